@@ -18,8 +18,9 @@ import sys
 from trac.admin import *
 from trac.api import IEnvironmentSetupParticipant
 from trac.core import *
-from trac.wiki import model
-from trac.wiki.api import WikiSystem, validate_page_name
+from trac.db.api import DatabaseManager
+from trac.wiki import db_default, model
+from trac.wiki.api import WikiSystem, _text_hash, validate_page_name
 from trac.util import read_file
 from trac.util.datefmt import datetime_now, format_datetime, from_utimestamp, \
                               to_utimestamp, utc
@@ -82,6 +83,27 @@ class WikiAdmin(Component):
                content and cannot be undone. It may be advisable to backup
                the current content using "wiki dump" beforehand.""",
                self._complete_load_replace, self._do_replace)
+        yield ('wiki compress', '[page] [...]',
+               """Store the previous versions of wiki pages as deltas
+
+               Each version is stored as a compressed delta against the
+               following version, except the latest version and every
+               [wiki] delta_keyframe_interval-th version. If no page is
+               specified, the versions of all wiki pages are compressed.""",
+               self._complete_pages, self._do_compress)
+        yield ('wiki uncompress', '[page] [...]',
+               """Store the full text of all versions of wiki pages
+
+               If no page is specified, the versions of all wiki pages are
+               uncompressed.""",
+               self._complete_pages, self._do_uncompress)
+        yield ('wiki reindex', '',
+               """Rebuild the search index of the wiki pages
+
+               The index is normally kept up to date when pages are
+               modified, but this is not the case while the WikiSearchIndex
+               component is disabled.""",
+               None, self._do_reindex)
         yield ('wiki upgrade', '',
                'Upgrade default wiki pages to current version',
                None, self._do_upgrade)
@@ -91,10 +113,11 @@ class WikiAdmin(Component):
 
     def export_page(self, page, filename):
 
-        for text, in self.env.db_query("""
-                SELECT text FROM wiki WHERE name=%s
+        for version, time, text in self.env.db_query("""
+                SELECT version, time, text FROM wiki WHERE name=%s
                 ORDER BY version DESC LIMIT 1
                 """, (page,)):
+            text = WikiSystem(self.env).expand_text(page, version, time, text)
             if not filename:
                 printout(text)
             else:
@@ -123,22 +146,26 @@ class WikiAdmin(Component):
 
         with self.env.db_transaction as db:
             # Make sure we don't insert the exact same page twice
-            old = db("""SELECT text FROM wiki WHERE name=%s
+            old = db("""SELECT version, time, text FROM wiki WHERE name=%s
                         ORDER BY version DESC LIMIT 1
                         """, (title,))
             if old and title in create_only:
                 printout(_("  %(title)s already exists", title=title))
                 return False
-            if old and data == old[0][0]:
+            if old and _text_hash(data) == \
+                    WikiSystem(self.env).get_text_hash(title, *old[0]):
                 printout(_("  %(title)s is already up to date", title=title))
                 return False
 
+            # The text goes to the wiki_text table when it's installed
+            text = None if WikiSystem(self.env).has_text_table else data
             if replace and old:
+                WikiSystem(self.env).uncompress_previous_version(title,
+                                                                 old[0][0])
                 db("""UPDATE wiki SET text=%s
-                      WHERE name=%s
-                        AND version=(SELECT max(version) FROM wiki
-                                     WHERE name=%s)
-                      """, (data, title, title))
+                      WHERE name=%s AND version=%s
+                      """, (text, title, old[0][0]))
+                WikiSystem(self.env).store_page_text(title, old[0][0], data)
             else:
                 db("""INSERT INTO wiki (version, readonly, name, time, author,
                                         text)
@@ -147,10 +174,24 @@ class WikiAdmin(Component):
                              %s, %s, 'trac', %s FROM wiki
                       WHERE name=%s AND version=(SELECT max(version)
                                                  FROM wiki WHERE name=%s)
-                      """, (title, to_utimestamp(datetime_now(utc)), data,
+                      """, (title, to_utimestamp(datetime_now(utc)), text,
                             title, title))
+                WikiSystem(self.env).store_page_text(
+                    title, old[0][0] + 1 if old else 1, data)
+                if old:
+                    WikiSystem(self.env).archive_version(title, old[0][0],
+                                                         old[0][0] + 1, data)
+            # The page is fetched again for updating the search index
+            WikiSystem(self.env).discard_page_rows(title)
+            if not (replace and old):
+                WikiSystem(self.env).update_latest([title])
+            from trac.wiki.web_ui import WikiSearchIndex
+            index = self.env[WikiSearchIndex]
+            if index:
+                index.reindex_page(title)
             if not old:
-                del WikiSystem(self.env).pages
+                WikiSystem(self.env).update_pages(added=[title])
+        WikiSystem(self.env).discard_page_rows(title)
         return True
 
     def load_pages(self, dir, ignore=[], create_only=[], replace=False):
@@ -169,6 +210,9 @@ class WikiAdmin(Component):
         if len(args) == 1:
             return self.get_wiki_list()
 
+    def _complete_pages(self, args):
+        return self.get_wiki_list()
+
     def _complete_import_export(self, args):
         if len(args) == 1:
             return self.get_wiki_list()
@@ -186,12 +230,16 @@ class WikiAdmin(Component):
             return get_dir_list(args[-1])
 
     def _do_list(self):
+        if WikiSystem(self.env).has_latest_table:
+            sql = """SELECT name, version, time
+                     FROM wiki_latest ORDER BY name"""
+        else:
+            sql = """SELECT name, max(version), max(time)
+                     FROM wiki GROUP BY name ORDER BY name"""
         print_table(
             [(title, int(edits), format_datetime(from_utimestamp(modified),
                                                  console_datetime_format))
-             for title, edits, modified in self.env.db_query("""
-                    SELECT name, max(version), max(time)
-                    FROM wiki GROUP BY name ORDER BY name""")
+             for title, edits, modified in self.env.db_query(sql)
              ], [_("Title"), _("Edits"), _("Modified")])
 
     def _do_rename(self, name, new_name):
@@ -202,7 +250,7 @@ class WikiAdmin(Component):
         if not validate_page_name(new_name):
             raise AdminCommandError(_("The new name is invalid."))
         with self.env.db_transaction:
-            if model.WikiPage(self.env, new_name).exists:
+            if model.WikiPage(self.env, new_name, fetch_text=False).exists:
                 raise AdminCommandError(_("The page %(name)s already exists.",
                                           name=new_name))
             page = model.WikiPage(self.env, name)
@@ -263,6 +311,36 @@ class WikiAdmin(Component):
     def _do_replace(self, *paths):
         self._load_or_replace(paths, replace=True)
 
+    def _do_compress(self, *names):
+        self._pack_pages(names, compress=True)
+
+    def _do_uncompress(self, *names):
+        self._pack_pages(names, compress=False)
+
+    def _do_reindex(self):
+        from trac.wiki.web_ui import WikiSearchIndex
+        index = WikiSearchIndex(self.env)
+        if not index.installed:
+            raise AdminCommandError(_("The wiki search index is not "
+                                      "installed"))
+        index.rebuild()
+
+    def _pack_pages(self, names, compress):
+        wiki = WikiSystem(self.env)
+        if not wiki.has_text_table:
+            raise AdminCommandError(_("The wiki text tables are not "
+                                      "installed"))
+        names = names or self.get_wiki_list()
+        for name in names:
+            if not wiki.has_page(name):
+                raise AdminCommandError(_("Page '%(page)s' not found",
+                                          page=name))
+        for name in names:
+            with self.env.db_transaction:
+                wiki.pack_page(name, compress)
+            wiki.discard_page_rows(name)
+            printout(' %s' % name)
+
     def _do_upgrade(self):
         self.load_pages(pkg_resources.resource_filename('trac.wiki',
                                                         'default-pages'),
@@ -272,18 +350,34 @@ class WikiAdmin(Component):
     # IEnvironmentSetupParticipant methods
 
     def environment_created(self):
-        """Add default wiki pages when environment is created."""
+        """Create the wiki tables and add default wiki pages when
+        environment is created."""
+        dbm = DatabaseManager(self.env)
+        dbm.create_tables(db_default.schema)
+        dbm.set_database_version(db_default.db_version,
+                                 db_default.db_version_name)
+        del WikiSystem(self.env).database_version
+
         self.log.info("Installing default wiki pages")
         pages_dir = pkg_resources.resource_filename('trac.wiki',
                                                     'default-pages')
         with self.env.db_transaction as db:
             self.load_pages(pages_dir)
-            for page in os.listdir(pages_dir):
-                if page not in ('InterMapTxt', 'SandBox', 'WikiStart'):
-                    db("UPDATE wiki SET readonly='1' WHERE name=%s", (page,))
+            readonly = [page for page in os.listdir(pages_dir)
+                        if page not in ('InterMapTxt', 'SandBox',
+                                        'WikiStart')]
+            for page in readonly:
+                db("UPDATE wiki SET readonly='1' WHERE name=%s", (page,))
+            WikiSystem(self.env).update_latest(readonly)
+            del WikiSystem(self.env).readonly_pages
 
     def environment_needs_upgrade(self):
-        pass
+        return DatabaseManager(self.env).needs_upgrade(
+            db_default.db_version, db_default.db_version_name)
 
     def upgrade_environment(self):
-        pass
+        DatabaseManager(self.env).upgrade(db_default.db_version,
+                                          db_default.db_version_name,
+                                          'trac.wiki.upgrades')
+        del WikiSystem(self.env).database_version
+        del WikiSystem(self.env).readonly_pages
@@ -16,15 +16,38 @@
 # Author: Jonas Borgström <jonas@edgewall.com>
 #         Christopher Lenz <cmlenz@gmx.de>
 
+import base64
+from bisect import bisect_left, insort
+from collections import Set
+from difflib import SequenceMatcher
+import hashlib
+import json
+import mmap
+import os
 import re
+import struct
+import threading
+import weakref
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from trac.cache import cached
-from trac.config import BoolOption, ListOption
+from trac.config import BoolOption, IntOption, ListOption
 from trac.core import *
+from trac.db.api import DatabaseManager
 from trac.resource import IResourceManager
-from trac.util.html import is_safe_origin, tag
-from trac.util.text import unquote_label
+from trac.util import AtomicFile, lazy
+from trac.util.compat import OrderedDict
+from trac.util.concurrency import ThreadLocal
+from trac.util.text import exception_to_unicode, unquote_label
+from trac.util.html import TracHTMLSanitizer, is_safe_origin, tag
 from trac.util.translation import _
+from trac.web.api import IRequestFilter
+from trac.wiki import db_default
 from trac.wiki.parser import WikiParser
 
 
@@ -245,10 +268,224 @@ def validate_page_name(pagename):
            all(part not in ('', '.', '..') for part in pagename.split('/'))
 
 
+_char_classes = {}
+
+
+def _char_class(predicate):
+    """Return the content of a regexp character class matching the
+    characters of the Basic Multilingual Plane for which `predicate`
+    is true, using ranges for the consecutive characters.
+
+    The result is computed on first use, then shared.
+
+    >>> _char_class(lambda c: c in u'abcxz')
+    u'a-cxz'
+    """
+    chars = _char_classes.get(predicate)
+    if chars is None:
+        buf = []
+        start = None
+        for code in xrange(0x10001):
+            if code < 0x10000 and predicate(unichr(code)):
+                if start is None:
+                    start = code
+            elif start is not None:
+                buf.append(_char_range(start, code - 1))
+                start = None
+        chars = _char_classes[predicate] = u''.join(buf)
+    return chars
+
+
+class _CharClass(object):
+    """Class attribute holding the content of the character class
+    built by `_char_class` for `predicate`, on first access.
+
+    >>> class Letters(object):
+    ...     vowels = _CharClass(lambda c: c in u'aeiou')
+    >>> Letters.vowels, Letters().vowels
+    (u'aeiou', u'aeiou')
+    """
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def __get__(self, instance, owner):
+        return _char_class(self.predicate)
+
+
+def _char_range(first, last):
+    def escape(code):
+        char = unichr(code)
+        return u'\\' + char if char in u'\\]^-' else char
+    if first == last:
+        return escape(first)
+    elif first + 1 == last:
+        return escape(first) + escape(last)
+    else:
+        return u'%s-%s' % (escape(first), escape(last))
+
+
+class LRUCache(object):
+    """Thread-safe mapping discarding its least recently used entries
+    when its size exceeds `max_size`.
+
+    The size of each entry is given when storing it. It defaults to 1, in
+    which case `max_size` is simply the maximum number of entries.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = entry
+            return entry[0]
+
+    def set(self, key, value, size=1):
+        if size > self.max_size:
+            return
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+            self._data[key] = value, size
+            self.size += size
+            while self.size > self.max_size:
+                key, entry = self._data.popitem(last=False)
+                self.size -= entry[1]
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def discard_matching(self, predicate):
+        """Remove the entries for which `predicate(key)` is true."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                self.size -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class PageNameIndex(Set):
+    """Read-only set of page names, stored sorted in a memory-mapped file
+    which can be shared by several processes.
+
+    The file starts with a header giving the cache `generation` of the
+    names and their count, followed by the offsets of the names and by
+    the UTF-8 encoded names.
+    """
+
+    _header = struct.Struct('<4sqI')
+    _magic = 'TWPI'
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, self._count = \
+            self._header.unpack_from(self._map)
+        if magic != self._magic:
+            raise ValueError("Not a page name index: %s" % path)
+        self._names = self._header.size + 4 * (self._count + 1)
+
+    @classmethod
+    def write(cls, path, generation, names):
+        """Write the page `names` of cache `generation` to the file
+        `path`, which is replaced atomically.
+        """
+        names = [name.encode('utf-8') for name in sorted(names)]
+        offsets = [0]
+        for name in names:
+            offsets.append(offsets[-1] + len(name))
+        f = AtomicFile(path, 'wb')
+        try:
+            f.write(cls._header.pack(cls._magic, generation, len(names)))
+            f.write(struct.pack('<%dI' % len(offsets), *offsets))
+            f.write(''.join(names))
+        except Exception:
+            f.rollback()
+            raise
+        f.commit()
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self._count:
+            raise IndexError(idx)
+        start, end = struct.unpack_from('<II', self._map,
+                                        self._header.size + 4 * idx)
+        return self._map[self._names + start:
+                         self._names + end].decode('utf-8')
+
+    def __iter__(self):
+        for idx in xrange(self._count):
+            yield self[idx]
+
+    def __contains__(self, name):
+        idx = bisect_left(self, name)
+        return idx < self._count and self[idx] == name
+
+
+def _text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _encode_delta(text, base):
+    """Return the compressed delta for rebuilding `text` from `base`.
+
+    The delta is a list of the line ranges copied from `base` and of the
+    strings inserted between them.
+    """
+    base_lines = base.splitlines(True)
+    lines = text.splitlines(True)
+    ops = []
+    matcher = SequenceMatcher(None, base_lines, lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append((i1, i2))
+        elif j1 < j2:
+            ops.append(u''.join(lines[j1:j2]))
+    data = zlib.compress(json.dumps(ops).encode('ascii'))
+    return base64.b64encode(data).decode('ascii')
+
+
+def _apply_delta(delta, base):
+    """Rebuild a text from `base` and a delta returned by `_encode_delta`.
+    """
+    data = base64.b64decode(delta.encode('ascii'))
+    base_lines = base.splitlines(True)
+    return u''.join(u''.join(base_lines[op[0]:op[1]])
+                    if isinstance(op, list) else op
+                    for op in json.loads(zlib.decompress(data)))
+
+
 class WikiSystem(Component):
     """Wiki system manager."""
 
-    implements(IResourceManager, IWikiSyntaxProvider)
+    implements(IRequestFilter, IResourceManager, IWikiSyntaxProvider)
 
     change_listeners = ExtensionPoint(IWikiChangeListener)
     macro_providers = ExtensionPoint(IWikiMacroProvider)
@@ -290,11 +527,256 @@ class WikiSystem(Component):
 
         To make any origins safe, specify "*" in the list.""")
 
+    shared_page_index = BoolOption('wiki', 'shared_page_index', 'false',
+        """Keep the names of the wiki pages in a memory-mapped file of the
+        environment `files` directory, shared by all the processes of the
+        host, instead of in a set in each process. (''since 1.3.6'')
+        """)
+
+    delta_storage = BoolOption('wiki', 'delta_storage', 'false',
+        """Store the previous versions of the wiki pages as compressed
+        deltas against the following version, instead of full copies of
+        their text. The latest version and every
+        `[wiki] delta_keyframe_interval`-th version are always stored in
+        full. Use `trac-admin wiki compress` to convert the existing
+        versions. Requires the `wiki_storage` table installed by
+        `trac-admin upgrade`. (''since 1.3.6'')
+        """)
+
+    delta_keyframe_interval = IntOption('wiki', 'delta_keyframe_interval',
+                                        16,
+        """Interval between the versions stored in full when
+        `[wiki] delta_storage` is enabled, which bounds the number of
+        deltas applied for retrieving a version. (''since 1.3.6'')
+        """)
+
+    delta_cache_size = IntOption('wiki', 'delta_cache_size', 4096,
+        """Maximum size in kilobytes of the texts rebuilt from deltas
+        kept in memory by each process. (''since 1.3.6'')
+        """)
+
+    def __init__(self):
+        self._macro_index = None
+        self._html_sanitizer = None
+        self._page_index = None
+        self._pages_snapshot = None
+        self._current_request = ThreadLocal(ref=None)
+        self._page_rows = weakref.WeakKeyDictionary()
+
+    # The changes to the set of page names are recorded in a small log
+    # kept in the `system` table, one slot per `pages` cache generation,
+    # so that the processes having an older generation can update their
+    # set instead of reloading all the names. Invalidating the cache
+    # without recording the changes (`del WikiSystem(env).pages`) forces
+    # a full reload.
+
+    _pages_log_size = 32
+
     @cached
     def pages(self):
         """Return the names of all existing wiki pages."""
-        return {name for name,
-                     in self.env.db_query("SELECT DISTINCT name FROM wiki")}
+        with self.env.db_query as db:
+            generation = self._pages_generation(db)
+            snapshot = self._pages_snapshot
+            if snapshot is not None and snapshot[0] == generation:
+                return snapshot[1]
+            pages = None
+            if self.shared_page_index:
+                pages = self._open_page_index(generation)
+            if pages is None and snapshot is not None and \
+                    snapshot[0] < generation <= \
+                    snapshot[0] + self._pages_log_size:
+                pages = self._apply_pages_log(db, snapshot[1], snapshot[0],
+                                              generation)
+            if pages is None:
+                pages = {name for name,
+                              in db("SELECT DISTINCT name FROM wiki")}
+            if self.shared_page_index and \
+                    not isinstance(pages, PageNameIndex):
+                pages = self._write_page_index(generation, pages)
+            self._pages_snapshot = (generation, pages)
+            return pages
+
+    @cached
+    def readonly_pages(self):
+        """Return the names of the wiki pages whose latest version is
+        read-only.
+        """
+        if self.has_latest_table:
+            return {name for name, in self.env.db_query("""
+                    SELECT name FROM wiki_latest WHERE readonly=1
+                    """)}
+        return {name for name, in self.env.db_query("""
+                SELECT w1.name FROM wiki w1
+                INNER JOIN (SELECT name, MAX(version) AS version
+                            FROM wiki GROUP BY name) w2
+                  ON w1.name = w2.name AND w1.version = w2.version
+                WHERE w1.readonly=1
+                """)}
+
+    @cached
+    def database_version(self):
+        """Return the version of the wiki tables of the database, or 0 if
+        they aren't installed.
+        """
+        dbm = DatabaseManager(self.env)
+        return dbm.get_database_version(db_default.db_version_name) or 0
+
+    @property
+    def has_latest_table(self):
+        """Whether the `wiki_latest` table, holding the latest version of
+        each page, is installed.
+        """
+        return self.database_version >= 1
+
+    @property
+    def has_text_table(self):
+        """Whether the `wiki_text` table, holding the page texts by
+        content hash, and the `wiki_storage` table, holding the texts of
+        the versions of the pages, are installed.
+
+        The `text` column of the `wiki` table is then `NULL`, except for
+        the rows inserted by other means, and the text of a version is
+        retrieved with `expand_text`.
+        """
+        return self.database_version >= 2
+
+    @property
+    def has_search_table(self):
+        """Whether the `wiki_search` table, holding the search index of
+        the wiki pages, is installed.
+        """
+        return self.database_version >= 3
+
+    @property
+    def has_plaintext_table(self):
+        """Whether the `wiki_plaintext` table, holding the latest version
+        of the pages without the wiki markup, is installed.
+        """
+        return self.database_version >= 4
+
+    def update_latest(self, names):
+        """Update the `wiki_latest` rows of the given pages from the
+        `wiki` table, in the current transaction.
+
+        Does nothing when the `wiki_latest` table isn't installed.
+        """
+        if not self.has_latest_table:
+            return
+        with self.env.db_transaction as db:
+            for name in names:
+                db("DELETE FROM wiki_latest WHERE name=%s", (name,))
+                db("""INSERT INTO wiki_latest
+                        (name, version, time, author, readonly)
+                      SELECT name, version, time, author, readonly
+                      FROM wiki WHERE name=%s AND version=(
+                        SELECT max(version) FROM wiki WHERE name=%s)
+                      """, (name, name))
+
+    def update_pages(self, added=(), removed=()):
+        """Update the `pages` cache after pages have been created, deleted
+        or renamed in the current transaction.
+
+        :param added: the names of the created pages
+        :param removed: the names of the deleted pages
+        """
+        with self.env.db_transaction as db:
+            del self.pages
+            generation = self._pages_generation(db)
+            name = 'wiki_pages_log:%d' % (generation % self._pages_log_size)
+            value = json.dumps([generation, list(added), list(removed)])
+            system = db.quote('system')
+            db("UPDATE %s SET value=%%s WHERE name=%%s" % system,
+               (value, name))
+            if not db("SELECT value FROM %s WHERE name=%%s" % system,
+                      (name,)):
+                db("INSERT INTO %s (name, value) VALUES (%%s, %%s)" % system,
+                   (name, value))
+
+    def _pages_generation(self, db):
+        for generation, in db("SELECT generation FROM cache WHERE id=%s",
+                              (WikiSystem.pages.id,)):
+            return generation
+        return -1
+
+    @property
+    def _page_index_path(self):
+        return os.path.join(self.env.files_dir, 'wiki-pages.idx')
+
+    def _open_page_index(self, generation):
+        try:
+            index = PageNameIndex(self._page_index_path)
+        except (EnvironmentError, ValueError, struct.error):
+            return None
+        if index.generation == generation:
+            return index
+
+    def _write_page_index(self, generation, pages):
+        """Write `pages` to the shared page name index and return the
+        index, or `pages` if the index couldn't be written.
+
+        Only one process writes the index at a time, the others keep
+        their own set of names. The index isn't replaced by an older
+        generation, which a slower process may still be writing.
+        """
+        path = self._page_index_path
+        try:
+            if not os.path.isdir(self.env.files_dir):
+                os.makedirs(self.env.files_dir)
+            with open(path + '.lock', 'w') as lock:
+                if fcntl:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        return pages
+                try:
+                    index = PageNameIndex(path)
+                except (EnvironmentError, ValueError, struct.error):
+                    index = None
+                if index is None or index.generation < generation:
+                    PageNameIndex.write(path, generation, pages)
+                    index = PageNameIndex(path)
+            return index if index.generation == generation else pages
+        except EnvironmentError as e:
+            self.log.warning("Can't write the wiki page name index: %s",
+                             exception_to_unicode(e))
+            return pages
+
+    def _apply_pages_log(self, db, pages, start, end):
+        """Return a copy of the `pages` set of generation `start`, updated
+        to generation `end`, or `None` if the log is incomplete.
+        """
+        names = ['wiki_pages_log:%d' % (generation % self._pages_log_size)
+                 for generation in xrange(start + 1, end + 1)]
+        changes = {}
+        for value, in db("SELECT value FROM %s WHERE name IN (%s)"
+                         % (db.quote('system'), ','.join(['%s'] * len(names))),
+                         names):
+            generation, added, removed = json.loads(value)
+            changes[generation] = added, removed
+        if not all(generation in changes
+                   for generation in xrange(start + 1, end + 1)):
+            return None
+        index = self._page_index
+        sorted_names = None
+        if index is not None and index[0] is pages:
+            sorted_names = list(index[1])
+        pages = set(pages)
+        for generation in xrange(start + 1, end + 1):
+            added, removed = changes[generation]
+            for name in removed:
+                if name in pages:
+                    pages.remove(name)
+                    if sorted_names is not None:
+                        del sorted_names[bisect_left(sorted_names, name)]
+            for name in added:
+                if name not in pages:
+                    pages.add(name)
+                    if sorted_names is not None:
+                        insort(sorted_names, name)
+        if sorted_names is not None:
+            self._page_index = (pages, sorted_names)
+        return pages
 
     # Public API
 
@@ -304,17 +786,357 @@ class WikiSystem(Component):
         :param prefix: if given, only names that start with that
           prefix are included.
         """
-        for page in self.pages:
-            if not prefix or page.startswith(prefix):
+        if not prefix:
+            for page in self.pages:
                 yield page
+            return
+        names = self._sorted_pages()
+        for idx in xrange(bisect_left(names, prefix), len(names)):
+            page = names[idx]
+            if not page.startswith(prefix):
+                break
+            yield page
 
     def has_page(self, pagename):
         """Whether a page with the specified name exists."""
         return pagename.rstrip('/') in self.pages
 
+    def _sorted_pages(self):
+        """Return the names of all existing wiki pages as a sorted list,
+        which is rebuilt when the `pages` cache is reloaded.
+        """
+        pages = self.pages
+        if isinstance(pages, PageNameIndex):
+            return pages
+        index = self._page_index
+        if index is None or index[0] is not pages:
+            index = self._page_index = (pages, sorted(pages))
+        return index[1]
+
+    def get_page_row(self, name, version, with_text, fetch):
+        """Return the `(version, time, author, text, comment, readonly)`
+        row of the wiki table for page `name` at `version` (`None` for
+        the latest version), or `None` if there's no such page.
+
+        During a request, the rows are kept with the request object so
+        that the page is only retrieved once, by calling `fetch()`. The
+        `text` of the row is `None` unless the row has been fetched
+        `with_text`.
+        """
+        rows = self._get_request_rows()
+        if rows is None:
+            return fetch()
+        key = (name, version)
+        if key in rows:
+            row = rows[key]
+            if row is None or not with_text or row[3] is not None:
+                return row
+        row = rows[key] = fetch()
+        if row is not None and version is None:
+            rows[(name, row[0])] = row
+        return row
+
+    def discard_page_rows(self, name):
+        """Forget the rows kept for page `name` during the current request,
+        once the modifications of the page have been committed.
+        """
+        rows = self._get_request_rows()
+        if rows:
+            for key in [key for key in rows if key[0] == name]:
+                del rows[key]
+
+    def _get_request_rows(self):
+        ref = self._current_request.ref
+        req = ref() if ref is not None else None
+        if req is not None:
+            return self._page_rows.get(req)
+
+    @lazy
+    def _delta_texts(self):
+        return LRUCache(self.delta_cache_size * 1024)
+
+    def expand_text(self, name, version, time, text):
+        """Return the text of `version` of page `name`, given its `time`
+        and its `text` as stored in the wiki table.
+
+        The text is `None` for the versions stored in the `wiki_storage`
+        table, which are either a reference to the `wiki_text` table or a
+        delta against the text of a following version. The texts rebuilt
+        from deltas are kept in a cache of limited size.
+        """
+        if text is not None or not self.has_text_table:
+            return text
+        chain = []
+        while text is None:
+            key = (name, version, time)
+            cached = self._delta_texts.get(key)
+            if cached is not None:
+                text = cached
+                break
+            for digest, base, delta in self.env.db_query("""
+                    SELECT hash, base, delta FROM wiki_storage
+                    WHERE name=%s AND version=%s
+                    """, (name, version)):
+                break
+            else:
+                raise TracError(_("The text of version %(num)s of page "
+                                  "%(name)s can't be rebuilt",
+                                  num=version, name=name))
+            if delta is None:
+                text = self.load_text(digest)
+                break
+            chain.append((key, delta))
+            for version, time, text in self.env.db_query("""
+                    SELECT version, time, text FROM wiki
+                    WHERE name=%s AND version=%s
+                    """, (name, base)):
+                break
+            else:
+                raise TracError(_("The text of version %(num)s of page "
+                                  "%(name)s can't be rebuilt",
+                                  num=chain[-1][0][1], name=name))
+        for key, delta in reversed(chain):
+            text = _apply_delta(delta, text)
+            self._delta_texts.set(key, text, len(text))
+        return text
+
+    def get_text_hash(self, name, version, time, text):
+        """Return the content hash of the text of `version` of page
+        `name`, given its `time` and its `text` as stored in the wiki
+        table.
+
+        The text is only retrieved when the version isn't stored as a
+        reference to the `wiki_text` table.
+        """
+        if text is None and self.has_text_table:
+            for digest, in self.env.db_query("""
+                    SELECT hash FROM wiki_storage
+                    WHERE name=%s AND version=%s AND hash IS NOT NULL
+                    """, (name, version)):
+                return digest
+        return _text_hash(self.expand_text(name, version, time, text))
+
+    def get_text_sql(self, alias):
+        """Return the SQL expression selecting the text of the rows of
+        the wiki table aliased `alias`, and the joins it requires.
+
+        The texts stored as deltas are `NULL`, which is never the case
+        for the latest version of the pages.
+        """
+        if not self.has_text_table:
+            return '%s.text' % alias, ''
+        return ('COALESCE(%s.text, %s_t.text)' % (alias, alias), """
+            LEFT OUTER JOIN wiki_storage %(a)s_s
+              ON %(a)s_s.name = %(a)s.name AND %(a)s_s.version = %(a)s.version
+            LEFT OUTER JOIN wiki_text %(a)s_t ON %(a)s_t.hash = %(a)s_s.hash
+            """ % {'a': alias})
+
+    def load_text(self, digest):
+        """Return the text of the `wiki_text` table having hash `digest`.
+        """
+        for text, in self.env.db_query("""
+                SELECT text FROM wiki_text WHERE hash=%s
+                """, (digest,)):
+            return text
+        raise TracError(_("Text %(hash)s is missing", hash=digest))
+
+    def store_text(self, text):
+        """Acquire a reference to the row of the `wiki_text` table for
+        `text`, in the current transaction, and return its hash.
+
+        The row is shared by all the versions having the same text.
+        """
+        digest = _text_hash(text)
+        with self.env.db_transaction as db:
+            for refs, in db("SELECT refs FROM wiki_text WHERE hash=%s",
+                            (digest,)):
+                db("UPDATE wiki_text SET refs=refs+1 WHERE hash=%s",
+                   (digest,))
+                break
+            else:
+                db("""INSERT INTO wiki_text (hash, text, refs)
+                      VALUES (%s, %s, 1)""", (digest, text))
+        return digest
+
+    def release_texts(self, digests):
+        """Release the references to the `wiki_text` table of the hashes
+        `digests`, in the current transaction.
+
+        The texts are deleted when they are no longer referenced.
+        """
+        counts = {}
+        for digest in digests:
+            if digest is not None:
+                counts[digest] = counts.get(digest, 0) + 1
+        if counts:
+            with self.env.db_transaction as db:
+                for digest, count in counts.iteritems():
+                    db("UPDATE wiki_text SET refs=refs-%s WHERE hash=%s",
+                       (count, digest))
+                    db("DELETE FROM wiki_text WHERE hash=%s AND refs<=0",
+                       (digest,))
+
+    def release_page_texts(self, name, version=None):
+        """Delete the `wiki_storage` rows of `version` of page `name`, or
+        of all its versions if `version` is `None`, and release their
+        references to the `wiki_text` table.
+        """
+        if not self.has_text_table:
+            return
+        with self.env.db_transaction as db:
+            where = "name=%s"
+            args = [name]
+            if version is not None:
+                where += " AND version=%s"
+                args.append(version)
+            self.release_texts([digest for digest, in db("""
+                SELECT hash FROM wiki_storage WHERE %s
+                """ % where, args)])
+            db("DELETE FROM wiki_storage WHERE %s" % where, args)
+
+    def _is_shared_text(self, digest):
+        for refs, in self.env.db_query("""
+                SELECT refs FROM wiki_text WHERE hash=%s
+                """, (digest,)):
+            return refs > 0
+        return False
+
+    def _store_version(self, name, version, text, next_version, next_text,
+                       compress):
+        # Store `text` as a delta against the text of `next_version`,
+        # unless it's a keyframe or its text is already stored, or as a
+        # reference to the wiki_text table otherwise.
+        interval = self.delta_keyframe_interval
+        with self.env.db_transaction as db:
+            self.release_page_texts(name, version)
+            delta = None
+            if compress and next_version is not None and \
+                    not (interval > 0 and version % interval == 0) and \
+                    not self._is_shared_text(_text_hash(text)):
+                delta = _encode_delta(text, next_text)
+                if len(delta) >= len(text):
+                    delta = None
+            if delta is not None:
+                db("""INSERT INTO wiki_storage (name, version, base, delta)
+                      VALUES (%s, %s, %s, %s)
+                      """, (name, version, next_version, delta))
+            else:
+                db("""INSERT INTO wiki_storage (name, version, hash)
+                      VALUES (%s, %s, %s)
+                      """, (name, version, self.store_text(text)))
+            db("UPDATE wiki SET text=NULL WHERE name=%s AND version=%s",
+               (name, version))
+
+    def store_page_text(self, name, version, text):
+        """Store the text of `version` of page `name` as a reference to
+        the `wiki_text` table, in the current transaction. Does nothing
+        when the `wiki_storage` table isn't installed.
+        """
+        if not self.has_text_table:
+            return
+        self._store_version(name, version, text, None, None, False)
+
+    def archive_version(self, name, version, next_version, next_text):
+        """Store the text of `version` of page `name` as a delta against
+        `next_text`, once `next_version` having this text is saved.
+
+        The text stays a reference to the `wiki_text` table unless
+        `[wiki] delta_storage` is enabled. The text left in the wiki
+        table by other means is moved to the `wiki_storage` table. Does
+        nothing when this table isn't installed.
+        """
+        if not self.has_text_table:
+            return
+        with self.env.db_transaction as db:
+            for time, text in db("""
+                    SELECT time, text FROM wiki WHERE name=%s AND version=%s
+                    """, (name, version)):
+                if text is not None or self.delta_storage:
+                    text = self.expand_text(name, version, time, text)
+                    self._store_version(name, version, text, next_version,
+                                        next_text, self.delta_storage)
+
+    def uncompress_previous_version(self, name, version):
+        """Store the version of page `name` which is a delta against
+        `version` as a reference to the `wiki_text` table, before
+        `version` is deleted or its text replaced.
+        """
+        if not self.has_text_table:
+            return
+        with self.env.db_transaction as db:
+            for prev, time in db("""
+                    SELECT w.version, w.time FROM wiki w
+                    INNER JOIN wiki_storage s
+                      ON s.name = w.name AND s.version = w.version
+                    WHERE s.name=%s AND s.base=%s
+                    """, (name, version)):
+                text = self.expand_text(name, prev, time, None)
+                self._store_version(name, prev, text, None, None, False)
+
+    def pack_page(self, name, compress=True):
+        """Store the versions of page `name`, except the latest one and
+        the keyframes, as deltas if `compress` is `True`, or all of them
+        as references to the `wiki_text` table otherwise.
+        """
+        with self.env.db_transaction as db:
+            next_version = next_text = None
+            for version, time, text in db("""
+                    SELECT version, time, text FROM wiki WHERE name=%s
+                    ORDER BY version DESC""", (name,)):
+                if text is None:
+                    for digest, base, delta in db("""
+                            SELECT hash, base, delta FROM wiki_storage
+                            WHERE name=%s AND version=%s
+                            """, (name, version)):
+                        if delta is None:
+                            text = self.load_text(digest)
+                        elif base == next_version:
+                            text = _apply_delta(delta, next_text)
+                    if text is None:
+                        text = self.expand_text(name, version, time, text)
+                self._store_version(name, version, text, next_version,
+                                    next_text, compress)
+                next_version, next_text = version, text
+
     def is_safe_origin(self, uri, req=None):
         return is_safe_origin(self.safe_origins, uri, req=req)
 
+    def get_macro_provider(self, name):
+        """Return the `(provider, inline_check)` pair for the macro
+        `name`, or `None` if no `IWikiMacroProvider` provides it.
+
+        The macro names are indexed on first use, and the index is
+        rebuilt when the set of enabled macro providers changes. When
+        several providers define the same macro, the last one wins.
+
+        As the macros of a provider can depend on its state, like the
+        wiki pages or the configuration, the index is also rebuilt when
+        it doesn't have `name`, before `None` is returned.
+        """
+        providers = self.macro_providers
+        index = self._macro_index
+        if index is None or index[0] != providers or \
+                name not in index[1]:
+            macros = {}
+            for provider in providers:
+                inline_check = getattr(provider, 'is_inline', False)
+                for macro_name in provider.get_macros() or []:
+                    macros[macro_name] = (provider, inline_check)
+            index = self._macro_index = (providers, macros)
+        return index[1].get(name)
+
+    @property
+    def html_sanitizer(self):
+        """The `TracHTMLSanitizer` corresponding to the `safe_schemes`
+        and `safe_origins` settings."""
+        settings = (self.safe_schemes, self.safe_origins)
+        sanitizer = self._html_sanitizer
+        if sanitizer is None or sanitizer[0] != settings:
+            sanitizer = self._html_sanitizer = \
+                (settings, TracHTMLSanitizer(safe_schemes=settings[0],
+                                             safe_origins=settings[1]))
+        return sanitizer[1]
+
     def resolve_relative_name(self, pagename, referrer):
         """Resolves a pagename relative to a referrer pagename."""
         if pagename.startswith(('./', '../')) or pagename in ('.', '..'):
@@ -329,8 +1151,9 @@ class WikiSystem(Component):
 
     PAGE_SPLIT_RE = re.compile(r"([a-z])([A-Z])(?=[a-z])")
 
-    Lu = ''.join(unichr(c) for c in xrange(0x10000) if unichr(c).isupper())
-    Ll = ''.join(unichr(c) for c in xrange(0x10000) if unichr(c).islower())
+    # Character class content for the uppercase and lowercase letters
+    Lu = _CharClass(unicode.isupper)
+    Ll = _CharClass(unicode.islower)
 
     def format_page_name(self, page, split=False):
         if split or self.split_page_names:
@@ -410,43 +1233,62 @@ class WikiSystem(Component):
 
     def _format_link(self, formatter, ns, pagename, label, ignore_missing,
                      original_label=None):
-        pagename, query, fragment = formatter.split_link(pagename)
-        version = None
-        if '@' in pagename:
-            pagename, version = pagename.split('@', 1)
-        if version and query:
-            query = '&' + query[1:]
-        pagename = pagename.rstrip('/') or self.START_PAGE
+        memo = getattr(formatter, 'link_memo', None)
         referrer = ''
         if formatter.resource and formatter.resource.realm == self.realm:
             referrer = formatter.resource.id
-        if pagename.startswith('/'):
-            pagename = pagename.lstrip('/')
-        elif pagename.startswith(('./', '../')) or pagename in ('.', '..'):
-            pagename = self._resolve_relative_name(pagename, referrer)
-        else:
-            pagename = self._resolve_scoped_name(pagename, referrer)
+        key = (ns, pagename, referrer,
+               formatter.href.base if formatter.href is not None else None)
+        link = memo.get(key) if memo is not None else None
+        if link is None:
+            link = self._resolve_link(formatter, pagename, referrer)
+            if memo is not None:
+                memo[key] = link
+        href, exists, can_view, can_create = link
         label = unquote_label(label)
-        if 'WIKI_VIEW' in formatter.perm(self.realm, pagename, version):
-            href = formatter.href.wiki(pagename, version=version) + query \
-                   + fragment
-            if self.has_page(pagename):
+        if can_view:
+            if exists:
                 return tag.a(label, href=href, class_='wiki')
             else:
                 if ignore_missing:
                     return original_label or label
-                if 'WIKI_CREATE' in \
-                        formatter.perm(self.realm, pagename, version):
+                if can_create:
                     return tag.a(label, class_='missing wiki',
                                  href=href, rel='nofollow')
                 else:
                     return tag.a(label, class_='missing wiki')
-        elif ignore_missing and not self.has_page(pagename):
+        elif ignore_missing and not exists:
             return original_label or label
         else:
             return tag.a(label, class_='forbidden wiki',
                          title=_("no permission to view this wiki page"))
 
+    def _resolve_link(self, formatter, pagename, referrer):
+        """Return the `(href, exists, can_view, can_create)` tuple for a
+        link to `pagename` from the `referrer` page.
+        """
+        pagename, query, fragment = formatter.split_link(pagename)
+        version = None
+        if '@' in pagename:
+            pagename, version = pagename.split('@', 1)
+        if version and query:
+            query = '&' + query[1:]
+        pagename = pagename.rstrip('/') or self.START_PAGE
+        if pagename.startswith('/'):
+            pagename = pagename.lstrip('/')
+        elif pagename.startswith(('./', '../')) or pagename in ('.', '..'):
+            pagename = self._resolve_relative_name(pagename, referrer)
+        else:
+            pagename = self._resolve_scoped_name(pagename, referrer)
+        exists = self.has_page(pagename)
+        if 'WIKI_VIEW' in formatter.perm(self.realm, pagename, version):
+            href = formatter.href.wiki(pagename, version=version) + query \
+                   + fragment
+            can_create = not exists and \
+                'WIKI_CREATE' in formatter.perm(self.realm, pagename, version)
+            return href, exists, True, can_create
+        return None, exists, False, False
+
     def _resolve_relative_name(self, pagename, referrer):
         base = referrer.split('/')
         components = pagename.split('/')
@@ -463,9 +1305,12 @@ class WikiSystem(Component):
         referrer = referrer.split('/')
         if len(referrer) == 1:           # Non-hierarchical referrer
             return pagename
+        ancestors = []                   # 'First/', 'First/Second/', ...
+        for part in referrer[:-1]:
+            ancestors.append((ancestors[-1] if ancestors else '') + part + '/')
         # Test for pages with same name, higher in the hierarchy
-        for i in xrange(len(referrer) - 1, 0, -1):
-            name = '/'.join(referrer[:i]) + '/' + pagename
+        for ancestor in reversed(ancestors):
+            name = ancestor + pagename
             if self.has_page(name):
                 return name
         if self.has_page(pagename):
@@ -481,7 +1326,21 @@ class WikiSystem(Component):
                     if self.has_page(anchor):
                         return anchor + '/' + rest
         # Assume the user wants a sibling of referrer
-        return '/'.join(referrer[:-1]) + '/' + pagename
+        return ancestors[-1] + pagename
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        # The page rows are kept as long as the request object, as the
+        # response may be generated after the filters ran. Only a weak
+        # reference to the request is kept for the thread, so nothing is
+        # used once the request is gone.
+        self._current_request.ref = weakref.ref(req)
+        self._page_rows[req] = {}
+        return handler
+
+    def post_process_request(self, req, template, data, metadata):
+        return template, data, metadata
 
     # IResourceManager methods
 
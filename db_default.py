@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://trac.edgewall.org/wiki/TracLicense.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://trac.edgewall.org/log/.
+
+from trac.db.schema import Table, Column, Index
+
+# Name of the entry in the system table holding the version of the wiki
+# schema, and the version identifier used for automatic upgrades.
+db_version_name = 'wiki_version'
+db_version = 4
+
+##
+## Database schema
+##
+
+schema = [
+    # Latest version of each wiki page, maintained along the `wiki` table
+    Table('wiki_latest', key='name')[
+        Column('name'),
+        Column('version', type='int'),
+        Column('time', type='int64'),
+        Column('author'),
+        Column('readonly', type='int'),
+        Index(['time'])],
+    # Texts of the wiki table versions, stored once for each content hash
+    Table('wiki_text', key='hash')[
+        Column('hash'),
+        Column('text'),
+        Column('refs', type='int')],
+    # Texts of the versions of the wiki pages, which are NULL in the wiki
+    # table: either the hash of a wiki_text row or, for the previous
+    # versions, a delta against the text of the following version `base`
+    Table('wiki_storage', key=('name', 'version'))[
+        Column('name'),
+        Column('version', type='int'),
+        Column('hash'),
+        Column('base', type='int'),
+        Column('delta')],
+    # Search index of the latest version of the wiki pages
+    Table('wiki_search', key=('term', 'name'))[
+        Column('term'),
+        Column('name'),
+        Column('weight', type='int'),
+        Index(['name'])],
+    # Latest version of the wiki pages without the wiki markup
+    Table('wiki_plaintext', key='name')[
+        Column('name'),
+        Column('version', type='int'),
+        Column('text')],
+]
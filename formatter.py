@@ -19,29 +19,36 @@
 #         Christian Boos <cboos@edgewall.org>
 
 from HTMLParser import HTMLParseError
+from functools import partial
+from hashlib import sha1
 import io
 import re
 
 from trac.core import *
 from trac.mimeview import *
+from trac.perm import PermissionSystem
 from trac.resource import get_relative_resource, get_resource_url
-from trac.util import arity, as_int
+from trac.util import arity, as_int, lazy
 from trac.util.text import (
     exception_to_unicode, shorten_line, to_unicode, unicode_quote,
     unquote_label
 )
 from trac.util.html import (
-    Element, Fragment, Markup, Stream, TracHTMLSanitizer, escape, genshi,
-    plaintext, stream_to_unicode, tag, to_fragment
+    Element, Fragment, Markup, Stream, escape, genshi, plaintext,
+    stream_to_unicode, tag, to_fragment
 )
 from trac.util.translation import _, tag_
 from trac.wiki.api import WikiSystem, parse_args
-from trac.wiki.parser import WikiParser, parse_processor_args
+from trac.wiki.parser import (
+    BLOCK_BLANK, BLOCK_CODE, BLOCK_HR, BLOCK_LINE, BLOCK_QUOTE, WikiDocument,
+    WikiParser, parse_processor_args
+)
 
 __all__ = ['Formatter', 'MacroError', 'ProcessorError',
-           'concat_path_query_fragment', 'extract_link', 'format_to',
-           'format_to_html', 'format_to_oneliner',
-           'split_url_into_path_query_fragment', 'wiki_to_outline']
+           'concat_path_query_fragment', 'extract_link', 'format_many',
+           'format_to', 'format_to_html', 'format_to_oneliner',
+           'format_to_plaintext', 'split_url_into_path_query_fragment',
+           'wiki_to_outline']
 
 
 def _markup_to_unicode(markup):
@@ -134,6 +141,24 @@ class WikiProcessor(object):
     _block_elem_re = re.compile(r'^\s*<(?:div|table)(?:\s+[^>]+)?>',
                                 re.I | re.M)
 
+    _builtin_processors = {'html': '_html_processor',
+                           'htmlcomment': '_htmlcomment_processor',
+                           'default': '_default_processor',
+                           'comment': '_comment_processor',
+                           'div': '_div_processor',
+                           'rtl': '_rtl_processor',
+                           'span': '_span_processor',
+                           'Span': '_span_processor',
+                           'td': '_td_processor',
+                           'th': '_th_processor',
+                           'tr': '_tr_processor',
+                           'table': '_table_processor',
+                           }
+
+    _builtin_inline_checks = {'htmlcomment': True, 'comment': True,
+                              'span': True, 'Span': True,
+                              }
+
     def __init__(self, formatter, name, args=None):
         """Find the processor by name
 
@@ -149,48 +174,31 @@ class WikiProcessor(object):
         self.args = args
         self.error = None
         self.macro_provider = None
+        self.processor = None
 
-        # FIXME: move these tables outside of __init__
-        builtin_processors = {'html': self._html_processor,
-                              'htmlcomment': self._htmlcomment_processor,
-                              'default': self._default_processor,
-                              'comment': self._comment_processor,
-                              'div': self._div_processor,
-                              'rtl': self._rtl_processor,
-                              'span': self._span_processor,
-                              'Span': self._span_processor,
-                              'td': self._td_processor,
-                              'th': self._th_processor,
-                              'tr': self._tr_processor,
-                              'table': self._table_processor,
-                              }
-
-        self.inline_check = {'html': self._html_is_inline,
-                             'htmlcomment': True, 'comment': True,
-                             'span': True, 'Span': True,
-                             }.get(name)
+        if name == 'html':
+            self.inline_check = self._html_is_inline
+        else:
+            self.inline_check = self._builtin_inline_checks.get(name)
 
-        self._sanitizer = TracHTMLSanitizer(
-            safe_schemes=formatter.wiki.safe_schemes,
-            safe_origins=formatter.wiki.safe_origins)
+        self._sanitizer = formatter.wiki.html_sanitizer
 
-        self.processor = builtin_processors.get(name)
-        if not self.processor:
+        processor = self._builtin_processors.get(name)
+        if processor:
+            self.processor = getattr(self, processor)
+        else:
             # Find a matching wiki macro
-            for macro_provider in WikiSystem(self.env).macro_providers:
-                for macro_name in macro_provider.get_macros() or []:
-                    if self.name == macro_name:
-                        if hasattr(macro_provider, 'expand_macro'):
-                            self.processor = self._macro_processor
-                        else:
-                            raise TracError(
-                                tag_("Pre-0.11 macros with the %(method)s "
-                                     "method are no longer supported.",
-                                     method=tag.code("render_macro")))
-                        self.macro_provider = macro_provider
-                        self.inline_check = getattr(macro_provider, 'is_inline',
-                                                    False)
-                        break
+            macro = formatter.wiki.get_macro_provider(name)
+            if macro:
+                macro_provider, self.inline_check = macro
+                if hasattr(macro_provider, 'expand_macro'):
+                    self.processor = self._macro_processor
+                else:
+                    raise TracError(
+                        tag_("Pre-0.11 macros with the %(method)s "
+                             "method are no longer supported.",
+                             method=tag.code("render_macro")))
+                self.macro_provider = macro_provider
         if not self.processor:
             # Find a matching mimeview renderer
             mimeview = Mimeview(formatter.env)
@@ -426,6 +434,16 @@ class WikiProcessor(object):
         return text
 
 
+def _permissions_key(env, username):
+    """Return a digest of the actions granted to `username`, for keying
+    the cached renderings which depend on permission checks.
+    """
+    if not username:
+        return None
+    actions = PermissionSystem(env).get_user_permissions(username)
+    return sha1(' '.join(sorted(actions))).hexdigest()
+
+
 class Formatter(object):
     """Base Wiki formatter.
 
@@ -436,8 +454,14 @@ class Formatter(object):
 
     def __init__(self, env, context):
         self.env = env
+        # The resolutions of the wiki links are shared with the formatters
+        # created for nested content, through the rendering context.
+        self.link_memo = context.get_hint('wiki_link_memo')
+        if self.link_memo is None:
+            self.link_memo = {}
         self.context = context.child()
-        self.context.set_hints(disable_warnings=True)
+        self.context.set_hints(disable_warnings=True,
+                               wiki_link_memo=self.link_memo)
         self.req = context.req
         self.href = context.href
         self.resource = context.resource
@@ -445,7 +469,11 @@ class Formatter(object):
         self.wiki = WikiSystem(self.env)
         self.wikiparser = WikiParser(self.env)
         self._anchors = {}
+        self._anchor_probes = None
         self._open_tags = []
+        self._match_handlers = {}
+        self.block_cache = None
+        self.wikidom = None
         self._safe_schemes = None
         if not self.wiki.render_unsafe_content:
             self._safe_schemes = set(self.wiki.safe_schemes)
@@ -767,7 +795,12 @@ class Formatter(object):
     def _unique_anchor(self, anchor):
         i = 1
         anchor_base = anchor
-        while anchor in self._anchors:
+        while True:
+            exists = anchor in self._anchors
+            if self._anchor_probes is not None:
+                self._anchor_probes.setdefault(anchor, exists)
+            if not exists:
+                break
             anchor = anchor_base + str(i)
             i += 1
         self._anchors[anchor] = True
@@ -1154,58 +1187,15 @@ class Formatter(object):
     def parse_processor_args(self, line):
         return parse_processor_args(line)
 
-    def handle_code_block(self, line, startmatch=None):
-        if startmatch:
-            self.in_code_block += 1
-            if self.in_code_block == 1:
-                name = startmatch.group(2)
-                if name:
-                    args = parse_processor_args(line[startmatch.end():])
-                    self.code_processor = WikiProcessor(self, name, args)
-                else:
-                    self.code_processor = None
-                self.code_buf = []
-                self.code_prefix = line[:line.find(WikiParser.STARTBLOCK)]
-            else:
-                self.code_buf.append(line)
-                if not self.code_processor:
-                    self.code_processor = WikiProcessor(self, 'default')
-        elif line.strip() == WikiParser.ENDBLOCK:
-            self.in_code_block -= 1
-            if self.in_code_block == 0 and self.code_processor:
-                if self.code_processor.name not in ('th', 'td', 'tr'):
-                    self.close_table()
-                self.close_paragraph()
-                if self.code_buf:
-                    if self.code_prefix and all(not l or
-                                                l.startswith(self.code_prefix)
-                                                for l in self.code_buf):
-                        code_indent = len(self.code_prefix)
-                        self.code_buf = [l[code_indent:]
-                                         for l in self.code_buf]
-                    self.code_buf.append('')
-                code_text = '\n'.join(self.code_buf)
-                processed = self._exec_processor(self.code_processor,
-                                                 code_text)
-                self.out.write(_markup_to_unicode(processed))
-            else:
-                self.code_buf.append(line)
-        elif not self.code_processor:
-            match = WikiParser._processor_re.match(line)
-            if match:
-                self.code_prefix = match.group(1)
-                name = match.group(2)
-                args = parse_processor_args(line[match.end():])
-                self.code_processor = WikiProcessor(self, name, args)
-            else:
-                self.code_buf.append(line)
-                self.code_processor = WikiProcessor(self, 'default')
-        else:
-            self.code_buf.append(line)
-
-    def close_code_blocks(self):
-        while self.in_code_block > 0:
-            self.handle_code_block(WikiParser.ENDBLOCK)
+    def handle_code_block(self, name, args, text):
+        """Render a code block, using the `name` processor."""
+        processor = WikiProcessor(self, name,
+                                  dict(args) if args is not None else None)
+        if processor.name not in ('th', 'td', 'tr'):
+            self.close_table()
+        self.close_paragraph()
+        processed = self._exec_processor(processor, text)
+        self.out.write(_markup_to_unicode(processed))
 
     def _exec_processor(self, processor, text):
         try:
@@ -1222,9 +1212,11 @@ class Formatter(object):
 
     # > quotes
 
-    def handle_quote_block(self, line):
+    def handle_quote_block(self, depth, wikidom, escape_newlines):
+        """Render a citation, `wikidom` being the parsed content of the
+        quoted lines.
+        """
         self.close_paragraph()
-        depth = line.find('>')
         # Close lists up to current level:
         #
         #  - first level item
@@ -1232,37 +1224,34 @@ class Formatter(object):
         #    > citation part of first level item
         #
         #  (depth == 3, _list_stack == [1, 3])
-        if not self._quote_buffer and depth < self._get_list_depth():
+        if depth < self._get_list_depth():
             self.close_list(depth)
-        self._quote_buffer.append(line[depth + 1:])
-
-    def close_quote_block(self, escape_newlines):
-        if self._quote_buffer:
-            # avoid an extra <blockquote> when there's consistently one space
-            # after the '>'
-            if all(not line or line[0] in '> ' for line in self._quote_buffer):
-                self._quote_buffer = [line[bool(line and line[0] == ' '):]
-                                      for line in self._quote_buffer]
-            self.out.write(u'<blockquote class="citation">\n')
-            Formatter(self.env, self.context).format(self._quote_buffer,
-                                                     self.out, escape_newlines)
-            self.out.write(u'</blockquote>\n')
-            self._quote_buffer = []
+        self.out.write(u'<blockquote class="citation">\n')
+        Formatter(self.env, self.context).format(wikidom, self.out,
+                                                 escape_newlines)
+        self.out.write(u'</blockquote>\n')
 
     # -- Wiki engine
 
     def handle_match(self, fullmatch):
-        for itype, match in fullmatch.groupdict().items():
-            if match and not itype in self.wikiparser.helper_patterns:
-                # Check for preceding escape character '!'
-                if match[0] == '!':
-                    return escape(match[1:])
-                if itype in self.wikiparser.external_handlers:
-                    external_handler = self.wikiparser.external_handlers[itype]
-                    return external_handler(self, match, fullmatch)
-                else:
-                    internal_handler = getattr(self, '_%s_formatter' % itype)
-                    return internal_handler(match, fullmatch)
+        index = fullmatch.lastindex
+        match = fullmatch.group(index)
+        if match:
+            # Check for preceding escape character '!'
+            if match[0] == '!':
+                return escape(match[1:])
+            handler = self._match_handlers.get(index)
+            if handler is None:
+                handler = self._match_handlers[index] = \
+                    self._get_match_handler(index)
+            return handler(match, fullmatch)
+
+    def _get_match_handler(self, index):
+        itype = self.wikiparser.rule_groups[index]
+        external_handler = self.wikiparser.external_handlers.get(itype)
+        if external_handler:
+            return partial(external_handler, self)
+        return getattr(self, '_%s_formatter' % itype)
 
     def replace(self, fullmatch):
         """Replace one match with its corresponding expansion"""
@@ -1270,12 +1259,35 @@ class Formatter(object):
         if replacement:
             return _markup_to_unicode(replacement)
 
-    _normalize_re = re.compile(r'[\v\f]', re.UNICODE)
+    def replace_spans(self, text, spans):
+        """Replace the matches found by `WikiParser.tokenize` in `text`
+        with their corresponding expansion.
+        """
+        if not spans:
+            return text
+        match = self.wikiparser.rules.match
+        buf = []
+        pos = 0
+        for start, end in spans:
+            buf.append(text[pos:start])
+            replacement = self.replace(match(text, start))
+            if replacement:
+                buf.append(replacement)
+            pos = end
+        buf.append(text[pos:])
+        return u''.join(buf)
+
+    _normalize_re = WikiParser._normalize_re
 
     def reset(self, source, out=None):
-        if isinstance(source, basestring):
-            source = re.sub(self._normalize_re, ' ', source)
-        self.source = source
+        if isinstance(source, WikiDocument):
+            self.wikidom = source
+            self.source = source.source
+        else:
+            if isinstance(source, basestring):
+                source = re.sub(self._normalize_re, ' ', source)
+            self.wikidom = None
+            self.source = source
         class NullOut(object):
             def write(self, data):
                 pass
@@ -1284,9 +1296,7 @@ class Formatter(object):
         self._list_stack = []
         self._quote_stack = []
         self._tabstops = []
-        self._quote_buffer = []
 
-        self.in_code_block = 0
         self.in_table = 0
         self.in_def_list = 0
         self.in_table_row = 0
@@ -1297,95 +1307,184 @@ class Formatter(object):
         return source
 
     def format(self, text, out=None, escape_newlines=False):
-        text = self.reset(text, out)
-        if isinstance(text, basestring):
-            text = text.splitlines()
-
-        for line in text:
-            if isinstance(line, str):
-                line = line.decode('utf-8')
-            # Detect start of code block (new block or embedded block)
-            block_start_match = None
-            if WikiParser.ENDBLOCK not in line:
-                block_start_match = WikiParser._startblock_re.match(line)
-            # Handle content or end of code block
-            if self.in_code_block:
-                self.handle_code_block(line, block_start_match)
-                continue
-            # Handle citation quotes '> ...'
-            if line.strip().startswith('>'):
-                self.handle_quote_block(line)
-                continue
-            # Handle end of citation quotes
-            self.close_quote_block(escape_newlines)
-            # Handle start of a new block
-            if block_start_match:
-                self.handle_code_block(line, block_start_match)
-                continue
-            # Handle Horizontal ruler
-            if line[0:4] == '----':
-                self.close_table()
-                self.close_paragraph()
-                self.close_indentation()
-                self.close_list()
-                self.close_def_list()
-                self.out.write(u'<hr />\n')
-                continue
-            # Handle new paragraph
-            if line == '':
-                self.close_table()
-                self.close_paragraph()
-                self.close_indentation()
-                self.close_list()
-                self.close_def_list()
-                continue
+        for _ in self.iter_format(text, out, escape_newlines):
+            pass
+
+    def iter_format(self, text, out=None, escape_newlines=False):
+        """Format `text` like `format`, yielding each time a top-level
+        block of the document has been written to `out`.
+        """
+        if not isinstance(text, WikiDocument):
+            text = self.wikiparser.parse(text)
+        wikidom = self.reset(text, out)
+
+        if self.block_cache is None:
+            for block in wikidom.blocks:
+                self._format_block(block, escape_newlines)
+                yield
+        else:
+            for segment in self._split_segments(wikidom.blocks):
+                for _ in self._format_segment(segment, escape_newlines):
+                    yield
 
-            # Tab expansion and clear tabstops if no indent
-            line = line.replace('\t', ' '*8)
-            if not line.startswith(' '):
-                self._tabstops = []
-
-            # Handle end of indentation
-            if not line.startswith(' ') and self._quote_stack:
-                self.close_indentation()
-
-            self.in_list_item = False
-            self.in_quote = False
-            # Throw a bunch of regexps on the problem
-            self.line = line
-            result = re.sub(self.wikiparser.rules, self.replace, line)
-
-            if not self.in_list_item:
-                self.close_list()
-
-            if not self.in_quote:
-                self.close_indentation()
-
-            if self.in_def_list and not line.startswith(' '):
-                self.close_def_list()
-
-            if self.in_table and not self.continue_table:
-                self.close_table()
-            self.continue_table = 0
-
-            sep = '\n'
-            if not(self.in_list_item or self.in_def_list or self.in_table):
-                if len(result):
-                    self.open_paragraph()
-                if escape_newlines and self.paragraph_open and \
-                       not result.rstrip().endswith('<br />'):
-                    sep = '<br />' + sep
-            self.out.write(result + sep)
-            self.close_table_row()
-
-        self.close_code_blocks()
-        self.close_quote_block(escape_newlines)
         self.close_table()
         self.close_paragraph()
         self.close_indentation()
         self.close_list()
         self.close_def_list()
 
+    def _format_block(self, block, escape_newlines):
+        kind = block[0]
+        if kind == BLOCK_LINE:
+            self.format_line(block[1], block[2], escape_newlines)
+        elif kind == BLOCK_QUOTE:
+            self.handle_quote_block(block[1], block[2], escape_newlines)
+        elif kind == BLOCK_CODE:
+            self.handle_code_block(*block[1:])
+        else:
+            self.close_table()
+            self.close_paragraph()
+            self.close_indentation()
+            self.close_list()
+            self.close_def_list()
+            if kind == BLOCK_HR:
+                self.out.write(u'<hr />\n')
+
+    # -- Block cache
+    #
+    # Blank lines and horizontal rules close all the open elements, so the
+    # rendering of the blocks up to such a separator only depends on these
+    # blocks, on the current tab stops and on the anchors already used
+    # for the headings. When `block_cache` is set, the rendering of each
+    # such segment which doesn't call a macro is stored in it, and reused
+    # when the same segment is found again in the same conditions.
+    #
+    # The `block_cache` must provide `get(key)` and `set(key, value,
+    # size)` methods, like `trac.wiki.api.LRUCache`.
+    #
+    # The segments linking to other realms are not cached either (see
+    # `WikiParser.is_static`), and the keys contain the permissions of
+    # the user, as the rendering of the wiki links depends on them.
+
+    @staticmethod
+    def _split_segments(blocks):
+        segment = []
+        for block in blocks:
+            segment.append(block)
+            if block[0] in (BLOCK_BLANK, BLOCK_HR):
+                yield segment
+                segment = []
+        if segment:
+            yield segment
+
+    def _segment_key(self, segment, escape_newlines):
+        digest = sha1()
+        for block in segment:
+            digest.update(repr(tuple(item.source
+                                     if isinstance(item, WikiDocument)
+                                     else item for item in block)))
+        tabstops = tuple(self._tabstops)
+        first = segment[0]
+        if first[0] == BLOCK_LINE and not first[1].startswith(' '):
+            tabstops = ()  # cleared by `format_line`
+        resource = self.resource
+        resources = []
+        while resource:
+            resources.append((resource.realm, resource.id))
+            resource = resource.parent
+        return ('block', self.__class__.__name__, digest.hexdigest(),
+                tabstops, escape_newlines,
+                self.perm.username if self.perm else None,
+                self._permissions_key,
+                str(self.req.locale) if self.req else None,
+                self.href.base if self.href else None,
+                self.context.get_hint('absurls', False), tuple(resources))
+
+    @lazy
+    def _permissions_key(self):
+        return _permissions_key(self.env, self.perm.username
+                                          if self.perm else None)
+
+    def _format_segment(self, segment, escape_newlines):
+        key = None
+        if segment[-1][0] in (BLOCK_BLANK, BLOCK_HR) and \
+                self.wikiparser.is_static(segment):
+            key = self._segment_key(segment, escape_newlines)
+            cached = self.block_cache.get(key)
+            if cached is not None:
+                html, tabstops, existing, added = cached
+                if all(anchor in self._anchors for anchor in existing) and \
+                        not any(anchor in self._anchors for anchor in added):
+                    self.out.write(html)
+                    self._tabstops = list(tabstops)
+                    self._anchors.update((anchor, True) for anchor in added)
+                    yield
+                    return
+        if key is None:
+            for block in segment:
+                self._format_block(block, escape_newlines)
+                yield
+            return
+
+        out = self.out
+        self.out = buf = io.StringIO()
+        self._anchor_probes = probes = {}
+        try:
+            for block in segment:
+                self._format_block(block, escape_newlines)
+        finally:
+            self.out = out
+            self._anchor_probes = None
+        html = buf.getvalue()
+        out.write(html)
+        existing = tuple(anchor for anchor, exists in probes.iteritems()
+                         if exists)
+        added = tuple(anchor for anchor, exists in probes.iteritems()
+                      if not exists)
+        self.block_cache.set(key, (html, tuple(self._tabstops), existing,
+                                   added), len(html))
+        yield
+
+    def format_line(self, line, spans, escape_newlines=False):
+        """Render a line of text, `spans` being the position of the wiki
+        markup in that line.
+        """
+        # Clear tabstops if no indent
+        if not line.startswith(' '):
+            self._tabstops = []
+
+        # Handle end of indentation
+        if not line.startswith(' ') and self._quote_stack:
+            self.close_indentation()
+
+        self.in_list_item = False
+        self.in_quote = False
+        self.line = line
+        result = self.replace_spans(line, spans)
+
+        if not self.in_list_item:
+            self.close_list()
+
+        if not self.in_quote:
+            self.close_indentation()
+
+        if self.in_def_list and not line.startswith(' '):
+            self.close_def_list()
+
+        if self.in_table and not self.continue_table:
+            self.close_table()
+        self.continue_table = 0
+
+        sep = '\n'
+        if not(self.in_list_item or self.in_def_list or self.in_table):
+            if len(result):
+                self.open_paragraph()
+            if escape_newlines and self.paragraph_open and \
+                   not result.rstrip().endswith('<br />'):
+                sep = '<br />' + sep
+        self.out.write(result + sep)
+        self.close_table_row()
+
 
 class OneLinerFormatter(Formatter):
     """
@@ -1430,34 +1529,19 @@ class OneLinerFormatter(Formatter):
         text = self.reset(text, out)
 
         # Simplify code blocks
-        in_code_block = 0
-        processor = None
-        buf = io.StringIO()
-        for line in text.strip().splitlines():
-            if isinstance(line, str):
-                line = line.decode('utf-8')
-            if WikiParser.ENDBLOCK not in line and \
-                   WikiParser._startblock_re.match(line):
-                in_code_block += 1
-            elif line.strip() == WikiParser.ENDBLOCK:
-                if in_code_block:
-                    in_code_block -= 1
-                    if in_code_block == 0:
-                        if processor != 'comment':
-                            buf.write(u' [...]\n')
-                        processor = None
-            elif in_code_block:
-                if not processor:
-                    if line.startswith('#!'):
-                        processor = line[2:].strip()
-            else:
-                buf.write(line + '\n')
-        result = buf.getvalue()[:-len('\n')]
+        if isinstance(text, WikiDocument):
+            result, spans, unterminated = self.wikiparser.get_inline(text)
+        else:
+            result, unterminated = WikiParser.collapse_code_blocks(text)
+            spans = None
 
         if shorten:
             result = shorten_line(result)
+            spans = None
 
-        result = re.sub(self.wikiparser.rules, self.replace, result)
+        if spans is None:
+            spans = self.wikiparser.tokenize(result)
+        result = self.replace_spans(result, spans)
         result = result.replace('[...]', u'[\u2026]')
         if result.endswith('...'):
             result = result[:-3] + u'\u2026'
@@ -1466,7 +1550,7 @@ class OneLinerFormatter(Formatter):
         # Close all open 'one line'-tags
         self.flush_tags()
         # Flush unterminated code blocks
-        if in_code_block > 0:
+        if unterminated:
             self.out.write(u'[\u2026]')
 
 
@@ -1484,12 +1568,8 @@ class OutlineFormatter(Formatter):
             return Formatter._macro_formatter(self, match, fullmatch, macro)
         return ''
 
-    def handle_code_block(self, line, startmatch=None):
-        if WikiParser.ENDBLOCK not in line and \
-               WikiParser._startblock_re.match(line):
-            self.in_code_block += 1
-        elif line.strip() == WikiParser.ENDBLOCK:
-            self.in_code_block -= 1
+    def handle_code_block(self, name, args, text):
+        pass
 
     def format(self, text, out, max_depth=6, min_depth=1, shorten=True):
         self.shorten = shorten
@@ -1544,6 +1624,8 @@ class LinkFormatter(OutlineFormatter):
 
     def match(self, wikitext):
         """Return the Wiki match found at the beginning of the `wikitext`"""
+        if isinstance(wikitext, WikiDocument):
+            wikitext = wikitext.source
         wikitext = self.reset(wikitext)
         self.line = wikitext
         match = re.match(self.wikiparser.rules, wikitext)
@@ -1551,6 +1633,106 @@ class LinkFormatter(OutlineFormatter):
             return self.handle_match(match)
 
 
+# The elements of the `html` processor whose content isn't text
+_plaintext_skip_re = re.compile(r'<(script|style)\b.*?(?:</\1\s*>|$)',
+                                re.I | re.S)
+
+
+class PlainTextFormatter(Formatter):
+    """Special formatter that strips the wiki markup, producing HTML from
+    which `format_to_plaintext` extracts the text.
+
+    It has no side effects, so that it can be used without a request:
+    the macros and the processors other than the wiki containers are not
+    executed, and the links are replaced by their label without being
+    resolved.
+    """
+    flavor = 'plaintext'
+
+    # Processors whose content is wiki text
+    _wiki_processors = ('div', 'rtl', 'span', 'Span', 'td', 'th', 'tr',
+                        'table')
+
+    def _get_match_handler(self, index):
+        itype = self.wikiparser.rule_groups[index]
+        if itype in self.wikiparser.external_handlers:
+            return lambda match, fullmatch: escape(match, False)
+        return getattr(self, '_%s_formatter' % itype)
+
+    def _format_inline(self, text):
+        out = io.StringIO()
+        PlainTextFormatter(self.env, self.context).format(text, out)
+        return out.getvalue()
+
+    def _email_formatter(self, match, fullmatch):
+        return escape(match, False)
+
+    def _make_lhref_link(self, match, fullmatch, rel, ns, target, label):
+        if label:
+            label = unquote_label(label)
+        elif rel:
+            label = self.wiki.make_label_from_target(rel)
+        elif target:
+            if ns and target.startswith('//'):
+                label = ns + ':' + target
+            else:
+                label = target.lstrip('/')
+        else:
+            label = ns
+        return escape(label, False)
+
+    def _make_link(self, ns, target, match, label, fullmatch):
+        return escape(label, False)
+
+    def _anchor_formatter(self, match, fullmatch):
+        return self._format_inline(fullmatch.group('anchorlabel') or '')
+
+    def _macro_formatter(self, match, fullmatch, macro, only_inline=False):
+        name = fullmatch.group('macroname')
+        return ' ' if name.lower() == 'br' else ''
+
+    def _heading_formatter(self, match, fullmatch):
+        self.close_table()
+        self.close_paragraph()
+        self.close_indentation()
+        self.close_list()
+        self.close_def_list()
+        hdepth = fullmatch.group('hdepth')
+        htext = fullmatch.group('htext').strip()
+        if htext.endswith(hdepth):
+            htext = htext[:-len(hdepth)]
+        self.out.write(u'<h%d>%s</h%d>\n' % (len(hdepth),
+                                             self._format_inline(htext),
+                                             len(hdepth)))
+
+    def _definition_formatter(self, match, fullmatch):
+        if self.in_def_list:
+            tmp = '</dd>'
+        else:
+            self.close_paragraph()
+            tmp = '<dl>'
+        definition = match[:match.find('::')]
+        self.in_def_list = True
+        return tmp + '<dt>%s</dt><dd>' % self._format_inline(definition)
+
+    def handle_code_block(self, name, args, text):
+        if name not in ('th', 'td', 'tr'):
+            self.close_table()
+        self.close_paragraph()
+        if name in self._wiki_processors:
+            PlainTextFormatter(self.env, self.context).format(text, self.out)
+        elif name == 'html':
+            self.out.write(_plaintext_skip_re.sub(u'', text) + u'\n')
+        elif name not in ('comment', 'htmlcomment'):
+            self.out.write(escape(text, False) + u'\n')
+
+    def handle_quote_block(self, depth, wikidom, escape_newlines):
+        self.close_paragraph()
+        if depth < self._get_list_depth():
+            self.close_list(depth)
+        PlainTextFormatter(self.env, self.context).format(wikidom, self.out)
+
+
 # Pure Wiki Formatter
 
 class HtmlFormatter(object):
@@ -1558,24 +1740,51 @@ class HtmlFormatter(object):
 
     flavor = 'default'
 
-    def __init__(self, env, context, wikidom):
+    def __init__(self, env, context, wikidom, block_cache=None):
+        """
+        :param block_cache: optional cache for the rendering of the
+                            top-level blocks which don't call macros, see
+                            `Formatter.block_cache`.
+        """
         self.env = env
         self.context = context
         if isinstance(wikidom, basestring):
             wikidom = WikiParser(env).parse(wikidom)
         self.wikidom = wikidom
+        self.block_cache = block_cache
+
+    def _formatter(self, escape_newlines):
+        formatter = Formatter(self.env, self.context)
+        formatter.block_cache = self.block_cache
+        return formatter
 
     def generate(self, escape_newlines=False):
         """Generate HTML elements.
 
         newlines in the wikidom will be preserved if `escape_newlines` is set.
         """
-        # FIXME: compatibility code only for now
         out = io.StringIO()
-        Formatter(self.env, self.context).format(self.wikidom, out,
-                                                 escape_newlines)
+        self._formatter(escape_newlines).format(self.wikidom, out,
+                                                escape_newlines)
         return Markup(out.getvalue())
 
+    def generate_chunks(self, escape_newlines=False, chunk_size=1024):
+        """Generate HTML elements as a sequence of `Markup` chunks.
+
+        The chunks are produced while the wikidom is being formatted, each
+        time at least `chunk_size` characters have been output, so the
+        beginning of a large page can be sent before its end is rendered.
+        Note that the chunks are not necessarily well-formed fragments.
+        """
+        out = io.StringIO()
+        formatter = self._formatter(escape_newlines)
+        for _ in formatter.iter_format(self.wikidom, out, escape_newlines):
+            if out.tell() >= chunk_size:
+                yield Markup(out.getvalue())
+                out.seek(0)
+                out.truncate()
+        yield Markup(out.getvalue())
+
 
 class InlineHtmlFormatter(object):
     """Format parsed wiki text to inline elements HTML.
@@ -1588,8 +1797,8 @@ class InlineHtmlFormatter(object):
     def __init__(self, env, context, wikidom):
         self.env = env
         self.context = context
-        if isinstance(wikidom, basestring):
-            wikidom = WikiParser(env).parse(wikidom)
+        # Only the inline projection of the wikidom is needed, so plain
+        # text is formatted directly.
         self.wikidom = wikidom
 
     def generate(self, shorten=False):
@@ -1598,7 +1807,6 @@ class InlineHtmlFormatter(object):
         If `shorten` is set, the generation will stop once enough characters
         have been emitted.
         """
-        # FIXME: compatibility code only for now
         out = io.StringIO()
         OneLinerFormatter(self.env, self.context).format(self.wikidom, out,
                                                          shorten)
@@ -1613,12 +1821,14 @@ def format_to(env, flavor, context, wikidom, **options):
     else:
         return format_to_html(env, context, wikidom, **options)
 
-def format_to_html(env, context, wikidom, escape_newlines=None):
+def format_to_html(env, context, wikidom, escape_newlines=None,
+                   block_cache=None):
     if not wikidom:
         return Markup()
     if escape_newlines is None:
         escape_newlines = context.get_hint('preserve_newlines', False)
-    return HtmlFormatter(env, context, wikidom).generate(escape_newlines)
+    return HtmlFormatter(env, context, wikidom, block_cache) \
+           .generate(escape_newlines)
 
 def format_to_oneliner(env, context, wikidom, shorten=None):
     if not wikidom:
@@ -1627,12 +1837,67 @@ def format_to_oneliner(env, context, wikidom, shorten=None):
         shorten = context.get_hint('shorten_lines', False)
     return InlineHtmlFormatter(env, context, wikidom).generate(shorten)
 
+def format_many(env, context, fragments, flavor=None, **options):
+    """Format each of the wiki `fragments` in `context` like `format_to`,
+    returning the list of the results in order.
+
+    A single formatter is used for all the fragments, so that its setup,
+    its resolution of the links and the permission checks are shared.
+    """
+    if flavor is None:
+        flavor = context.get_hint('wiki_flavor', 'html')
+    if flavor == 'oneliner':
+        shorten = options.get('shorten')
+        if shorten is None:
+            shorten = context.get_hint('shorten_lines', False)
+        formatter = OneLinerFormatter(env, context)
+        def format(wikidom, out):
+            formatter.format(wikidom, out, shorten)
+    else:
+        escape_newlines = options.get('escape_newlines')
+        if escape_newlines is None:
+            escape_newlines = context.get_hint('preserve_newlines', False)
+        formatter = Formatter(env, context)
+        def format(wikidom, out):
+            # The anchors are unique within each fragment
+            formatter._anchors = {}
+            formatter.format(wikidom, out, escape_newlines)
+    results = []
+    for wikidom in fragments:
+        out = io.StringIO()
+        if wikidom:
+            format(wikidom, out)
+        results.append(Markup(out.getvalue()))
+    return results
+
 def extract_link(env, context, wikidom):
     if not wikidom:
         return Markup()
     return LinkFormatter(env, context).match(wikidom)
 
 
+_plaintext_break_re = re.compile(
+    r'<(?:(t[dh]|br)|/?(?:blockquote|d[dlt]|div|h[1-6]|hr|li|[ou]l|p|pre|'
+    r'table|tr))\b', re.I)
+
+def format_to_plaintext(env, context, wikidom):
+    """Return the text of `wikidom` without the wiki markup, as a unicode
+    string with one line for each paragraph, list item or table row.
+    """
+    if not wikidom:
+        return u''
+    out = io.StringIO()
+    PlainTextFormatter(env, context).format(wikidom, out)
+    # Mark the line breaks before the block elements, as `plaintext`
+    # collapses all the whitespace
+    html = _plaintext_break_re.sub(
+        lambda m: (u' ' if m.group(1) else u'\0') + m.group(0),
+        out.getvalue().replace(u'\0', u''))
+    lines = (plaintext(chunk, keeplinebreaks=False).strip()
+             for chunk in html.split(u'\0'))
+    return u'\n'.join(line for line in lines if line)
+
+
 # pre-0.11 wiki text to Markup compatibility methods
 
 def wiki_to_outline(wikitext, env, db=None,
@@ -36,8 +36,8 @@ from trac.util.translation import _, dgettext, cleandoc_, tag_
 from trac.web.chrome import chrome_resource_path
 from trac.wiki.api import IWikiMacroProvider, WikiSystem, parse_args
 from trac.wiki.formatter import (
-    MacroError, OutlineFormatter, ProcessorError, extract_link, format_to_html,
-    format_to_oneliner, system_message
+    MacroError, OutlineFormatter, ProcessorError, extract_link, format_many,
+    format_to_html, format_to_oneliner, system_message
 )  # ProcessorError unused, but imported for plugin use.
 from trac.wiki.interwiki import InterWikiMap
 
@@ -343,14 +343,21 @@ class RecentChangesMacro(WikiMacroBase):
         limit = _arg_as_int(args[1].strip(), min=1) if len(args) > 1 else None
         group = kw.get('group', 'date')
 
-        sql = """SELECT name, max(version) AS max_version,
-                        max(time) AS max_time FROM wiki"""
+        latest = WikiSystem(self.env).has_latest_table
+        if latest:
+            sql = "SELECT name, version, time FROM wiki_latest"
+        else:
+            sql = """SELECT name, max(version) AS max_version,
+                            max(time) AS max_time FROM wiki"""
         args = []
         if prefix:
             with self.env.db_query as db:
                 sql += " WHERE name %s" % db.prefix_match()
                 args.append(db.prefix_match_value(prefix))
-        sql += " GROUP BY name ORDER BY max_time DESC"
+        if latest:
+            sql += " ORDER BY time DESC"
+        else:
+            sql += " GROUP BY name ORDER BY max_time DESC"
         if limit:
             sql += " LIMIT %s"
             args.append(limit)
@@ -441,12 +448,11 @@ class PageOutlineMacro(WikiMacroBase):
                         elif arg == 'unnumbered':
                             numbered = False
 
-        # TODO: - integrate the rest of the OutlineFormatter directly here
-        #       - use formatter.wikidom instead of formatter.source
+        # TODO: integrate the rest of the OutlineFormatter directly here
         out = io.StringIO()
         oformatter = OutlineFormatter(self.env, formatter.context)
-        oformatter.format(formatter.source, out, max_depth, min_depth,
-                          shorten=not inline)
+        oformatter.format(formatter.wikidom or formatter.source, out,
+                          max_depth, min_depth, shorten=not inline)
         outline = Markup(out.getvalue())
 
         if title:
@@ -835,6 +841,16 @@ class TracIniMacro(WikiMacroBase):
                               if section in section_registry else '')
                     for section in sorted(options)]
 
+        # Format all the documentation texts at once
+        texts = []
+        for section, section_doc in sections:
+            texts.append(((section, None), section_doc))
+            texts.extend(((section, option.name), option.doc)
+                         for option in options.get(section) or ())
+        docs = dict(zip((key for key, text in texts),
+                        format_many(self.env, formatter.context,
+                                    [text for key, text in texts], 'html')))
+
         def default_cell(option):
             default = option.default
             if default is not None and default != '':
@@ -852,8 +868,7 @@ class TracIniMacro(WikiMacroBase):
                                          class_='tracini-option',
                                          href='#%s-%s-option' %
                                               (section, option.name))),
-                            tag.td(format_to_html(self.env, formatter.context,
-                                                  option.doc)),
+                            tag.td(docs[section, option.name]),
                             default_cell(option),
                             id='%s-%s-option' % (section, option.name),
                             class_='odd' if idx % 2 else 'even')
@@ -861,7 +876,7 @@ class TracIniMacro(WikiMacroBase):
 
         return tag.div(class_='tracini')(
             (tag.h3(tag.code('[%s]' % section), id='%s-section' % section),
-             format_to_html(self.env, formatter.context, section_doc),
+             docs[section, None],
              options_table(section, options.get(section)))
             for section, section_doc in sections)
 
@@ -32,15 +32,19 @@ class WikiPage(object):
     def resource(self):
         return Resource(self.realm, self.name, self._resource_version)
 
-    def __init__(self, env, name=None, version=None):
+    def __init__(self, env, name=None, version=None, fetch_text=True):
         """Create a new page object or retrieves an existing page.
 
         :param env: an `Environment` object.
         :param name: the page name or a `Resource` object.
         :param version: the page version. The value takes precedence over the
                         `Resource` version when both are specified.
+        :param fetch_text: if `False`, the `text` of an existing page is
+                           only retrieved when it is first accessed.
         """
         self.env = env
+        self._fetch_text = fetch_text
+        self._pending_text = None
         if version:
             try:
                 version = int(version)
@@ -71,33 +75,84 @@ class WikiPage(object):
             self.text = self.comment = self.author = ''
             self.time = None
             self.readonly = 0
-        self.old_text = self.text
+        if not self._pending_text:
+            self.old_text = self.text
         self.old_readonly = self.readonly
 
     def _fetch(self, name, version=None):
         if version is not None:
-            sql = """SELECT version, time, author, text, comment, readonly
-                     FROM wiki WHERE name=%s AND version=%s"""
-            args = (name, int(version))
-        else:
-            sql = """SELECT version, time, author, text, comment, readonly
-                     FROM wiki WHERE name=%s ORDER BY version DESC LIMIT 1"""
-            args = (name,)
-        for version, time, author, text, comment, readonly in \
-                self.env.db_query(sql, args):
+            version = int(version)
+        row = self._fetch_row(name, version, self._fetch_text)
+        self._pending_text = None
+        if row:
+            version, time, author, text, comment, readonly = row
             self.version = int(version)
             self.author = author
             self.time = from_utimestamp(time)
-            self.text = text
+            if self._fetch_text:
+                self.text = text
+            else:
+                # Fetched along with `old_text` on first access
+                self._pending_text = (name, self.version)
             self.comment = comment
             self.readonly = int(readonly) if readonly else 0
-            break
         else:
             self.version = 0
             self.text = self.comment = self.author = ''
             self.time = None
             self.readonly = 0
 
+    def _fetch_row(self, name, version, with_text):
+        def fetch():
+            text = 'text' if with_text else 'NULL'
+            if version is not None:
+                sql = """SELECT version, time, author, %s, comment, readonly
+                         FROM wiki WHERE name=%%s AND version=%%s""" % text
+                args = (name, version)
+            else:
+                sql = """SELECT version, time, author, %s, comment, readonly
+                         FROM wiki WHERE name=%%s
+                         ORDER BY version DESC LIMIT 1""" % text
+                args = (name,)
+            for row in self.env.db_query(sql, args):
+                if with_text:
+                    text = WikiSystem(self.env).expand_text(name, row[0],
+                                                            row[1], row[3])
+                    row = row[:3] + (text,) + row[4:]
+                return row
+        return WikiSystem(self.env).get_page_row(name, version, with_text,
+                                                 fetch)
+
+    @property
+    def text(self):
+        if self._pending_text:
+            self._load_text()
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        if self._pending_text:
+            self._load_text()
+        self._text = text
+
+    @property
+    def old_text(self):
+        if self._pending_text:
+            self._load_text()
+        return self._old_text
+
+    @old_text.setter
+    def old_text(self, text):
+        if self._pending_text:
+            self._load_text()
+        self._old_text = text
+
+    def _load_text(self):
+        name, version = self._pending_text
+        self._pending_text = None
+        row = self._fetch_row(name, version, True)
+        self._text = self._old_text = row[3] if row else ''
+
     def __repr__(self):
         if self.name is None:
             name = self.name
@@ -116,24 +171,35 @@ class WikiPage(object):
         with self.env.db_transaction as db:
             if version is None:
                 # Delete a wiki page completely
+                WikiSystem(self.env).release_page_texts(self.name)
                 db("DELETE FROM wiki WHERE name=%s", (self.name,))
                 self.env.log.info("Deleted page %s", self.name)
             else:
                 # Delete only a specific page version
+                WikiSystem(self.env).uncompress_previous_version(self.name,
+                                                                 version)
+                WikiSystem(self.env).release_page_texts(self.name, version)
                 db("DELETE FROM wiki WHERE name=%s and version=%s",
                    (self.name, version))
                 self.env.log.info("Deleted version %d of page %s", version,
                                   self.name)
+            WikiSystem(self.env).update_latest([self.name])
+            # The latest version is fetched again below
+            WikiSystem(self.env).discard_page_rows(self.name)
 
             if version is None or version == self.version:
+                readonly = self.readonly
                 self._fetch(self.name, None)
+                if self.readonly != readonly:
+                    del WikiSystem(self.env).readonly_pages
 
             if not self.exists:
-                # Invalidate page name cache
-                del WikiSystem(self.env).pages
+                # Update page name cache
+                WikiSystem(self.env).update_pages(removed=[self.name])
                 # Delete orphaned attachments
                 from trac.attachment import Attachment
                 Attachment.delete_all(self.env, self.realm, self.name)
+        WikiSystem(self.env).discard_page_rows(self.name)
 
         # Let change listeners know about the deletion
         if not self.exists:
@@ -157,18 +223,32 @@ class WikiPage(object):
 
         with self.env.db_transaction as db:
             if new_text:
+                # The text goes to the wiki_text table when it's installed
+                text = None if WikiSystem(self.env).has_text_table \
+                       else self.text
                 db("""INSERT INTO wiki (name, version, time, author,
                                         text, comment, readonly)
                       VALUES (%s,%s,%s,%s,%s,%s,%s)
                       """, (self.name, self.version + 1, to_utimestamp(t),
-                            author, self.text, comment, self.readonly))
+                            author, text, comment, self.readonly))
                 self.version += 1
+                WikiSystem(self.env).store_page_text(self.name, self.version,
+                                                     self.text)
+                if self.version > 1:
+                    WikiSystem(self.env).archive_version(self.name,
+                                                         self.version - 1,
+                                                         self.version,
+                                                         self.text)
             else:
                 db("UPDATE wiki SET readonly=%s WHERE name=%s",
                    (self.readonly, self.name))
+            WikiSystem(self.env).update_latest([self.name])
             if self.version == 1:
-                # Invalidate page name cache
-                del WikiSystem(self.env).pages
+                # Update page name cache
+                WikiSystem(self.env).update_pages(added=[self.name])
+            if self.readonly != self.old_readonly:
+                del WikiSystem(self.env).readonly_pages
+        WikiSystem(self.env).discard_page_rows(self.name)
 
         self.author = author
         self.comment = comment
@@ -199,18 +279,27 @@ class WikiPage(object):
         old_name = self.name
 
         with self.env.db_transaction as db:
-            new_page = WikiPage(self.env, new_name)
+            new_page = WikiPage(self.env, new_name, fetch_text=False)
             if new_page.exists:
                 raise TracError(_("Can't rename to existing %(name)s page.",
                                   name=new_name))
 
             db("UPDATE wiki SET name=%s WHERE name=%s", (new_name, old_name))
-            # Invalidate page name cache
-            del WikiSystem(self.env).pages
+            if WikiSystem(self.env).has_text_table:
+                db("UPDATE wiki_storage SET name=%s WHERE name=%s",
+                   (new_name, old_name))
+            WikiSystem(self.env).update_latest([old_name, new_name])
+            if self.readonly:
+                del WikiSystem(self.env).readonly_pages
+            # Update page name cache
+            WikiSystem(self.env).update_pages(added=[new_name],
+                                              removed=[old_name])
             # Reparent attachments
             from trac.attachment import Attachment
             Attachment.reparent_all(self.env, self.realm, old_name,
                                     self.realm, new_name)
+        WikiSystem(self.env).discard_page_rows(old_name)
+        WikiSystem(self.env).discard_page_rows(new_name)
 
         self.name = new_name
         self.env.log.info("Renamed page %s to %s", old_name, new_name)
@@ -229,6 +318,7 @@ class WikiPage(object):
         with self.env.db_transaction as db:
             db("UPDATE wiki SET comment=%s WHERE name=%s AND version=%s",
                (new_comment, self.name, self.version))
+        WikiSystem(self.env).discard_page_rows(self.name)
 
         self.comment = new_comment
         self.env.log.info("Changed comment on page %s version %s to %s",
@@ -238,14 +328,48 @@ class WikiPage(object):
             if hasattr(listener, 'wiki_page_comment_modified'):
                 listener.wiki_page_comment_modified(self, old_comment)
 
-    def get_history(self):
+    def get_history(self, before=None, limit=None):
         """Retrieve the edit history of a wiki page.
 
+        :param before: if given, only the versions older than `before` are
+                       retrieved, instead of the version of the page and
+                       the older ones.
+        :param limit: if given, the maximum number of versions retrieved.
         :return: a tuple containing the `version`, `datetime`, `author`
                  and `comment`.
         """
-        for version, ts, author, comment in self.env.db_query("""
-                SELECT version, time, author, comment FROM wiki
-                WHERE name=%s AND version<=%s ORDER BY version DESC
-                """, (self.name, self.version)):
+        if before is None:
+            sql = """SELECT version, time, author, comment FROM wiki
+                     WHERE name=%s AND version<=%s ORDER BY version DESC"""
+            args = [self.name, self.version]
+        else:
+            sql = """SELECT version, time, author, comment FROM wiki
+                     WHERE name=%s AND version<%s ORDER BY version DESC"""
+            args = [self.name, before]
+        if limit:
+            sql += " LIMIT %s"
+            args.append(limit)
+        for version, ts, author, comment in self.env.db_query(sql, args):
             yield version, from_utimestamp(ts), author, comment
+
+    def previous_version(self, version=None):
+        """Return the version preceding `version`, or the version of the
+        page if `None`, or `None` if there's no such version.
+        """
+        if version is None:
+            version = self.version
+        for prev, in self.env.db_query("""
+                SELECT max(version) FROM wiki WHERE name=%s AND version<%s
+                """, (self.name, version)):
+            return prev
+
+    def next_version(self, version=None):
+        """Return the version following `version`, or the version of the
+        page if `None`, or `None` if there's no such version.
+        """
+        if version is None:
+            version = self.version
+        for next_, in self.env.db_query("""
+                SELECT min(version) FROM wiki WHERE name=%s AND version>%s
+                """, (self.name, version)):
+            return next_
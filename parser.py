@@ -19,9 +19,12 @@
 #         Christian Boos <cboos@edgewall.org>
 
 import re
+import sre_constants
+import sre_parse
 
 from trac.core import *
 from trac.notification import EMAIL_LOOKALIKE_PATTERN
+from trac.util.text import to_unicode
 
 
 class WikiParser(Component):
@@ -169,9 +172,12 @@ class WikiParser(Component):
 
     def __init__(self):
         self._compiled_rules = None
+        self._markup_re = None
         self._link_resolvers = None
         self._helper_patterns = None
         self._external_handlers = None
+        self._wiki_rules = None
+        self._rule_groups = None
 
     @property
     def rules(self):
@@ -188,16 +194,30 @@ class WikiParser(Component):
         self._prepare_rules()
         return self._external_handlers
 
+    @property
+    def rule_groups(self):
+        """Map the index of the outer group of each rule to its name.
+
+        As the outer group of a rule is the last one to be closed, the
+        rule to which a match of `rules` corresponds is given by its
+        `lastindex`.
+        """
+        self._prepare_rules()
+        return self._rule_groups
+
     def _prepare_rules(self):
         from trac.wiki.api import WikiSystem
         if not self._compiled_rules:
             helpers = []
             handlers = {}
             syntax = self._pre_rules[:]
+            wiki_rules = set()
             i = 0
             for resolver in WikiSystem(self.env).syntax_providers:
                 for regexp, handler in resolver.get_wiki_syntax() or []:
                     handlers['i' + str(i)] = handler
+                    if isinstance(resolver, WikiSystem):
+                        wiki_rules.add('i' + str(i))
                     syntax.append('(?P<i%d>%s)' % (i, regexp))
                     i += 1
             syntax += self._post_rules[:]
@@ -205,10 +225,125 @@ class WikiParser(Component):
             for rule in syntax:
                 helpers += helper_re.findall(rule)[1:]
             rules = re.compile('(?:' + '|'.join(syntax) + ')', re.UNICODE)
+            helpers = frozenset(helpers)
             self._external_handlers = handlers
+            self._wiki_rules = wiki_rules
             self._helper_patterns = helpers
+            self._rule_groups = dict((index, name) for name, index
+                                     in rules.groupindex.iteritems()
+                                     if name not in helpers)
+            self._markup_re = self._prepare_markup_re(syntax)
             self._compiled_rules = rules
 
+    def _prepare_markup_re(self, syntax):
+        """Build the regexp finding whether a line may contain markup.
+
+        Each rule must match at least one of its "trigger" characters,
+        except for the rules anchored at the start of the line, which are
+        simply tried there. The rules whose triggers include letters, like
+        the CamelCase page names, are tried as well, as letters are found
+        in nearly every line. A line in which this regexp finds nothing
+        can't match any of the `rules`. Return `None` when some rule can't
+        be reduced that way, and the lines always have to be scanned.
+        """
+        triggers = set()
+        leading = []
+        for rule in syntax:
+            parsed = _parse_rule(rule)
+            if parsed and _is_anchored(parsed):
+                leading.append('(?:%s)' % rule)
+                continue
+            chars = parsed and _required_chars(parsed)
+            if chars and any(c.isalpha() for c in chars):
+                leading.append('(?:%s)' % rule)
+            elif chars:
+                triggers.update(chars)
+            else:
+                self.log.debug("No markup prefilter, as the wiki syntax "
+                               "rule %r can't be reduced", rule)
+                return None
+        if triggers:
+            leading.append(u'[%s]' % u''.join(re.escape(c)
+                                              for c in sorted(triggers)))
+        return re.compile('|'.join(leading), re.UNICODE)
+
+    # Builtin processors rendering their content without side effects,
+    # and among them the ones rendering it as wiki text
+    _static_processors = ('comment', 'default', 'div', 'html', 'htmlcomment',
+                          'rtl', 'span', 'Span', 'table', 'td', 'th', 'tr')
+    _wiki_processors = ('div', 'rtl', 'span', 'Span', 'table', 'td', 'th',
+                        'tr')
+
+    _macro_call_re = re.compile(r'(?<!!)\[\[(?P<name>[\w/+-]+\??|\?)')
+
+    def is_static(self, blocks):
+        """Whether the rendering of the `WikiDocument` `blocks` only
+        depends on their content and on the existing wiki pages, i.e.
+        whether they don't call any macro nor Mimeview renderer, which
+        may also add stylesheets or scripts to the request, and don't
+        contain links to other realms, like tickets or attachments, whose
+        rendering depends on the state of the linked resources.
+        """
+        from trac.wiki.api import WikiSystem
+        is_macro = WikiSystem(self.env).get_macro_provider
+        for block in blocks:
+            kind = block[0]
+            if kind == BLOCK_LINE:
+                text = block[1]
+                if '[[' in text:
+                    for start, end in block[2]:
+                        for match in self._macro_call_re.finditer(
+                                text, start, end):
+                            name = match.group('name')
+                            if name[-1] == '?' or is_macro(name):
+                                return False
+                if self._links_other_realms(text, block[2]):
+                    return False
+            elif kind == BLOCK_QUOTE:
+                if not self.is_static(block[2].blocks):
+                    return False
+            elif kind == BLOCK_CODE:
+                name, args, text = block[1:]
+                if name not in self._static_processors or \
+                        name == 'default' and args and 'lineno' in args:
+                    return False
+                if name in self._wiki_processors and \
+                        not self.is_static(self.parse(text).blocks):
+                    return False
+        return True
+
+    def _links_other_realms(self, text, spans):
+        """Whether the markup found at `spans` in the line `text` has
+        links handled by the wiki syntax or the link resolvers of other
+        components than `WikiSystem`.
+        """
+        rules = self.rules
+        rule_groups = self._rule_groups
+        resolvers = self.link_resolvers
+        for start, end in spans:
+            if text[start] == '!':
+                continue
+            match = rules.match(text, start)
+            name = rule_groups.get(match.lastindex)
+            if name in self._external_handlers:
+                if name not in self._wiki_rules:
+                    return True
+                continue
+            if name == 'shref':
+                ns = match.group('sns')
+            elif name == 'shrefbr':
+                ns = match.group('snsbr')
+            elif name == 'lhref':
+                ns = match.group('lns')
+            elif name == 'macrolink':
+                link = self._creolelink_re.match(text[start + 2:end - 2])
+                ns = link and link.group('lns')
+            else:
+                continue
+            if ns and ns != 'wiki' and ns in resolvers:
+                return True
+        return False
+
     @property
     def link_resolvers(self):
         if not self._link_resolvers:
@@ -220,10 +355,291 @@ class WikiParser(Component):
             self._link_resolvers = resolvers
         return self._link_resolvers
 
+    _normalize_re = re.compile(r'[\v\f]', re.UNICODE)
+
     def parse(self, wikitext):
-        """Parse `wikitext` and produce a WikiDOM tree."""
-        # obviously still some work to do here ;)
-        return wikitext
+        """Parse `wikitext` and produce a WikiDOM tree.
+
+        :param wikitext: the wiki text, either as a string or as a list of
+                         lines.
+        :return: a `WikiDocument`
+        """
+        if isinstance(wikitext, basestring):
+            wikitext = re.sub(self._normalize_re, ' ', wikitext)
+            lines = wikitext.splitlines()
+            source = wikitext
+        else:
+            lines = wikitext
+            source = u'\n'.join(to_unicode(line) for line in lines)
+        return WikiDocument(source, self._parse_blocks(lines))
+
+    def tokenize(self, line):
+        """Return the `(start, end)` offsets of the wiki markup found
+        in `line`.
+
+        Each offset pair corresponds to one match of the `rules` regexp,
+        which can later be retrieved with `rules.match(line, start)`.
+        """
+        rules = self.rules
+        if self._markup_re and not self._markup_re.search(line):
+            return ()
+        return tuple(m.span() for m in rules.finditer(line))
+
+    def get_inline(self, wikidom):
+        """Return the single line projection of `wikidom`, as used by the
+        "oneliner" formatters.
+
+        The projection is a `(text, spans, unterminated)` tuple, where
+        `text` is the wiki text in which code blocks have been collapsed,
+        `spans` the corresponding `tokenize` result and `unterminated`
+        tells whether a code block was left open.
+
+        The projection is computed once and then stored in the document.
+        """
+        if wikidom.inline is None:
+            text, unterminated = self.collapse_code_blocks(wikidom.source)
+            wikidom.inline = (text, self.tokenize(text), unterminated)
+        return wikidom.inline
+
+    @classmethod
+    def collapse_code_blocks(cls, text):
+        """Replace the code blocks found in `text` by a `[...]` marker.
+
+        Comment blocks are removed and the remaining lines are kept as is.
+
+        :return: a `(text, unterminated)` tuple, where `unterminated` is
+                 `True` if the last code block was not closed.
+        """
+        in_code_block = 0
+        processor = None
+        buf = []
+        for line in text.strip().splitlines():
+            if isinstance(line, str):
+                line = line.decode('utf-8')
+            if cls.ENDBLOCK not in line and cls._startblock_re.match(line):
+                in_code_block += 1
+            elif line.strip() == cls.ENDBLOCK:
+                if in_code_block:
+                    in_code_block -= 1
+                    if in_code_block == 0:
+                        if processor != 'comment':
+                            buf.append(u' [...]')
+                        processor = None
+            elif in_code_block:
+                if not processor:
+                    if line.startswith('#!'):
+                        processor = line[2:].strip()
+            else:
+                buf.append(line)
+        return u'\n'.join(buf), in_code_block > 0
+
+    def _parse_blocks(self, lines):
+        blocks = []
+        quote = None        # (depth, lines) of the pending citation
+        code = None         # state of the current code block
+        for line in lines:
+            if isinstance(line, str):
+                line = line.decode('utf-8')
+            # Detect start of code block (new block or embedded block)
+            startmatch = None
+            if self.ENDBLOCK not in line:
+                startmatch = self._startblock_re.match(line)
+            # Handle content or end of code block
+            if code:
+                if self._parse_code_line(code, line, startmatch):
+                    if code['name']:
+                        blocks.append(self._make_code_block(code))
+                    code = None
+                continue
+            # Handle citation quotes '> ...'
+            if line.strip().startswith('>'):
+                depth = line.find('>')
+                if quote is None:
+                    quote = (depth, [])
+                quote[1].append(line[depth + 1:])
+                continue
+            # Handle end of citation quotes
+            if quote is not None:
+                blocks.append(self._make_quote_block(*quote))
+                quote = None
+            # Handle start of a new block
+            if startmatch:
+                code = {'depth': 1, 'name': startmatch.group(2), 'args': None,
+                        'prefix': line[:line.find(self.STARTBLOCK)],
+                        'buf': []}
+                if code['name']:
+                    code['args'] = parse_processor_args(
+                        line[startmatch.end():])
+            elif line[0:4] == '----':
+                blocks.append((BLOCK_HR,))
+            elif line == '':
+                blocks.append((BLOCK_BLANK,))
+            else:
+                line = line.replace('\t', ' ' * 8)
+                blocks.append((BLOCK_LINE, line, self.tokenize(line)))
+        # Flush unterminated code blocks
+        while code:
+            if self._parse_code_line(code, self.ENDBLOCK, None):
+                if code['name']:
+                    blocks.append(self._make_code_block(code))
+                code = None
+        if quote is not None:
+            blocks.append(self._make_quote_block(*quote))
+        return blocks
+
+    def _parse_code_line(self, code, line, startmatch):
+        """Add `line` to the `code` block being parsed.
+
+        Return `True` when the line closes the outermost block.
+        """
+        if startmatch:
+            code['depth'] += 1
+            code['buf'].append(line)
+            if not code['name']:
+                code['name'] = 'default'
+        elif line.strip() == self.ENDBLOCK:
+            code['depth'] -= 1
+            if code['depth'] == 0:
+                return True
+            code['buf'].append(line)
+        elif not code['name']:
+            match = self._processor_re.match(line)
+            if match:
+                code['prefix'] = match.group(1)
+                code['name'] = match.group(2)
+                code['args'] = parse_processor_args(line[match.end():])
+            else:
+                code['buf'].append(line)
+                code['name'] = 'default'
+        else:
+            code['buf'].append(line)
+        return False
+
+    def _make_code_block(self, code):
+        buf, prefix = code['buf'], code['prefix']
+        if buf:
+            if prefix and all(not l or l.startswith(prefix) for l in buf):
+                buf = [l[len(prefix):] for l in buf]
+            buf.append('')
+        return (BLOCK_CODE, code['name'], code['args'], u'\n'.join(buf))
+
+    def _make_quote_block(self, depth, lines):
+        # avoid an extra <blockquote> when there's consistently one space
+        # after the '>'
+        if all(not line or line[0] in '> ' for line in lines):
+            lines = [line[bool(line and line[0] == ' '):] for line in lines]
+        return (BLOCK_QUOTE, depth,
+                WikiDocument(u'\n'.join(lines), self._parse_blocks(lines)))
+
+
+# Kinds of the top-level nodes of a `WikiDocument`
+
+BLOCK_LINE = 'line'     # (BLOCK_LINE, text, spans)
+BLOCK_HR = 'hr'         # (BLOCK_HR,)
+BLOCK_BLANK = 'blank'   # (BLOCK_BLANK,)
+BLOCK_QUOTE = 'quote'   # (BLOCK_QUOTE, depth, WikiDocument)
+BLOCK_CODE = 'code'     # (BLOCK_CODE, processor name, processor args, text)
+
+
+class WikiDocument(object):
+    """Parsed wiki text, as produced by `WikiParser.parse`.
+
+    The document only holds plain Python values (strings, tuples, lists
+    and dicts), so it can be cached or pickled and then rendered any
+    number of times, by any formatter flavor, as long as the same set of
+    wiki syntax rules is in use.
+
+    `blocks` is the list of top-level nodes, as described by the `BLOCK_*`
+    constants; inline markup is represented by the `(start, end)` offsets
+    of the `WikiParser.rules` matches found in each line. `inline` is the
+    single line projection used by the "oneliner" formatters, which is
+    only computed on demand (see `WikiParser.get_inline`).
+    """
+
+    def __init__(self, source, blocks):
+        self.source = source
+        self.blocks = blocks
+        self.inline = None
+
+    def __nonzero__(self):
+        return bool(self.source)
+
+    def __eq__(self, other):
+        return isinstance(other, WikiDocument) and \
+               (self.source, self.blocks) == (other.source, other.blocks)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%s (%d blocks)>' % (self.__class__.__name__,
+                                     len(self.blocks))
+
+
+def _parse_rule(rule):
+    try:
+        parsed = sre_parse.parse(rule, re.UNICODE)
+    except (sre_constants.error, OverflowError):
+        return None
+    if parsed.pattern.flags & (re.IGNORECASE | re.LOCALE):
+        return None
+    return parsed
+
+
+def _is_anchored(items):
+    """Whether the parsed regexp can only match at the start of the text.
+    """
+    while items:
+        op, av = items[0]
+        if op == sre_constants.AT:
+            return av == sre_constants.AT_BEGINNING
+        elif op != sre_constants.SUBPATTERN:
+            return False
+        items = av[-1]
+    return False
+
+
+def _required_chars(items):
+    """Return a set of characters among which one at least appears in
+    any match of the parsed regexp, or `None` if no such set is found.
+    """
+    # Among the items which must be matched, pick the set of characters
+    # least likely to be found in plain text.
+    best = None
+    for op, av in items:
+        chars = None
+        if op == sre_constants.LITERAL:
+            chars = frozenset([unichr(av)])
+        elif op == sre_constants.IN:
+            chars = _charset_chars(av)
+        elif op == sre_constants.SUBPATTERN:
+            chars = _required_chars(av[-1])
+        elif op == sre_constants.BRANCH:
+            branches = [_required_chars(branch) for branch in av[1]]
+            if None not in branches:
+                chars = frozenset().union(*branches)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if av[0] > 0:
+                chars = _required_chars(av[2])
+        if chars and (best is None or _rarity(chars) < _rarity(best)):
+            best = chars
+    return best
+
+
+def _charset_chars(items):
+    chars = set()
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            chars.add(unichr(av))
+        elif op == sre_constants.RANGE:
+            chars.update(unichr(c) for c in xrange(av[0], av[1] + 1))
+        else: # NEGATE, CATEGORY
+            return None
+    return frozenset(chars)
+
+
+def _rarity(chars):
+    return any(c.isalpha() for c in chars), len(chars)
 
 
 _processor_pname_re = re.compile(r'[-\w]+$')
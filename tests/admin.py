@@ -16,8 +16,11 @@ import sys
 import tempfile
 import unittest
 
+from trac.db.api import DatabaseManager
 from trac.test import EnvironmentStub
-from trac.util import create_file
+from trac.util import create_file, read_file
+from trac.wiki import db_default
+from trac.wiki.api import WikiSystem
 from trac.wiki.model import WikiPage
 from trac.wiki.admin import WikiAdmin
 
@@ -44,6 +47,7 @@ class WikiAdminTestCase(unittest.TestCase):
                     page.save('trac', '')
 
     def tearDown(self):
+        DatabaseManager(self.env).drop_tables(db_default.schema)
         self.env.reset_db_and_disk()
 
     def _import_page(self, *args, **kwargs):
@@ -97,6 +101,111 @@ class WikiAdminTestCase(unittest.TestCase):
         self.assertEqual(0, page.readonly)
         self.assertEqual(page_text, page.text)
 
+    def test_upgrade_latest_table(self):
+        self.assertFalse(WikiSystem(self.env).has_latest_table)
+        self.assertTrue(self.admin.environment_needs_upgrade())
+        self.admin.upgrade_environment()
+        self.assertFalse(self.admin.environment_needs_upgrade())
+        self.assertTrue(WikiSystem(self.env).has_latest_table)
+        self.assertEqual([('ReadOnlyPage', 5, 1), ('WritablePage', 3, 0)],
+                         self.env.db_query("""
+                            SELECT name, version, readonly FROM wiki_latest
+                            ORDER BY name"""))
+
+        self._import_page(self.filename, 'WritablePage')
+        self._import_page(self.filename, 'NewPage')
+        self.assertEqual([('NewPage', 1, 0), ('ReadOnlyPage', 5, 1),
+                          ('WritablePage', 4, 0)],
+                         self.env.db_query("""
+                            SELECT name, version, readonly FROM wiki_latest
+                            ORDER BY name"""))
+
+    def test_upgrade_text_table(self):
+        texts = [WikiPage(self.env, name, version).text
+                 for name, version in self.env.db_query("""
+                    SELECT name, version FROM wiki ORDER BY name, version""")]
+        self.admin.upgrade_environment()
+        self.assertTrue(WikiSystem(self.env).has_text_table)
+        self.assertEqual([('[wiki:ReadOnlyPage@%d]' % v, 1)
+                          for v in range(1, 6)] +
+                         [('[wiki:WritablePage@%d]' % v, 1)
+                          for v in range(1, 4)],
+                         self.env.db_query("""
+                            SELECT text, refs FROM wiki_text
+                            ORDER BY text"""))
+        self.assertEqual([], self.env.db_query("""
+            SELECT text FROM wiki WHERE text IS NOT NULL"""))
+        self.assertEqual(texts,
+                         [WikiPage(self.env, name, version).text
+                          for name, version in self.env.db_query("""
+                            SELECT name, version FROM wiki
+                            ORDER BY name, version""")])
+
+        create_file(self.filename, '[wiki:WritablePage@3]')
+        self._import_page(self.filename, 'WritablePage')
+        self.assertEqual(3, WikiPage(self.env, 'WritablePage').version)
+        create_file(self.filename, '[wiki:WritablePage@1]')
+        self._import_page(self.filename, 'WritablePage')
+        create_file(self.filename, '[wiki:WritablePage@5]')
+        self._import_page(self.filename, 'WritablePage')
+        self.assertEqual(5, WikiPage(self.env, 'WritablePage').version)
+        self.assertEqual([('[wiki:WritablePage@1]', 2),
+                          ('[wiki:WritablePage@2]', 1),
+                          ('[wiki:WritablePage@3]', 1),
+                          ('[wiki:WritablePage@5]', 1)],
+                         self.env.db_query("""
+                            SELECT text, refs FROM wiki_text
+                            WHERE text>%s ORDER BY text
+                            """, ('[wiki:W',)))
+
+        create_file(self.filename, '[wiki:WritablePage@2]')
+        self._import_page(self.filename, 'WritablePage', replace=True)
+        self.assertEqual(5, WikiPage(self.env, 'WritablePage').version)
+        self.assertEqual([('[wiki:WritablePage@1]', 2),
+                          ('[wiki:WritablePage@2]', 2),
+                          ('[wiki:WritablePage@3]', 1)],
+                         self.env.db_query("""
+                            SELECT text, refs FROM wiki_text
+                            WHERE text>%s ORDER BY text
+                            """, ('[wiki:W',)))
+        exported = os.path.join(self.tmpdir, 'exported.txt')
+        self.admin.export_page('WritablePage', exported)
+        self.assertEqual('[wiki:WritablePage@2]', read_file(exported))
+
+    def test_compress_uncompress(self):
+        self.admin.upgrade_environment()
+        lines = ['Line %d of the page\n' % i for i in range(50)]
+        page_texts = []
+        for i in range(5):
+            lines[i * 10] = 'Line changed in version %d\n' % (i + 1)
+            page = WikiPage(self.env, 'LongPage')
+            page.text = ''.join(lines)
+            page.save('joe', '')
+            page_texts.append(page.text)
+
+        def deltas():
+            return [version for version, in self.env.db_query("""
+                SELECT version FROM wiki_storage
+                WHERE name=%s AND delta IS NOT NULL
+                ORDER BY version""", ('LongPage',))]
+
+        self.env.config.set('wiki', 'delta_keyframe_interval', 2)
+        with open(os.devnull, 'wb') as devnull:
+            stdout = sys.stdout
+            try:
+                sys.stdout = devnull
+                self.admin._do_compress('LongPage')
+                self.assertEqual([1, 3], deltas())
+                self.assertEqual(page_texts,
+                                 [WikiPage(self.env, 'LongPage', v).text
+                                  for v in range(1, 6)])
+                self.admin._do_uncompress()
+            finally:
+                sys.stdout = stdout
+        self.assertEqual([], deltas())
+        self.assertEqual(page_texts,
+                         [WikiPage(self.env, 'LongPage', v).text
+                          for v in range(1, 6)])
 
 def test_suite():
     return unittest.makeSuite(WikiAdminTestCase)
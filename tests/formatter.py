@@ -11,15 +11,25 @@
 # individuals. For the exact contribution history, see the revision
 # history and logs, available at http://trac.edgewall.org/log/.
 
+import io
 import os
+import pickle
 import unittest
 
-from trac.core import Component, TracError, implements
+from trac.core import Component, ComponentMeta, TracError, implements
+from trac.test import EnvironmentStub, MockRequest
 from trac.util.html import genshi, html
 from trac.util.translation import tag_
-from trac.wiki.api import IWikiSyntaxProvider
-from trac.wiki.formatter import MacroError, ProcessorError
+from trac.wiki.api import IWikiSyntaxProvider, LRUCache, WikiSystem
+from trac.web.chrome import web_context
+from trac.wiki import formatter as wikiformatter
+from trac.wiki.formatter import (
+    Formatter, HtmlFormatter, InlineHtmlFormatter, MacroError,
+    OutlineFormatter, ProcessorError, WikiProcessor, extract_link, format_many,
+    format_to_plaintext)
 from trac.wiki.macros import WikiMacroBase
+from trac.wiki.model import WikiPage
+from trac.wiki.parser import BLOCK_CODE, BLOCK_QUOTE, WikiParser
 from trac.wiki.test import wikisyntax_test_suite
 
 
@@ -156,9 +166,301 @@ class SampleResolver(Component):
                       href=formatter.href(module, target))
 
 
+class WikiDocumentTestCase(unittest.TestCase):
+
+    text = u"""\
+= Title =
+Some ''wiki'' text with a CamelCase link and
+a [wiki:SandBox sand box].
+
+> quoted ''text''
+>> == Quoted heading ==
+
+{{{#!div class=important
+ * list item
+}}}
+{{{
+code block
+""" # unterminated code block
+
+    def setUp(self):
+        self.env = EnvironmentStub()
+        self.req = MockRequest(self.env)
+        self.context = web_context(self.req, 'wiki', 'WikiStart')
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _outline(self, wikidom):
+        out = io.StringIO()
+        OutlineFormatter(self.env, self.context).format(wikidom, out)
+        return out.getvalue()
+
+    def test_parse_blocks(self):
+        wikidom = WikiParser(self.env).parse(self.text)
+        self.assertEqual(self.text, wikidom.source)
+        kinds = [block[0] for block in wikidom.blocks]
+        self.assertEqual(['line', 'line', 'line', 'blank', 'quote', 'blank',
+                          'code', 'code'], kinds)
+        quote = wikidom.blocks[4]
+        self.assertEqual(BLOCK_QUOTE, quote[0])
+        self.assertEqual(0, quote[1])
+        self.assertEqual(u"quoted ''text''\n> == Quoted heading ==",
+                         quote[2].source)
+        self.assertEqual((BLOCK_CODE, 'div', {'class': 'important'},
+                          u' * list item\n'), wikidom.blocks[6])
+        self.assertEqual((BLOCK_CODE, 'default', None, u'code block\n'),
+                         wikidom.blocks[7])
+
+    def test_render_parsed_document(self):
+        wikidom = WikiParser(self.env).parse(self.text)
+        self.assertEqual(
+            HtmlFormatter(self.env, self.context, self.text).generate(),
+            HtmlFormatter(self.env, self.context, wikidom).generate())
+        self.assertEqual(
+            InlineHtmlFormatter(self.env, self.context, self.text).generate(),
+            InlineHtmlFormatter(self.env, self.context, wikidom).generate())
+        self.assertEqual(self._outline(self.text), self._outline(wikidom))
+        self.assertEqual(extract_link(self.env, self.context, self.text),
+                         extract_link(self.env, self.context, wikidom))
+
+    def test_render_document_twice(self):
+        wikidom = WikiParser(self.env).parse(self.text)
+        first = HtmlFormatter(self.env, self.context, wikidom).generate()
+        second = HtmlFormatter(self.env, self.context, wikidom).generate()
+        self.assertEqual(first, second)
+        self.assertIn('<div class="important">', first)
+
+    def test_formatter_source(self):
+        wikidom = WikiParser(self.env).parse(self.text)
+        formatter = Formatter(self.env, self.context)
+        formatter.format(wikidom)
+        self.assertEqual(self.text, formatter.source)
+        self.assertIs(wikidom, formatter.wikidom)
+        formatter.format(self.text)
+        self.assertEqual(self.text, formatter.source)
+        self.assertEqual(wikidom.blocks, formatter.wikidom.blocks)
+
+    def test_pickle_document(self):
+        wikidom = WikiParser(self.env).parse(self.text)
+        InlineHtmlFormatter(self.env, self.context, wikidom).generate()
+        copy = pickle.loads(pickle.dumps(wikidom, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(wikidom.blocks, copy.blocks)
+        self.assertEqual(wikidom.inline, copy.inline)
+        self.assertEqual(
+            HtmlFormatter(self.env, self.context, wikidom).generate(),
+            HtmlFormatter(self.env, self.context, copy).generate())
+
+    def _render_cached(self, text, cache):
+        formatter = HtmlFormatter(self.env, self.context, text, cache)
+        rendered = formatter.generate()
+        self.assertEqual(HtmlFormatter(self.env, self.context,
+                                       text).generate(), rendered)
+        return rendered
+
+    def test_block_cache(self):
+        cache = LRUCache(1 << 20)
+        text = u"= Title =\nFirst paragraph\n\n = Title =\n  indented\n" \
+               u"\n----\n|| a || b ||\n\n[[HelloWorld(x)]]\n\nLast"
+        first = self._render_cached(text, cache)
+        self.assertEqual(4, len(cache))
+        self.assertEqual(first, self._render_cached(text, cache))
+        self.assertEqual(4, len(cache))
+
+        edited = text.replace('First', 'Edited')
+        self.assertIn('Edited paragraph', self._render_cached(edited, cache))
+        self.assertEqual(5, len(cache))
+
+    def test_block_cache_skips_links_to_other_realms(self):
+        cache = LRUCache(1 << 20)
+        self._render_cached(u"See #1.\n\nSee OtherPage.\n\n", cache)
+        self.assertEqual(1, len(cache))
+
+    def test_block_cache_anchors(self):
+        cache = LRUCache(1 << 20)
+        text = u"= Title =\n\n= Other =\n\n= Title =\n"
+        self.assertIn('id="Title1"', self._render_cached(text, cache))
+        text = u"= Other =\n\n" + text
+        rendered = self._render_cached(text, cache)
+        self.assertIn('id="Other1"', rendered)
+        self.assertIn('id="Title1"', rendered)
+        text = u"= Title =\n\n= Other =\n\n"
+        self.assertNotIn('id="Title1"', self._render_cached(text, cache))
+
+    def test_link_memo(self):
+        text = u"WikiStart\n> WikiStart\n\n{{{#!div\n[wiki:WikiStart x]\n" \
+               u"}}}\n|| [wiki:/WikiStart] ||\n"
+        formatter = Formatter(self.env, self.context)
+        out = io.StringIO()
+        formatter.format(text, out)
+        self.assertEqual(4, out.getvalue().count('class="missing wiki"'))
+        self.assertEqual(['/WikiStart', 'WikiStart'],
+                         sorted(key[1] for key in formatter.link_memo))
+
+        page = WikiPage(self.env, 'WikiStart')
+        page.text = 'The start page'
+        page.save('joe', 'Created')
+        out = io.StringIO()
+        Formatter(self.env, self.context).format(text, out)
+        self.assertEqual(4, out.getvalue().count('<a class="wiki"'))
+
+    def test_tokenize_plain_line(self):
+        parser = WikiParser(self.env)
+        self.assertEqual((), parser.tokenize(u"nothing to see here"))
+        self.assertEqual(((5, 14),), parser.tokenize(u"some CamelCase"))
+        self.assertEqual(((0, 1),), parser.tokenize(u" indented"))
+        self.assertEqual(((2, 4),), parser.tokenize(u"a ,,b"))
+
+    def test_tokenize_skips_prose(self):
+        """The capitals of the prose don't trigger the full scan."""
+        parser = WikiParser(self.env)
+        parser.rules
+        for line in (u"This is plain prose with a Capital letter.",
+                     u"Änderungen Über Straße."):
+            self.assertIsNone(parser._markup_re.search(line))
+            self.assertEqual((), parser.tokenize(line))
+        for line in (u"see CamelCase", u"Über UberPage"):
+            self.assertIsNotNone(parser._markup_re.search(line))
+            self.assertEqual(tuple(m.span() for m in
+                                   parser.rules.finditer(line)),
+                             parser.tokenize(line))
+
+    def test_tokenize_same_as_rules(self):
+        parser = WikiParser(self.env)
+        for line in self.text.splitlines() + [u"a b", u" * item", u"x&y",
+                                              u"== h ==", u"mail a@b.org"]:
+            self.assertEqual(tuple(m.span() for m in
+                                   parser.rules.finditer(line)),
+                             parser.tokenize(line))
+        self.assertIsNotNone(parser._markup_re)
+
+    def test_rule_groups(self):
+        parser = WikiParser(self.env)
+        for text, itype in ((u"'''", 'bold'), (u"!''", 'italic'),
+                            (u"[wiki:Page label]", 'lhref'),
+                            (u"== Heading == #anchor", 'heading'),
+                            (u"|| cell ||", 'table_cell')):
+            match = parser.rules.match(text)
+            self.assertEqual(itype, parser.rule_groups[match.lastindex])
+        self.assertNotIn('hanchor', parser.rule_groups.values())
+        self.assertIn('hanchor', parser.helper_patterns)
+
+    def test_format_to_plaintext(self):
+        context = web_context(None, 'wiki', 'WikiStart')
+        self.assertEqual(u"Title\n"
+                         u"Some wiki text with a CamelCase link and a sand "
+                         u"box.\n"
+                         u"quoted text\n"
+                         u"Quoted heading\n"
+                         u"list item\n"
+                         u"code block",
+                         format_to_plaintext(self.env, context, self.text))
+        self.assertEqual(u"Cell 1 cell 2\nAfter",
+                         format_to_plaintext(self.env, context,
+                                             u"|| Cell 1 || ''cell'' 2 ||\n"
+                                             u"[[PageOutline]] After[[br]]"))
+        self.assertEqual(u"Visible text",
+                         format_to_plaintext(self.env, context,
+                                             u"{{{#!html\n"
+                                             u"<style>p { color: red }"
+                                             u"</style>\n"
+                                             u"<p>Visible text</p>\n"
+                                             u"<script>alert(1)</script>\n"
+                                             u"<SCRIPT>unclosed\n"
+                                             u"}}}"))
+
+    def test_format_many(self):
+        fragments = [self.text, u"", u"== Title ==\n * item", self.text,
+                     u"'''unclosed bold"]
+        self.assertEqual([wikiformatter.format_to_html(self.env,
+                                                       self.context, text)
+                          for text in fragments],
+                         format_many(self.env, self.context, fragments,
+                                     'html'))
+        self.assertEqual([wikiformatter.format_to_oneliner(self.env,
+                                                           self.context,
+                                                           text, True)
+                          for text in fragments],
+                         format_many(self.env, self.context, fragments,
+                                     'oneliner', shorten=True))
+
+
+class WikiProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', HelloWorldMacro])
+        self.req = MockRequest(self.env)
+        self.formatter = Formatter(self.env, web_context(self.req))
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def test_macro_lookup(self):
+        processor = WikiProcessor(self.formatter, 'HelloWorld')
+        self.assertIsNone(processor.error)
+        self.assertIsInstance(processor.macro_provider, HelloWorldMacro)
+        self.assertIsNotNone(WikiProcessor(self.formatter, 'div').processor)
+        self.assertIsNotNone(WikiProcessor(self.formatter, 'Unknown').error)
+
+    def test_macro_overridden_by_later_provider(self):
+        class OverridingMacro(WikiMacroBase):
+            def get_macros(self):
+                yield 'HelloWorld'
+        try:
+            self.env.enable_component(OverridingMacro)
+            processor = WikiProcessor(self.formatter, 'HelloWorld')
+            self.assertIsInstance(processor.macro_provider, OverridingMacro)
+        finally:
+            ComponentMeta.deregister(OverridingMacro)
+
+    def test_macro_index_follows_enabled_components(self):
+        wiki = WikiSystem(self.env)
+        self.assertIsNotNone(wiki.get_macro_provider('HelloWorld'))
+        self.env.disable_component(HelloWorldMacro)
+        self.assertIsNone(wiki.get_macro_provider('HelloWorld'))
+        processor = WikiProcessor(self.formatter, 'HelloWorld')
+        self.assertIsNotNone(processor.error)
+
+    def test_macro_index_follows_provided_macros(self):
+        class DynamicMacros(WikiMacroBase):
+            names = []
+            def get_macros(self):
+                return self.names
+        try:
+            self.env.enable_component(DynamicMacros)
+            wiki = WikiSystem(self.env)
+            self.assertIsNotNone(wiki.get_macro_provider('HelloWorld'))
+            self.assertIsNone(wiki.get_macro_provider('LateMacro'))
+            DynamicMacros.names = ['LateMacro']
+            provider, inline_check = wiki.get_macro_provider('LateMacro')
+            self.assertIsInstance(provider, DynamicMacros)
+        finally:
+            ComponentMeta.deregister(DynamicMacros)
+
+    def test_case_classes(self):
+        self.assertIsInstance(WikiSystem.Lu, unicode)
+        self.assertEqual(WikiSystem.Lu, WikiSystem(self.env).Lu)
+        self.assertRegexpMatches(u'\xc9', u'^[%s]$' % WikiSystem.Lu)
+        self.assertRegexpMatches(u'\xe9', u'^[%s]$' % WikiSystem.Ll)
+        self.assertNotRegexpMatches(u'e', u'^[%s]$' % WikiSystem.Lu)
+
+    def test_html_sanitizer_shared(self):
+        wiki = WikiSystem(self.env)
+        sanitizer = wiki.html_sanitizer
+        self.assertIs(sanitizer,
+                      WikiProcessor(self.formatter, 'html')._sanitizer)
+        self.env.config.set('wiki', 'safe_schemes', 'http, https')
+        self.assertIsNot(sanitizer, wiki.html_sanitizer)
+        self.assertEqual({'http', 'https'},
+                         set(wiki.html_sanitizer.safe_schemes))
+
+
 def test_suite(data=None, setup=None, file=__file__, teardown=None,
                context=None):
     suite = unittest.TestSuite()
+    if not data:
+        suite.addTest(unittest.makeSuite(WikiDocumentTestCase))
+        suite.addTest(unittest.makeSuite(WikiProcessorTestCase))
 
     if data:
         suite.addTest(wikisyntax_test_suite(data, setup, file, teardown,
@@ -12,15 +12,21 @@
 # history and logs, available at http://trac.edgewall.org/log/.
 
 from datetime import datetime
+import hashlib
 import io
+import os
 import unittest
 
 from trac.attachment import Attachment
 from trac.core import *
+from trac.db.api import DatabaseManager
 from trac.resource import Resource
-from trac.test import EnvironmentStub, mkdtemp
+from trac.test import EnvironmentStub, MockRequest, mkdtemp
 from trac.util.datefmt import utc, to_utimestamp
-from trac.wiki import WikiPage, IWikiChangeListener
+from trac.wiki import WikiPage, WikiSystem, IWikiChangeListener
+from trac.wiki import db_default
+from trac.wiki.admin import WikiAdmin
+from trac.wiki.api import PageNameIndex
 
 
 class TestWikiChangeListener(Component):
@@ -66,6 +72,7 @@ class WikiPageTestCase(unittest.TestCase):
         self.env = EnvironmentStub(path=mkdtemp())
 
     def tearDown(self):
+        DatabaseManager(self.env).drop_tables(db_default.schema)
         self.env.reset_db_and_disk()
 
     def test_new_page(self):
@@ -111,6 +118,65 @@ class WikiPageTestCase(unittest.TestCase):
         page = WikiPage(self.env, resource, 1)
         self.assertEqual(1, page.version)
 
+    def test_existing_page_without_text(self):
+        t = datetime(2001, 1, 1, 1, 1, 1, 0, utc)
+        self.env.db_transaction(
+            "INSERT INTO wiki VALUES(%s,%s,%s,%s,%s,%s,%s)",
+            ('TestPage', 1, to_utimestamp(t), 'joe', 'Bla bla',
+             'Testing', 1))
+
+        page = WikiPage(self.env, 'TestPage', fetch_text=False)
+        self.assertTrue(page.exists)
+        self.assertEqual(1, page.version)
+        self.assertEqual(1, page.readonly)
+        self.assertEqual('joe', page.author)
+        self.assertEqual(('TestPage', 1), page._pending_text)
+        self.assertEqual('Bla bla', page.text)
+        self.assertEqual('Bla bla', page.old_text)
+        self.assertIsNone(page._pending_text)
+
+        page = WikiPage(self.env, 'TestPage', fetch_text=False)
+        page.text = 'Bla bla bla'
+        self.assertEqual('Bla bla', page.old_text)
+        page.save('kate', 'Changed')
+        self.assertEqual('Bla bla bla', WikiPage(self.env, 'TestPage').text)
+
+        page = WikiPage(self.env, 'OtherPage', fetch_text=False)
+        self.assertFalse(page.exists)
+        self.assertEqual('', page.text)
+
+    def test_page_rows_kept_during_request(self):
+        self.env.db_transaction(
+            "INSERT INTO wiki VALUES(%s,%s,%s,%s,%s,%s,%s)",
+            ('TestPage', 1, 42, 'joe', 'Bla bla', 'Testing', 0))
+        req = MockRequest(self.env)
+        WikiSystem(self.env).pre_process_request(req, None)
+
+        self.assertEqual('Bla bla', WikiPage(self.env, 'TestPage').text)
+        self.env.db_transaction("UPDATE wiki SET text='Changed', readonly=1")
+        page = WikiPage(self.env, 'TestPage', 1, fetch_text=False)
+        self.assertEqual(0, page.readonly)
+        self.assertEqual('Bla bla', page.text)
+
+        page.text = 'New text'
+        page.save('kate', 'Changed')
+        page = WikiPage(self.env, 'TestPage')
+        self.assertEqual(2, page.version)
+        self.assertEqual('New text', page.text)
+        self.assertEqual(0, page.readonly)
+
+    def test_page_rows_released_with_request(self):
+        self.env.db_transaction(
+            "INSERT INTO wiki VALUES(%s,%s,%s,%s,%s,%s,%s)",
+            ('TestPage', 1, 42, 'joe', 'Bla bla', 'Testing', 0))
+        req = MockRequest(self.env)
+        WikiSystem(self.env).pre_process_request(req, None)
+        self.assertEqual('Bla bla', WikiPage(self.env, 'TestPage').text)
+        del req
+
+        self.env.db_transaction("UPDATE wiki SET text='Changed'")
+        self.assertEqual('Changed', WikiPage(self.env, 'TestPage').text)
+
     def test_create_page(self):
         page = WikiPage(self.env)
         page.name = 'TestPage'
@@ -269,6 +335,79 @@ class WikiPageTestCase(unittest.TestCase):
         listener = TestWikiChangeListener(self.env)
         self.assertEqual((page, 'TestPage'), listener.renamed[0])
 
+    def test_get_pages_with_prefix(self):
+        wiki = WikiSystem(self.env)
+        for name in ('Page', 'Page/Child', 'PageTwo', 'Other/Page'):
+            page = WikiPage(self.env, name)
+            page.text = 'Text'
+            page.save('joe', 'Created')
+        self.assertEqual(['Page', 'Page/Child', 'PageTwo'],
+                         sorted(wiki.get_pages('Page')))
+        self.assertEqual(['Page/Child'], list(wiki.get_pages('Page/')))
+        self.assertEqual([], list(wiki.get_pages('Pages')))
+        self.assertEqual(4, len(list(wiki.get_pages())))
+
+        WikiPage(self.env, 'Page/Child').rename('PageThree')
+        self.assertEqual(['Page', 'PageThree', 'PageTwo'],
+                         list(wiki.get_pages('Page')))
+
+    def test_update_pages_cache(self):
+        wiki = WikiSystem(self.env)
+        self.assertEqual(set(), wiki.pages)
+        # Not recorded in the log of the changes of the pages cache
+        self.env.db_transaction("INSERT INTO wiki (name, version) "
+                                "VALUES ('RawPage', 1)")
+        page = WikiPage(self.env, 'TestPage')
+        page.text = 'Text'
+        page.save('joe', 'Created')
+        self.assertEqual({'TestPage'}, wiki.pages)
+        page.rename('RenamedPage')
+        self.assertEqual({'RenamedPage'}, wiki.pages)
+        self.assertEqual(['RenamedPage'], list(wiki.get_pages('Re')))
+        page.delete()
+        self.assertEqual(set(), wiki.pages)
+
+        del wiki.pages
+        self.assertEqual({'RawPage'}, wiki.pages)
+
+    def test_shared_page_index(self):
+        self.env.config.set('wiki', 'shared_page_index', True)
+        wiki = WikiSystem(self.env)
+        for name in ('Page', u'Pag\xe9', 'Page/Child'):
+            page = WikiPage(self.env, name)
+            page.text = 'Text'
+            page.save('joe', 'Created')
+        pages = wiki.pages
+        self.assertIsInstance(pages, PageNameIndex)
+        self.assertEqual({'Page', u'Pag\xe9', 'Page/Child'}, pages)
+        self.assertIn(u'Pag\xe9', pages)
+        self.assertNotIn('Pag', pages)
+        self.assertEqual(['Page/Child'], list(wiki.get_pages('Page/')))
+        index = PageNameIndex(os.path.join(self.env.files_dir,
+                                           'wiki-pages.idx'))
+        self.assertEqual(['Page', 'Page/Child', u'Pag\xe9'], list(index))
+
+        WikiPage(self.env, 'Page').delete()
+        self.assertEqual({u'Pag\xe9', 'Page/Child'}, wiki.pages)
+        self.assertIsNot(pages, wiki.pages)
+
+    def test_shared_page_index_not_replaced_by_older(self):
+        self.env.config.set('wiki', 'shared_page_index', True)
+        wiki = WikiSystem(self.env)
+        path = os.path.join(self.env.files_dir, 'wiki-pages.idx')
+        os.makedirs(self.env.files_dir)
+        PageNameIndex.write(path, 5, ['NewerPage'])
+        self.assertEqual({'OlderPage'},
+                         wiki._write_page_index(4, {'OlderPage'}))
+        self.assertEqual((5, ['NewerPage']),
+                         (PageNameIndex(path).generation,
+                          list(PageNameIndex(path))))
+        index = wiki._write_page_index(5, {'OtherPage'})
+        self.assertIsInstance(index, PageNameIndex)
+        self.assertEqual(['NewerPage'], list(index))
+        index = wiki._write_page_index(6, {'OtherPage'})
+        self.assertEqual((6, ['OtherPage']), (index.generation, list(index)))
+
     def test_edit_comment_of_page_version(self):
         self.env.db_transaction.executemany(
             "INSERT INTO wiki VALUES(%s,%s,%s,%s,%s,%s,%s)",
@@ -343,6 +482,143 @@ class WikiPageTestCase(unittest.TestCase):
         page = WikiPage(self.env, resource, 1)
         self.assertEqual(1, page.version)
 
+    def test_latest_table(self):
+        WikiAdmin(self.env).upgrade_environment()
+
+        def latest():
+            return self.env.db_query("""
+                SELECT name, version, time, author, readonly
+                FROM wiki_latest ORDER BY name""")
+
+        t1 = datetime(2001, 1, 1, 1, 1, 1, 0, utc)
+        t2 = datetime(2002, 1, 1, 1, 1, 1, 0, utc)
+        page = WikiPage(self.env, 'TestPage')
+        page.text = 'Bla bla'
+        page.save('joe', 'Testing', t1)
+        page.text = 'Bla bla bla'
+        page.readonly = 1
+        page.save('kate', 'Testing', t2)
+        self.assertEqual([('TestPage', 2, to_utimestamp(t2), 'kate', 1)],
+                         latest())
+        self.assertEqual({'TestPage'}, WikiSystem(self.env).readonly_pages)
+
+        page.rename('PageRenamed')
+        self.assertEqual([('PageRenamed', 2, to_utimestamp(t2), 'kate', 1)],
+                         latest())
+
+        page.delete(2)
+        self.assertEqual([('PageRenamed', 1, to_utimestamp(t1), 'joe', 0)],
+                         latest())
+        self.assertEqual(set(), WikiSystem(self.env).readonly_pages)
+
+        page.delete()
+        self.assertEqual([], latest())
+
+    def test_delta_storage(self):
+        WikiAdmin(self.env).upgrade_environment()
+        self.env.config.set('wiki', 'delta_storage', 'enabled')
+        self.env.config.set('wiki', 'delta_keyframe_interval', 3)
+        lines = ['Line %d of the page\n' % i for i in range(50)]
+        texts = []
+        page = WikiPage(self.env, 'TestPage')
+        for i in range(5):
+            lines[i * 10] = 'Line changed in version %d\n' % (i + 1)
+            page.text = ''.join(lines)
+            page.save('joe', 'Version %d' % (i + 1))
+            texts.append(page.text)
+
+        def stored():
+            return self.env.db_query("""
+                SELECT w.text IS NOT NULL, s.hash IS NOT NULL, s.base
+                FROM wiki w LEFT OUTER JOIN wiki_storage s
+                  ON s.name = w.name AND s.version = w.version
+                WHERE w.name=%s ORDER BY w.version""", ('TestPage',))
+
+        self.assertEqual([(0, 0, 2), (0, 0, 3), (0, 1, None), (0, 0, 5),
+                          (0, 1, None)], stored())
+        for version, text in enumerate(texts, 1):
+            self.assertEqual(text, WikiPage(self.env, 'TestPage',
+                                            version).text)
+
+        WikiPage(self.env, 'TestPage').delete(5)
+        self.assertEqual([(0, 0, 2), (0, 0, 3), (0, 1, None),
+                          (0, 1, None)], stored())
+        WikiPage(self.env, 'TestPage', 2).delete(2)
+        self.assertEqual([(0, 1, None), (0, 1, None), (0, 1, None)],
+                         stored())
+        for version in (1, 3, 4):
+            self.assertEqual(texts[version - 1],
+                             WikiPage(self.env, 'TestPage', version).text)
+
+    def test_history_cursor(self):
+        with self.env.db_transaction as db:
+            for version in (1, 2, 4, 5, 7):
+                db("INSERT INTO wiki VALUES(%s,%s,%s,%s,%s,%s,%s)",
+                   ('TestPage', version, 42, 'joe', 'Bla', '', 0))
+
+        page = WikiPage(self.env, 'TestPage', 5)
+        self.assertEqual([5, 4, 2, 1],
+                         [h[0] for h in page.get_history()])
+        self.assertEqual([5, 4], [h[0] for h in page.get_history(limit=2)])
+        self.assertEqual([2, 1], [h[0] for h in page.get_history(before=4)])
+        self.assertEqual([4], [h[0] for h in page.get_history(before=5,
+                                                              limit=1)])
+        self.assertEqual(4, page.previous_version())
+        self.assertEqual(7, page.next_version())
+        self.assertEqual(2, page.previous_version(4))
+        self.assertEqual(4, page.next_version(2))
+        self.assertIsNone(page.previous_version(1))
+        self.assertIsNone(page.next_version(7))
+
+    def test_text_table(self):
+        WikiAdmin(self.env).upgrade_environment()
+        self.env.config.set('wiki', 'delta_storage', 'enabled')
+
+        def texts():
+            return self.env.db_query("""
+                SELECT text, refs FROM wiki_text ORDER BY text""")
+
+        page = WikiPage(self.env, 'TestPage')
+        for text in ('Bla bla', 'Bla bla bla', 'Bla bla', 'Bla'):
+            page.text = text
+            page.save('joe', 'Testing')
+        other = WikiPage(self.env, 'OtherPage')
+        for text in ('Bla bla bla', 'Other'):
+            other.text = text
+            other.save('kate', 'Copied')
+        self.assertEqual([('Bla', 1), ('Bla bla', 2), ('Bla bla bla', 2),
+                          ('Other', 1)], texts())
+        self.assertEqual(['Bla bla', 'Bla bla bla', 'Bla bla', 'Bla'],
+                         [WikiPage(self.env, 'TestPage', v).text
+                          for v in (1, 2, 3, 4)])
+        self.assertEqual([], self.env.db_query("""
+            SELECT text FROM wiki WHERE text IS NOT NULL"""))
+
+        page.delete(2)
+        self.assertEqual([('Bla', 1), ('Bla bla', 2), ('Bla bla bla', 1),
+                          ('Other', 1)], texts())
+        page.delete()
+        self.assertEqual([('Bla bla bla', 1), ('Other', 1)], texts())
+        other.rename('RenamedPage')
+        self.assertEqual('Bla bla bla',
+                         WikiPage(self.env, 'RenamedPage', 1).text)
+        other.delete()
+        self.assertEqual([], texts())
+
+    def test_text_table_verbatim_text(self):
+        """The page texts looking like stored references are kept as is.
+        """
+        WikiAdmin(self.env).upgrade_environment()
+        page = WikiPage(self.env, 'TestPage')
+        page.text = 'Secret'
+        page.save('joe', 'Testing')
+        page.text = u'\x1bsha1:' + hashlib.sha1('Secret').hexdigest()
+        page.save('joe', 'Testing')
+        page.text = 'Bla'
+        page.save('joe', 'Testing')
+        self.assertEqual(u'\x1bsha1:' + hashlib.sha1('Secret').hexdigest(),
+                         WikiPage(self.env, 'TestPage', 2).text)
+
 
 def test_suite():
     return unittest.makeSuite(WikiPageTestCase)
@@ -12,12 +12,21 @@
 # history and logs, available at http://trac.edgewall.org/log/.
 
 import unittest
+from datetime import datetime
 
-from trac.perm import DefaultPermissionStore, PermissionCache
+from trac.db.api import DatabaseManager
+from trac.perm import (DefaultPermissionStore, PermissionCache,
+                       PermissionSystem)
 from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import utc
 from trac.web.api import HTTPBadRequest
+from trac.web.chrome import web_context
+from trac.wiki import db_default
+from trac.wiki.admin import WikiAdmin
+from trac.wiki.formatter import format_to_html
 from trac.wiki.model import WikiPage
-from trac.wiki.web_ui import DefaultWikiPolicy, WikiModule
+from trac.wiki.web_ui import DefaultWikiPolicy, WikiModule, WikiRenderCache, \
+                             WikiSearchIndex
 
 
 class DefaultWikiPolicyTestCase(unittest.TestCase):
@@ -60,6 +69,27 @@ class DefaultWikiPolicyTestCase(unittest.TestCase):
                 self.policy.check_permission(perm, perm_cache.username,
                                              self.page.resource, perm_cache))
 
+    def test_readonly_flag_changed(self):
+        """The readonly flag of the latest version is checked."""
+        self.page.readonly = 0
+        self.page.save('user', 'readonly flag removed')
+        perm_cache = PermissionCache(self.env, 'user2', self.page.resource)
+        for perm in ('WIKI_DELETE', 'WIKI_MODIFY', 'WIKI_RENAME'):
+            self.assertIsNone(
+                self.policy.check_permission(perm, perm_cache.username,
+                                             self.page.resource, perm_cache))
+            self.assertFalse(
+                self.policy.check_permission(perm, perm_cache.username,
+                                             self.page.resource(version=1),
+                                             perm_cache))
+
+        self.page.rename('OtherPage')
+        self.page.readonly = 1
+        self.page.save('user', 'readonly flag set')
+        self.assertFalse(
+            self.policy.check_permission('WIKI_MODIFY', perm_cache.username,
+                                         self.page.resource, perm_cache))
+
 
 class WikiModuleTestCase(unittest.TestCase):
 
@@ -147,11 +177,377 @@ class WikiModuleTestCase(unittest.TestCase):
         self.assertNotIn('version', resp[1])
         self.assertEqual('NewPage', resp[1]['page'].name)
 
+    def test_history_pages(self):
+        self.env.config.set('wiki', 'history_page_size', 3)
+        page = WikiPage(self.env, 'TestPage')
+        for i in range(7):
+            page.text = 'Version %d' % (i + 1)
+            page.save('joe', '')
+
+        def history(version):
+            req = MockRequest(self.env, path_info='/wiki/TestPage',
+                              args={'action': 'history', 'page': 'TestPage',
+                                    'version': version})
+            resp = WikiModule(self.env).process_request(req)
+            links = req.chrome['links']
+            return ([item['version'] for item in resp[1]['history']],
+                    links['prev'][0]['href'] if 'prev' in links else None,
+                    links['next'][0]['href'] if 'next' in links else None)
+
+        self.assertEqual(
+            ([7, 6, 5], None,
+             '/trac.cgi/wiki/TestPage?action=history&version=4'),
+            history(''))
+        self.assertEqual(
+            ([4, 3, 2], '/trac.cgi/wiki/TestPage?action=history',
+             '/trac.cgi/wiki/TestPage?action=history&version=1'),
+            history('4'))
+        self.assertEqual(
+            ([1], '/trac.cgi/wiki/TestPage?action=history&version=4', None),
+            history('1'))
+
+    def test_diff_prev_next_versions(self):
+        page = WikiPage(self.env, 'TestPage')
+        for i in range(4):
+            page.text = 'Version %d' % (i + 1)
+            page.save('joe', 'Change %d' % (i + 1))
+        req = MockRequest(self.env, path_info='/wiki/TestPage',
+                          args={'action': 'diff', 'page': 'TestPage',
+                                'version': '3', 'old_version': '1'})
+
+        resp = WikiModule(self.env).process_request(req)
+
+        self.assertEqual(1, resp[1]['old_version'])
+        self.assertEqual(3, resp[1]['new_version'])
+        self.assertEqual(2, resp[1]['num_changes'])
+        self.assertEqual('Change 3', resp[1]['change']['comment'])
+        links = req.chrome['links']
+        self.assertEqual('/trac.cgi/wiki/TestPage?action=diff&version=2',
+                         links['prev'][0]['href'])
+        self.assertEqual('/trac.cgi/wiki/TestPage?action=diff&version=4',
+                         links['next'][0]['href'])
+
+    def test_timeline_events(self):
+        module = WikiModule(self.env)
+        module._changes_batch_size = 2
+        for i in range(5):
+            for name in ('PageA', 'PageB'):
+                page = WikiPage(self.env, name)
+                page.text = 'Version %d' % (i + 1)
+                page.save('joe', '', datetime(2019, 1, i + 1, tzinfo=utc))
+        start = datetime(2019, 1, 1, tzinfo=utc)
+        stop = datetime(2019, 1, 4, tzinfo=utc)
+
+        def events(**kwargs):
+            req = MockRequest(self.env, path_info='/timeline',
+                              args={'max': '3'})
+            return [(event[3][0].id, event[3][0].version) for event in
+                    module.get_timeline_events(req, start, stop, ['wiki'],
+                                               **kwargs)]
+
+        self.assertEqual([('PageA', 4), ('PageB', 4), ('PageA', 3),
+                          ('PageB', 3), ('PageA', 2), ('PageB', 2),
+                          ('PageA', 1), ('PageB', 1)], events())
+        self.assertEqual([('PageA', 4), ('PageB', 4), ('PageA', 3)],
+                         events(limit=3))
+        self.assertEqual(8, len(events(limit=10)))
+
+
+class WikiRenderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub()
+        self.cache = WikiRenderCache(self.env)
+        self.page = self._insert_page('SomePage', "See OtherPage.")
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _insert_page(self, name, text):
+        page = WikiPage(self.env, name)
+        page.text = text
+        page.save('joe', 'Page added')
+        return page
+
+    def _render(self, page, text=None):
+        req = MockRequest(self.env)
+        context = web_context(req, page.resource)
+        rendered = self.cache.render(context, page, text or page.text)
+        self.assertEqual(format_to_html(self.env, context, text or page.text),
+                         rendered)
+        return rendered
+
+    def test_static_page_is_cached(self):
+        first = self._render(self.page)
+        self.assertIn('class="missing wiki"', first)
+        self.assertIs(first, self._render(self.page))
+
+    def test_page_calling_macros_is_not_cached(self):
+        page = self._insert_page('MacroPage', "[[PageOutline]] OtherPage")
+        self.assertIsNot(self._render(page), self._render(page))
+
+    def test_page_with_highlighted_code_is_not_cached(self):
+        page = self._insert_page('CodePage', "{{{#!text/x-python\npass\n}}}")
+        self.assertIsNot(self._render(page), self._render(page))
+
+    def test_page_linking_other_realms_is_not_cached(self):
+        for text in ("See #1.", "See ticket:1.", "See [ticket:1 one].",
+                     "See <attachment:file.txt>.", "See [[ticket:1]]."):
+            page = self._insert_page('LinkPage', text)
+            self.assertIsNot(self._render(page), self._render(page))
+            page.delete()
+
+    def test_page_with_wiki_links_is_cached(self):
+        page = self._insert_page('LinkPage', "See [wiki:OtherPage] and "
+                                             "!#1, [[OtherPage]].")
+        self.assertIs(self._render(page), self._render(page))
+
+    def test_cache_keyed_on_permissions(self):
+        first = self._render(self.page)
+        PermissionSystem(self.env).grant_permission('anonymous',
+                                                    'TICKET_ADMIN')
+        self.assertIsNot(first, self._render(self.page))
+
+    def test_cache_cleared_when_page_created(self):
+        first = self._render(self.page)
+        self._insert_page('OtherPage', "Target.")
+        second = self._render(self.page)
+        self.assertIsNot(first, second)
+        self.assertIn('class="wiki"', second)
+
+    def test_text_modified_in_place(self):
+        self._render(self.page)
+        self.assertIn('Replaced text', self._render(self.page, "Replaced text"))
+
+    def test_page_deleted_keeps_cached_blocks(self):
+        page = self._insert_page('BlockPage', "See OtherPage.\n\nEnd.\n")
+        self._render(page)
+        blocks = [key for key in self.cache._cache._data
+                  if key[0] == 'block']
+        self.assertTrue(blocks)
+        # The block keys start with the name of the formatter class
+        self._insert_page(blocks[0][1], "Same name.").delete()
+        for key in blocks:
+            self.assertIn(key, self.cache._cache)
+        page.delete()
+        for key in blocks:
+            self.assertIn(key, self.cache._cache)
+
+    def test_render_chunks(self):
+        page = self._insert_page('LargePage', "[[PageOutline]]\n" +
+                                 "\n".join("Line %d of OtherPage" % i
+                                            for i in xrange(1000)))
+        req = MockRequest(self.env)
+        context = web_context(req, page.resource)
+        chunks = list(self.cache.render_chunks(context, page, page.text))
+        self.assertLess(1, len(chunks))
+        self.assertEqual(format_to_html(self.env, context, page.text),
+                         u''.join(chunks))
+
+    def test_render_chunks_static_page(self):
+        req = MockRequest(self.env)
+        context = web_context(req, self.page.resource)
+        chunks = list(self.cache.render_chunks(context, self.page,
+                                               self.page.text))
+        self.assertEqual([self._render(self.page)], chunks)
+        self.assertEqual(chunks, self.cache.render_chunks(context, self.page,
+                                                          self.page.text))
+
+    def test_comment_is_cached(self):
+        req = MockRequest(self.env)
+        context = web_context(req, self.page.resource)
+        first = self.cache.render_comment(context, "Fixed OtherPage",
+                                          'oneliner')
+        self.assertIn('class="missing wiki"', first)
+        self.assertIs(first, self.cache.render_comment(
+            context, "Fixed OtherPage", 'oneliner'))
+        self.assertIsNot(first, self.cache.render_comment(
+            context, "Fixed OtherPage", 'html'))
+        self.assertIsNot(self.cache.render_comment(context, "[[PageOutline]]",
+                                                   'oneliner'),
+                         self.cache.render_comment(context, "[[PageOutline]]",
+                                                   'oneliner'))
+
+        self.page.edit_comment("Edited")
+        self.assertIsNot(first, self.cache.render_comment(
+            context, "Fixed OtherPage", 'oneliner'))
+
+    def test_comment_linking_other_realms_is_not_cached(self):
+        req = MockRequest(self.env)
+        context = web_context(req, self.page.resource)
+        for comment in ("Fixed #1", "See ticket:1"):
+            self.assertIsNot(self.cache.render_comment(context, comment,
+                                                       'oneliner'),
+                             self.cache.render_comment(context, comment,
+                                                       'oneliner'))
+
+    def test_comment_cache_is_keyed_on_permissions(self):
+        req = MockRequest(self.env, authname='joe')
+        context = web_context(req, self.page.resource)
+        first = self.cache.render_comment(context, "Fixed OtherPage",
+                                          'oneliner')
+        self.assertIs(first, self.cache.render_comment(
+            context, "Fixed OtherPage", 'oneliner'))
+        PermissionSystem(self.env).grant_permission('joe', 'WIKI_ADMIN')
+        self.assertIsNot(first, self.cache.render_comment(
+            context, "Fixed OtherPage", 'oneliner'))
+
+    def test_history_comments(self):
+        self.page.text = "Modified"
+        self.page.save('joe', "See ''OtherPage''")
+        req = MockRequest(self.env, path_info='/wiki/SomePage',
+                          args={'action': 'history', 'page': 'SomePage'})
+        resp = WikiModule(self.env).process_request(req)
+        context = web_context(req, self.page.resource)
+        rendered = resp[1]['wiki_to_oneliner'](context, "See ''OtherPage''",
+                                               shorten=True)
+        self.assertIn('<em>', rendered)
+        self.assertIs(rendered, self.cache.render_comment(
+            context, "See ''OtherPage''", 'oneliner', True))
+
+    def test_history_comments_not_cached(self):
+        self.page.text = "Modified"
+        self.page.save('joe', "Fixed #1")
+        req = MockRequest(self.env, path_info='/wiki/SomePage',
+                          args={'action': 'history', 'page': 'SomePage'})
+        resp = WikiModule(self.env).process_request(req)
+        context = web_context(req, self.page.resource)
+        wiki_to_oneliner = resp[1]['wiki_to_oneliner']
+        # The comments rendered for the page are not rendered again
+        self.assertIs(wiki_to_oneliner(context, "Fixed #1", shorten=True),
+                      wiki_to_oneliner(context, "Fixed #1", shorten=True))
+
+    def test_comments_with_form_feed(self):
+        req = MockRequest(self.env)
+        context = web_context(req, self.page.resource)
+        self.assertEqual([u'form feed', u'vertical tab'],
+                         [unicode(markup) for markup in
+                          self.cache.render_comments(
+                              context, [u'form\ffeed', u'vertical\vtab'],
+                              'oneliner')])
+
+    def test_cache_disabled(self):
+        self.env.config.set('wiki', 'render_cache_size', 0)
+        self.assertIsNot(self._render(self.page), self._render(self.page))
+
+
+class WikiSearchIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub()
+        self._insert_page('WikiStart', "Welcome to the wiki.", 'joe')
+        self._insert_page('SandBox', "Play with the wiki formatting.",
+                          'jim')
+        WikiAdmin(self.env).upgrade_environment()
+        self.env.config.set('wiki', 'search_word_prefixes', 'enabled')
+        self.index = WikiSearchIndex(self.env)
+
+    def tearDown(self):
+        DatabaseManager(self.env).drop_tables(db_default.schema)
+        self.env.reset_db()
+
+    def _insert_page(self, name, text, author='joe'):
+        page = WikiPage(self.env, name)
+        page.text = text
+        page.save(author, 'Page modified')
+        return page
+
+    def _search(self, *terms):
+        req = MockRequest(self.env)
+        return [result[1].split(':')[0] for result in
+                WikiModule(self.env).get_search_results(req, terms,
+                                                        ['wiki'])]
+
+    def test_get_words(self):
+        self.assertEqual({'wikiformatting': 1, 'wiki': 2, 'formatting': 1,
+                          'html': 1, 'parser': 1, 'htmlparser': 1},
+                         self.index.get_words('WikiFormatting HTMLParser',
+                                              'wiki'))
+
+    def test_upgrade_indexes_pages(self):
+        self.assertEqual(['SandBox', 'WikiStart'],
+                         sorted(self.index.search(['wiki'])))
+        self.assertEqual(['SandBox'], self.index.search(['jim']))
+        self.assertEqual(['SandBox'], self.index.search(['box']))
+        self.assertEqual([('SandBox', 1, "Play with the wiki formatting."),
+                          ('WikiStart', 1, "Welcome to the wiki.")],
+                         self.env.db_query("""
+                            SELECT name, version, text FROM wiki_plaintext
+                            ORDER BY name"""))
+
+    def test_upgrade_same_as_rebuild(self):
+        def rows():
+            return self.env.db_query("""
+                SELECT term, name, weight FROM wiki_search
+                ORDER BY term, name""")
+        upgraded = rows()
+        self.index.rebuild()
+        self.assertEqual(rows(), upgraded)
+
+    def test_ranking(self):
+        self._insert_page('WikiFormatting', "Wiki markup of the wiki pages.")
+        self.assertEqual('WikiFormatting', self.index.search(['wiki'])[0])
+        self.assertEqual(['WikiFormatting'], self.index.search(['wiki',
+                                                                'mark']))
+
+    def test_page_changes_are_indexed(self):
+        page = self._insert_page('SandBox', "Another text.")
+        self.assertEqual(['SandBox'], self.index.search(['another']))
+        self.assertEqual([], self.index.search(['formatting']))
+        page.delete(version=2)
+        self.assertEqual([], self.index.search(['another']))
+        self.assertEqual(['SandBox'], self.index.search(['formatting']))
+        page = WikiPage(self.env, 'SandBox')
+        page.rename('PlayGround')
+        self.assertEqual(['PlayGround'], self.index.search(['formatting']))
+        page.delete()
+        self.assertEqual([], self.index.search(['formatting']))
+
+    def test_search_results(self):
+        self.assertEqual(['SandBox'], self._search('with the wiki'))
+        self.assertEqual(['SandBox', 'WikiStart'],
+                         sorted(self._search('wiki')))
+        self.assertEqual([], self._search('formatting', 'welcome'))
+        self.assertEqual(['WikiStart'], self._search('wel'))
+        self.assertEqual(['SandBox'], self._search('.', 'play'))
+
+    def test_search_word_prefixes(self):
+        self._insert_page('ReportPage', "A report of the week.")
+        self._insert_page('PortalPage', "The portal of the site.")
+        self.assertEqual(['PortalPage'], self._search('port'))
+        self.assertEqual([], self._search('come'))
+        self.env.config.set('wiki', 'search_word_prefixes', 'disabled')
+        self.assertEqual(['PortalPage', 'ReportPage'],
+                         sorted(self._search('port')))
+        self.assertEqual(['WikiStart'], self._search('come'))
+
+    def test_search_excerpts_from_plaintext(self):
+        self._insert_page('WikiStart', "= Welcome =\n"
+                                       "'''Bold''' [wiki:Sandbox sand box].")
+        results = list(WikiModule(self.env).get_search_results(
+            MockRequest(self.env), ['bold'], ['wiki']))
+        self.assertEqual(1, len(results))
+        self.assertEqual('WikiStart: Welcome\nBold sand box.', results[0][1])
+        self.assertEqual('Welcome\nBold sand box.', unicode(results[0][4]))
+
+    def test_search_max_results(self):
+        self.env.config.set('wiki', 'search_max_results', 1)
+        self._insert_page('WikiFormatting', "Wiki markup of the wiki pages.")
+        self.assertEqual(['WikiFormatting'], self._search('wiki'))
+
+    def test_search_without_index(self):
+        self.env.disable_component(WikiSearchIndex)
+        self.assertEqual(['SandBox', 'WikiStart'],
+                         sorted(self._search('wiki')))
+        self.assertEqual(['WikiStart'], self._search('come'))
+
 
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(DefaultWikiPolicyTestCase))
     suite.addTest(unittest.makeSuite(WikiModuleTestCase))
+    suite.addTest(unittest.makeSuite(WikiRenderCacheTestCase))
+    suite.addTest(unittest.makeSuite(WikiSearchIndexTestCase))
     return suite
 
 
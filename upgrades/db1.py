@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://trac.edgewall.org/wiki/TracLicense.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://trac.edgewall.org/log/.
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+
+def do_upgrade(env, version, cursor):
+    """Add the wiki_latest table and fill it from the page history."""
+    table = Table('wiki_latest', key='name')[
+                Column('name'),
+                Column('version', type='int'),
+                Column('time', type='int64'),
+                Column('author'),
+                Column('readonly', type='int'),
+                Index(['time'])]
+
+    dbm = DatabaseManager(env)
+    dbm.drop_tables([table])
+    dbm.create_tables([table])
+    with env.db_transaction as db:
+        db("""
+            INSERT INTO wiki_latest (name, version, time, author, readonly)
+            SELECT w1.name, w1.version, w1.time, w1.author, w1.readonly
+            FROM wiki w1
+            INNER JOIN (SELECT name, MAX(version) AS version
+                        FROM wiki GROUP BY name) w2
+              ON w1.name = w2.name AND w1.version = w2.version
+            """)
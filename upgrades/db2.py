@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://trac.edgewall.org/wiki/TracLicense.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://trac.edgewall.org/log/.
+
+from trac.db import Table, Column, DatabaseManager
+from trac.wiki.api import _text_hash
+
+
+def do_upgrade(env, version, cursor):
+    """Add the wiki_text and wiki_storage tables and move the texts of the
+    versions of the pages to them, storing each distinct text once. The
+    versions are processed in batches.
+    """
+    tables = [
+        Table('wiki_text', key='hash')[
+            Column('hash'),
+            Column('text'),
+            Column('refs', type='int')],
+        Table('wiki_storage', key=('name', 'version'))[
+            Column('name'),
+            Column('version', type='int'),
+            Column('hash'),
+            Column('base', type='int'),
+            Column('delta')],
+    ]
+
+    dbm = DatabaseManager(env)
+    dbm.drop_tables(tables)
+    dbm.create_tables(tables)
+    with env.db_transaction as db:
+        refs = {}
+        where = ''
+        args = ()
+        while True:
+            rows = db("""
+                SELECT name, version, text FROM wiki %s
+                ORDER BY name, version LIMIT 1000
+                """ % where, args)
+            if not rows:
+                break
+            where = "WHERE name > %s OR name = %s AND version > %s"
+            args = (rows[-1][0], rows[-1][0], rows[-1][1])
+            texts = []
+            storage = []
+            for name, num, text in rows:
+                if text is None:
+                    continue
+                digest = _text_hash(text)
+                if digest in refs:
+                    refs[digest] += 1
+                else:
+                    refs[digest] = 1
+                    texts.append((digest, text))
+                storage.append((name, num, digest))
+            db.executemany("""
+                INSERT INTO wiki_text (hash, text, refs) VALUES (%s, %s, 0)
+                """, texts)
+            db.executemany("""
+                INSERT INTO wiki_storage (name, version, hash)
+                VALUES (%s, %s, %s)
+                """, storage)
+            db.executemany("""
+                UPDATE wiki SET text=NULL WHERE name=%s AND version=%s
+                """, [(name, num) for name, num, digest in storage])
+        db.executemany("UPDATE wiki_text SET refs=%s WHERE hash=%s",
+                       [(count, digest) for digest, count in refs.iteritems()])
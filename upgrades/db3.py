@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://trac.edgewall.org/wiki/TracLicense.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://trac.edgewall.org/log/.
+
+import re
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+# The words of the index, as defined when the table was added
+max_word_length = 64
+word_re = re.compile(r'\w+', re.UNICODE)
+word_part_re = re.compile(r'[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])')
+
+
+def get_words(*texts):
+    words = {}
+    for text in texts:
+        for word in word_re.findall(text or ''):
+            if len(word) > max_word_length:
+                continue
+            parts = word_part_re.findall(word)
+            if len(parts) > 1 or parts and parts[0] != word:
+                parts.insert(0, word)
+            for part in parts:
+                part = part.lower()
+                words[part] = words.get(part, 0) + 1
+    return words
+
+
+def do_upgrade(env, version, cursor):
+    """Add the wiki_search table and index the latest version of the
+    wiki pages. The pages are processed in batches.
+    """
+    table = Table('wiki_search', key=('term', 'name'))[
+                Column('term'),
+                Column('name'),
+                Column('weight', type='int'),
+                Index(['name'])]
+
+    dbm = DatabaseManager(env)
+    dbm.drop_tables([table])
+    dbm.create_tables([table])
+    with env.db_transaction as db:
+        where = ''
+        args = ()
+        while True:
+            # The text is either in the wiki table or in the wiki_text
+            # table, since version 2
+            rows = db("""
+                SELECT w.name, w.author, COALESCE(w.text, t.text)
+                FROM wiki w INNER JOIN wiki_latest l
+                  ON l.name = w.name AND l.version = w.version
+                LEFT OUTER JOIN wiki_storage s
+                  ON s.name = w.name AND s.version = w.version
+                LEFT OUTER JOIN wiki_text t ON t.hash = s.hash %s
+                ORDER BY w.name LIMIT 100
+                """ % where, args)
+            if not rows:
+                break
+            where = "WHERE w.name > %s"
+            args = (rows[-1][0],)
+            db.executemany("""
+                INSERT INTO wiki_search (term, name, weight)
+                VALUES (%s, %s, %s)
+                """, [(word, name, count)
+                      for name, author, text in rows
+                      for word, count in get_words(name, author,
+                                                   text).iteritems()])
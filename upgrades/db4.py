@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://trac.edgewall.org/wiki/TracLicense.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://trac.edgewall.org/log/.
+
+import re
+
+from trac.db import Table, Column, DatabaseManager
+
+# An approximation of the plain text rendered by the wiki formatter, which
+# replaces it when the pages are modified or reindexed
+processor_re = re.compile(r'^\s*(?:\{\{\{(?:#!.*)?|\}\}\}|#!.*)$')
+line_re = re.compile(r'^\s*(?:>+|=+|[-*]|[0-9a-zA-Z]+\.)\s+|'
+                     r'\s*=+\s*(?:#\S+)?\s*$')
+macro_re = re.compile(r'\[\[\w+\([^\]]*\)\]\]')
+link_re = re.compile(r'\[\[(?:[^|\]]*\|)?([^\]]*)\]\]|'
+                     r'\[\S+\s+([^\]]+)\]|\[(\S+)\]')
+style_re = re.compile(r"'{2,3}|__|~~|\^|,,|`|\{\{\{|\}\}\}|\|\||!(?=\S)")
+
+
+def to_plaintext(text):
+    lines = []
+    for line in (text or '').splitlines():
+        if processor_re.match(line):
+            continue
+        line = macro_re.sub('', line_re.sub('', line))
+        line = link_re.sub(lambda m: m.group(1) or m.group(2) or
+                                     m.group(3) or '', line)
+        line = ' '.join(style_re.sub(' ', line).split())
+        if line:
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def do_upgrade(env, version, cursor):
+    """Add the wiki_plaintext table, and store the plain text of the
+    latest version of the wiki pages. The pages are processed in
+    batches.
+    """
+    table = Table('wiki_plaintext', key='name')[
+                Column('name'),
+                Column('version', type='int'),
+                Column('text')]
+
+    dbm = DatabaseManager(env)
+    dbm.drop_tables([table])
+    dbm.create_tables([table])
+    with env.db_transaction as db:
+        where = ''
+        args = ()
+        while True:
+            # The text is either in the wiki table or in the wiki_text
+            # table, since version 2
+            rows = db("""
+                SELECT w.name, w.version, COALESCE(w.text, t.text)
+                FROM wiki w INNER JOIN wiki_latest l
+                  ON l.name = w.name AND l.version = w.version
+                LEFT OUTER JOIN wiki_storage s
+                  ON s.name = w.name AND s.version = w.version
+                LEFT OUTER JOIN wiki_text t ON t.hash = s.hash %s
+                ORDER BY w.name LIMIT 100
+                """ % where, args)
+            if not rows:
+                break
+            where = "WHERE w.name > %s"
+            args = (rows[-1][0],)
+            db.executemany("""
+                INSERT INTO wiki_plaintext (name, version, text)
+                VALUES (%s, %s, %s)
+                """, [(name, num, to_plaintext(text))
+                      for name, num, text in rows])
@@ -16,7 +16,7 @@ from trac.resource import Resource
 from trac.web.api import IRequestHandler
 from trac.web.chrome import chrome_info_script, web_context
 from trac.wiki.api import WikiSystem
-from trac.wiki.formatter import format_to
+from trac.wiki.web_ui import WikiRenderCache
 
 
 class WikiRenderer(Component):
@@ -51,6 +51,7 @@ class WikiRenderer(Component):
 
         resource = Resource(realm, id=id, version=version)
         context = web_context(req, resource)
-        rendered = format_to(self.env, flavor, context, text, **options) + \
+        rendered = WikiRenderCache(self.env).render_text(context, text,
+                                                         flavor, **options) + \
                    chrome_info_script(req)
         req.send(rendered.encode('utf-8'))
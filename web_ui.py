@@ -18,18 +18,20 @@
 
 import pkg_resources
 import re
+from hashlib import sha1
 
 from trac.attachment import AttachmentModule, Attachment
-from trac.config import IntOption
+from trac.config import BoolOption, IntOption
 from trac.core import *
+from trac.db.api import DatabaseManager
 from trac.mimeview.api import IContentConverter, Mimeview
 from trac.perm import IPermissionPolicy, IPermissionRequestor
 from trac.resource import *
 from trac.search import ISearchSource, search_to_sql, shorten_result
 from trac.timeline.api import ITimelineEventProvider
-from trac.util import as_int, get_reporter_id
+from trac.util import as_int, get_reporter_id, lazy
 from trac.util.datefmt import from_utimestamp, to_utimestamp
-from trac.util.html import tag
+from trac.util.html import Markup, tag
 from trac.util.text import shorten_line
 from trac.util.translation import _, tag_
 from trac.versioncontrol.diff import get_diff_options, diff_blocks
@@ -38,9 +40,13 @@ from trac.web.chrome import (Chrome, INavigationContributor, ITemplateProvider,
                              accesskey, add_ctxtnav, add_link,
                              add_notice, add_script, add_stylesheet,
                              add_warning, prevnext_nav, web_context)
-from trac.wiki.api import IWikiPageManipulator, WikiSystem, validate_page_name
-from trac.wiki.formatter import format_to, OneLinerFormatter
+from trac.wiki.api import (IWikiChangeListener, IWikiPageManipulator,
+                           LRUCache, WikiSystem, validate_page_name)
+from trac.wiki.formatter import (HtmlFormatter, OneLinerFormatter,
+                                 _permissions_key, format_many, format_to,
+                                 format_to_plaintext)
 from trac.wiki.model import WikiPage
+from trac.wiki.parser import WikiParser
 
 
 class WikiModule(Component):
@@ -61,6 +67,12 @@ class WikiModule(Component):
         """Default height of the textarea on the wiki edit page.
         (//Since 1.1.5//)""")
 
+    history_page_size = IntOption('wiki', 'history_page_size', 100,
+        """Maximum number of versions displayed on each page of the wiki
+        page history. Set to 0 to display all the versions on a single
+        page. (''since 1.3.6'')
+        """)
+
     START_PAGE = property(lambda self: WikiSystem.START_PAGE)
     TITLE_INDEX_PAGE = property(lambda self: WikiSystem.TITLE_INDEX_PAGE)
     PAGE_TEMPLATES_PREFIX = 'PageTemplates/'
@@ -329,7 +341,7 @@ class WikiModule(Component):
                      "with slashes cannot be '.' or '..').")
         elif new_name == old_name:
             warn = _("The new name must be different from the old name.")
-        elif WikiPage(self.env, new_name).exists:
+        elif WikiPage(self.env, new_name, fetch_text=False).exists:
             warn = _("The page %(name)s already exists.", name=new_name)
         if warn:
             add_warning(req, warn)
@@ -438,28 +450,23 @@ class WikiModule(Component):
                 old_version = page.resource.version
                 page = WikiPage(self.env, page.name, old_version)
                 req.perm(page.resource).require('WIKI_VIEW')
-        latest_page = WikiPage(self.env, page.name)
+        latest_page = WikiPage(self.env, page.name, fetch_text=False)
         req.perm(latest_page.resource).require('WIKI_VIEW')
         new_version = page.version
 
-        date = author = comment = None
-        num_changes = 0
-        prev_version = next_version = None
-        for version, t, a, c in latest_page.get_history():
-            if version == new_version:
-                date = t
-                author = a or 'anonymous'
-                comment = c or '--'
-            else:
-                if version < new_version:
-                    num_changes += 1
-                    if not prev_version:
-                        prev_version = version
-                    if old_version is None or version == old_version:
-                        old_version = version
-                        break
-                else:
-                    next_version = version
+        date = page.time
+        author = page.author or 'anonymous'
+        comment = page.comment or '--'
+        prev_version = page.previous_version()
+        next_version = page.next_version()
+        if old_version is None:
+            old_version = prev_version
+            num_changes = 1 if prev_version else 0
+        else:
+            num_changes = self.env.db_query("""
+                SELECT COUNT(*) FROM wiki
+                WHERE name=%s AND version>=%s AND version<%s
+                """, (page.name, old_version, new_version))[0][0]
         if not old_version:
             old_version = 0
         old_page = WikiPage(self.env, page.name, old_version)
@@ -563,6 +570,7 @@ class WikiModule(Component):
         context = web_context(req, page.resource)
         data.update({
             'context': context,
+            'render_preview': WikiRenderCache(self.env).render_text,
             'author': author,
             'comment': comment,
             'edit_rows': editrows,
@@ -596,31 +604,71 @@ class WikiModule(Component):
         return 'wiki_edit_comment.html', data
 
     def _render_history(self, req, page):
-        """Extract the complete history for a given page.
+        """Extract the history for a given page, starting at the version
+        of the page.
 
         This information is used to present a changelog/history for a given
-        page.
+        page, by pages of `history_page_size` versions.
         """
         if not page.exists:
             raise TracError(_("Page %(name)s does not exist", name=page.name))
 
         data = self._page_data(req, page, 'history')
 
+        # The history is shown by pages of `history_page_size` versions,
+        # starting at the version of the page
+        limit = self.history_page_size
         history = []
-        for version, date, author, comment in page.get_history():
+        older_version = None
+        for version, date, author, comment in \
+                page.get_history(limit=limit + 1 if limit > 0 else None):
+            if len(history) == limit:
+                older_version = version
+                break
             history.append({
                 'version': version,
                 'date': date,
                 'author': author,
                 'comment': comment or ''
             })
+        # The comments are rendered at once, and then looked up by the
+        # template
+        render_cache = WikiRenderCache(self.env)
+        comments = [item['comment'] for item in history]
+        rendered = dict(zip(comments, render_cache.render_comments(
+            web_context(req, page.resource), comments, 'oneliner', True)))
+
+        def wiki_to_oneliner(context, comment, shorten=None):
+            if shorten and comment in rendered:
+                return rendered[comment]
+            return render_cache.render_comment(context, comment, 'oneliner',
+                                               shorten)
+
         data.update({
             'history': history,
             'resource': page.resource,
-            'can_edit_comment': 'WIKI_ADMIN' in req.perm(page.resource)
+            'can_edit_comment': 'WIKI_ADMIN' in req.perm(page.resource),
+            'wiki_to_oneliner': wiki_to_oneliner
         })
         add_ctxtnav(req, _("Back to %(wikipage)s", wikipage=page.name),
                     req.href.wiki(page.name))
+        if page.resource.version is not None and limit > 0:
+            newer = self.env.db_query("""
+                SELECT version FROM wiki WHERE name=%s AND version>%s
+                ORDER BY version LIMIT %s
+                """, (page.name, page.version, limit + 1))
+            if newer:
+                newer_version = newer[limit - 1][0] \
+                                if len(newer) > limit else None
+                add_link(req, 'prev', req.href.wiki(page.name,
+                                                    action='history',
+                                                    version=newer_version),
+                         _("Newer versions"))
+        if older_version is not None:
+            add_link(req, 'next', req.href.wiki(page.name, action='history',
+                                                version=older_version),
+                     _("Older versions"))
+        prevnext_nav(req, _("Newer Versions"), _("Older Versions"))
         return 'history_view.html', data
 
     def _render_view(self, req, page):
@@ -665,21 +713,14 @@ class WikiModule(Component):
                                        False)
                        for each in related]
 
-        latest_page = WikiPage(self.env, page.name)
+        latest_page = WikiPage(self.env, page.name, fetch_text=False)
 
         prev_version = next_version = None
         if version:
             version = as_int(version, None)
             if version is not None:
-                for hist in latest_page.get_history():
-                    v = hist[0]
-                    if v != version:
-                        if v < version:
-                            if not prev_version:
-                                prev_version = v
-                                break
-                        else:
-                            next_version = v
+                prev_version = latest_page.previous_version(version)
+                next_version = latest_page.next_version(version)
 
         prefix = self.PAGE_TEMPLATES_PREFIX
         templates = [template[len(prefix):]
@@ -721,9 +762,15 @@ class WikiModule(Component):
             manipulator.prepare_wiki_page(req, page, fields)
         text = fields.get('text', '')
 
+        rendered_text = None
+        if page.exists:
+            rendered_text = WikiRenderCache(self.env) \
+                            .render_chunks(context, page, text)
+
         data.update({
             'context': context,
             'text': text,
+            'rendered_text': rendered_text,
             'latest_version': latest_page.version,
             'attachments': AttachmentModule(self.env).attachment_data(context),
             'start_page': self.START_PAGE,
@@ -753,24 +800,73 @@ class WikiModule(Component):
         if 'WIKI_VIEW' in req.perm:
             yield ('wiki', _('Wiki changes'))
 
-    def get_timeline_events(self, req, start, stop, filters):
+    def get_timeline_events(self, req, start, stop, filters, limit=0):
+        """Return the wiki events between `start` and `stop`, the most
+        recent first.
+
+        The `TimelineModule` needs all the events of the time range, as
+        it filters them by author before keeping the most recent ones.
+        Other callers can pass a `limit` to only get the most recent
+        events, which are then read in batches and not beyond the last
+        one returned.
+        """
         if 'wiki' in filters:
             wiki_realm = Resource(self.realm)
-            for ts, name, comment, author, version in self.env.db_query("""
-                    SELECT time, name, comment, author, version FROM wiki
-                    WHERE time>=%s AND time<=%s
-                    """, (to_utimestamp(start), to_utimestamp(stop))):
+            batch_size = self._changes_batch_size if limit else None
+            count = 0
+            for ts, name, comment, author, version in \
+                    self._get_changes(start, stop, batch_size):
+                # The permission policies can restrict the versions
                 wiki_page = wiki_realm(id=name, version=version)
                 if 'WIKI_VIEW' not in req.perm(wiki_page):
                     continue
                 yield ('wiki', from_utimestamp(ts), author,
                        (wiki_page, comment))
+                count += 1
+                if limit and count >= limit:
+                    break
 
             # Attachments
             for event in AttachmentModule(self.env).get_timeline_events(
                     req, wiki_realm, start, stop):
                 yield event
 
+    _changes_batch_size = 1000
+
+    def _get_changes(self, start, stop, batch_size=None):
+        """Return the `(time, name, comment, author, version)` of the
+        page versions saved between `start` and `stop`, the most recent
+        first.
+
+        If `batch_size` is given, the rows are fetched in batches of that
+        size, using the index on the `time` column, so that only the ones
+        needed are read. Otherwise they are fetched in a single query.
+        """
+        args = (to_utimestamp(start), to_utimestamp(stop))
+        if not batch_size:
+            for row in self.env.db_query("""
+                    SELECT time, name, comment, author, version FROM wiki
+                    WHERE time>=%s AND time<=%s
+                    ORDER BY time DESC, name, version DESC
+                    """, args):
+                yield row
+            return
+        cond = ''
+        while True:
+            rows = self.env.db_query("""
+                SELECT time, name, comment, author, version FROM wiki
+                WHERE time>=%%s AND time<=%%s %s
+                ORDER BY time DESC, name, version DESC LIMIT %d
+                """ % (cond, batch_size), args)
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                break
+            ts, name, version = rows[-1][0], rows[-1][1], rows[-1][4]
+            cond = """AND (time<%s OR time=%s AND (name>%s OR
+                                                   name=%s AND version<%s))"""
+            args = args[:2] + (ts, ts, name, name, version)
+
     def render_timeline_event(self, context, field, event):
         wiki_page, comment = event[3]
         if field == 'url':
@@ -782,8 +878,8 @@ class WikiModule(Component):
             else:
                 return tag_("%(page)s created", page=name)
         elif field == 'description':
-            markup = format_to(self.env, None,
-                               context.child(resource=wiki_page), comment)
+            markup = WikiRenderCache(self.env).render_comment(
+                context.child(resource=wiki_page), comment)
             if wiki_page.version > 1:
                 diff_href = context.href.wiki(
                     wiki_page.id, version=wiki_page.version, action='diff')
@@ -800,27 +896,523 @@ class WikiModule(Component):
     def get_search_results(self, req, terms, filters):
         if not 'wiki' in filters:
             return
+        wiki_realm = Resource(self.realm)
+        index = self.env[WikiSearchIndex]
+        names = index.search(terms) \
+                if index and index.word_prefixes else None
+        if names is None:
+            results = self._search_pages(req, wiki_realm, terms)
+        else:
+            results = self._search_indexed_pages(req, wiki_realm, terms,
+                                                 names, index.max_results)
+        for result in results:
+            yield result
+
+        # Attachments
+        for result in AttachmentModule(self.env).get_search_results(
+                req, wiki_realm, terms):
+            yield result
+
+    def _search_pages(self, req, wiki_realm, terms):
+        text_sql, joins = WikiSystem(self.env).get_text_sql('w1')
         with self.env.db_query as db:
             sql_query, args = search_to_sql(db, ['w1.name', 'w1.author',
-                                                 'w1.text'], terms)
-            wiki_realm = Resource(self.realm)
+                                                 text_sql], terms)
+            if WikiSystem(self.env).has_latest_table:
+                latest = "wiki_latest"
+            else:
+                latest = """(SELECT name, max(version) AS version
+                             FROM wiki GROUP BY name)"""
             for name, ts, author, text in db("""
-                    SELECT w1.name, w1.time, w1.author, w1.text
-                    FROM wiki w1,(SELECT name, max(version) AS ver
-                                  FROM wiki GROUP BY name) w2
-                    WHERE w1.version = w2.ver AND w1.name = w2.name
-                    AND """ + sql_query, args):
+                    SELECT w1.name, w1.time, w1.author, %s
+                    FROM wiki w1 INNER JOIN %s w2
+                      ON w1.version = w2.version AND w1.name = w2.name %s
+                    WHERE %s""" % (text_sql, latest, joins, sql_query),
+                    args):
                 page = wiki_realm(id=name)
                 if 'WIKI_VIEW' in req.perm(page):
-                    yield (get_resource_url(self.env, page, req.href),
-                           '%s: %s' % (name, shorten_line(text)),
-                           from_utimestamp(ts), author,
-                           shorten_result(text, terms))
+                    yield self._search_result(req, page, ts, author, text,
+                                              terms)
 
-        # Attachments
-        for result in AttachmentModule(self.env).get_search_results(
-                req, wiki_realm, terms):
-            yield result
+    def _search_indexed_pages(self, req, wiki_realm, terms, names, limit):
+        """Return the search results for the candidate pages `names`
+        given by the search index, the most relevant first.
+
+        The index only matches words by prefix, so the terms are then
+        looked for in the latest version of the candidates, like
+        `search_to_sql` does, which are fetched in batches. The excerpts
+        are taken from their plain text when it is up to date.
+        """
+        lterms = [term.lower() for term in terms]
+        text_sql, joins = WikiSystem(self.env).get_text_sql('w')
+        count = 0
+        for start in xrange(0, len(names), 100):
+            batch = names[start:start + 100]
+            with self.env.db_query as db:
+                rows = dict((row[0], row[1:]) for row in db("""
+                    SELECT w.name, w.time, w.author, %s, p.text
+                    FROM wiki w INNER JOIN wiki_latest l
+                      ON w.version = l.version AND w.name = l.name %s
+                    LEFT OUTER JOIN wiki_plaintext p
+                      ON p.version = l.version AND p.name = l.name
+                    WHERE w.name IN (%s)
+                    """ % (text_sql, joins, ','.join(['%s'] * len(batch))),
+                    batch))
+            for name in batch:
+                if name not in rows:
+                    continue
+                ts, author, text, plaintext = rows[name]
+                text = text or ''
+                values = (name.lower(), (author or '').lower(), text.lower())
+                if not all(any(term in value for value in values)
+                           for term in lterms):
+                    continue
+                page = wiki_realm(id=name)
+                if 'WIKI_VIEW' not in req.perm(page):
+                    continue
+                if plaintext is None:
+                    plaintext = text
+                yield self._search_result(req, page, ts, author, plaintext,
+                                          terms)
+                count += 1
+                if limit and count >= limit:
+                    return
+
+    def _search_result(self, req, page, ts, author, text, terms):
+        return (get_resource_url(self.env, page, req.href),
+                '%s: %s' % (page.id, shorten_line(text)),
+                from_utimestamp(ts), author, shorten_result(text, terms))
+
+
+class WikiRenderCache(Component):
+    """Cache of the parsed and rendered wiki pages.
+
+    The parsed `WikiDocument` of a page version can always be reused. The
+    rendered HTML is only kept for pages which neither call macros nor
+    link to other realms (see `WikiParser.is_static`), as their output
+    can change at any time, and it is keyed on everything else affecting
+    the rendering: the user and the actions granted to them (for the
+    permission checks), the locale and the base URL of the request.
+
+    Entries are also keyed on the digest of the text, as `wiki replace`
+    modifies the text of the last version in place. The whole cache is
+    cleared when the set of existing pages changes, as this affects the
+    rendering of the wiki links.
+
+    The rendering of the other top-level blocks is cached as well (see
+    `Formatter.block_cache`), so that after an edit or in a preview,
+    only the modified parts of a page have to be rendered again.
+    """
+
+    implements(IWikiChangeListener)
+
+    cache_size = IntOption('wiki', 'render_cache_size', 16384,
+        """Maximum size in kilobytes of the parsed and rendered wiki pages
+        kept in memory by each process, for displaying the wiki pages.
+        Set to 0 to disable the cache. The parts of the pages calling
+        macros or linking to other realms, like tickets or attachments,
+        are always rendered again. Note that the permissions given by
+        fine-grained permission policies are not tracked, so the links
+        to wiki pages may be outdated until a page is created or
+        deleted. (''since 1.3.6'')
+        """)
+
+    def __init__(self):
+        self._pages = None
+
+    @lazy
+    def _cache(self):
+        return LRUCache(self.cache_size * 1024)
+
+    def render(self, context, page, text, flavor='html'):
+        """Render the `text` of `page`, which is usually its `text`
+        attribute, possibly modified by the `IWikiPageManipulator`\s.
+        """
+        rendered, wikidom, html_key = self._lookup(context, page, text,
+                                                   flavor)
+        if rendered is None:
+            rendered = self.render_text(context, wikidom, flavor)
+            if html_key:
+                self._cache.set(html_key, rendered, len(rendered))
+        return rendered
+
+    def render_text(self, context, text, flavor=None, **options):
+        """Render wiki `text` like `format_to`, reusing the cached
+        rendering of its top-level blocks.
+
+        This is used for wiki text which is not the content of a page
+        version, like the previews.
+        """
+        if flavor is None:
+            flavor = context.get_hint('wiki_flavor', 'html')
+        if flavor != 'oneliner':
+            options['block_cache'] = self._get_cache()
+        return format_to(self.env, flavor, context, text, **options)
+
+    def render_comment(self, context, comment, flavor=None, shorten=None):
+        """Render the change `comment` of a version of the page
+        `context.resource`, like `format_to`.
+
+        The rendering is cached unless the comment calls macros or links
+        to other realms, like `is_static` checks. It doesn't depend on the
+        version, so the entries are keyed on the page name and on the
+        digest of the comment, along with the user and permissions.
+        """
+        return self.render_comments(context, [comment], flavor, shorten)[0]
+
+    def render_comments(self, context, comments, flavor=None, shorten=None):
+        """Render the change `comments` of the page `context.resource`
+        like `render_comment`, returning the list of the renderings.
+
+        The comments which are not in the cache are formatted at once,
+        using `format_many`.
+        """
+        if flavor is None:
+            flavor = context.get_hint('wiki_flavor', 'html')
+        if flavor == 'oneliner':
+            if shorten is None:
+                shorten = context.get_hint('shorten_lines', False)
+            options = {'shorten': shorten}
+        else:
+            options = {'escape_newlines':
+                       context.get_hint('preserve_newlines', False)}
+        cache = self._get_cache()
+        if cache is None:
+            return format_many(self.env, context, comments, flavor,
+                               **options)
+        req = context.req
+        authname = req.authname if req else None
+        key_suffix = (flavor, options.get('shorten'),
+                      options.get('escape_newlines'), authname,
+                      _permissions_key(self.env, authname),
+                      str(req.locale) if req else None,
+                      context.href.base if context.href else None)
+        rendered = []
+        missing = {}
+        for comment in comments:
+            if comment:
+                digest = sha1(comment.encode('utf-8')).hexdigest()
+                key = ('comment', context.resource.id, digest) + key_suffix
+                markup = cache.get(key)
+                if markup is None:
+                    missing.setdefault(comment, []).append(len(rendered))
+            else:
+                markup = Markup()
+            rendered.append(markup)
+        if missing:
+            parser = WikiParser(self.env)
+            # The comments are paired with their documents, as the parser
+            # normalizes some whitespace in the source of the documents
+            items = missing.items()
+            wikidoms = [parser.parse(comment) for comment, indexes in items]
+            for (comment, indexes), wikidom, markup in zip(items, wikidoms,
+                    format_many(self.env, context, wikidoms, flavor,
+                                **options)):
+                for idx in indexes:
+                    rendered[idx] = markup
+                if parser.is_static(wikidom.blocks):
+                    digest = sha1(comment.encode('utf-8')).hexdigest()
+                    key = ('comment', context.resource.id, digest) + \
+                          key_suffix
+                    cache.set(key, markup, len(comment) + len(markup))
+        return rendered
+
+    def render_chunks(self, context, page, text):
+        """Render the `text` of `page` to HTML like `render`, as an
+        iterable of `Markup` chunks.
+
+        Unless the page was found in the cache, the chunks are generated
+        while the page is formatted, so they can be sent to the client
+        without waiting for the whole page to be rendered.
+        """
+        rendered, wikidom, html_key = self._lookup(context, page, text,
+                                                   'html')
+        if rendered is not None:
+            return [rendered]
+        return self._generate_chunks(context, wikidom, html_key)
+
+    def _generate_chunks(self, context, wikidom, html_key):
+        chunks = []
+        escape_newlines = context.get_hint('preserve_newlines', False)
+        formatter = HtmlFormatter(self.env, context, wikidom,
+                                  self._get_cache())
+        for chunk in formatter.generate_chunks(escape_newlines):
+            if html_key:
+                chunks.append(chunk)
+            yield chunk
+        if html_key:
+            rendered = Markup(u''.join(chunks))
+            self._cache.set(html_key, rendered, len(rendered))
+
+    def _lookup(self, context, page, text, flavor):
+        """Return the cached rendering of `text`, or `None`, along with
+        its parsed document and the key under which its rendering can be
+        cached, or `None` if it can't.
+        """
+        cache = self._get_cache()
+        if cache is None:
+            return None, WikiParser(self.env).parse(text), None
+        req = context.req
+        digest = sha1(text.encode('utf-8')).hexdigest()
+        dom_key = ('dom', page.name, page.version, digest)
+        html_key = ('html', page.name, page.version, digest, flavor,
+                    req.authname, _permissions_key(self.env, req.authname),
+                    str(req.locale), context.href.base)
+        rendered = cache.get(html_key)
+        if rendered is not None:
+            return rendered, None, html_key
+        wikidom = cache.get(dom_key)
+        if wikidom is None:
+            wikidom = WikiParser(self.env).parse(text)
+            cache.set(dom_key, wikidom, 2 * len(text))
+        if not WikiParser(self.env).is_static(wikidom.blocks):
+            html_key = None
+        return None, wikidom, html_key
+
+    def _get_cache(self):
+        if not self.cache_size:
+            return None
+        cache = self._cache
+        pages = WikiSystem(self.env).pages
+        if pages is not self._pages:
+            cache.clear()
+            self._pages = pages
+        return cache
+
+    def _discard_page(self, name):
+        self._cache.discard_matching(lambda key: key[0] != 'block' and
+                                                 key[1] == name)
+
+    # IWikiChangeListener methods
+
+    def wiki_page_added(self, page):
+        self._reset_if_intermap(page)
+
+    def wiki_page_changed(self, page, version, t, comment, author):
+        self._reset_if_intermap(page)
+
+    def wiki_page_deleted(self, page):
+        self._reset_if_intermap(page)
+        self._discard_page(page.name)
+
+    def wiki_page_version_deleted(self, page):
+        self._reset_if_intermap(page)
+        self._discard_page(page.name)
+
+    def wiki_page_renamed(self, page, old_name):
+        self._discard_page(old_name)
+
+    def wiki_page_comment_modified(self, page, old_comment):
+        self._cache.discard_matching(lambda key: key[0] == 'comment' and
+                                                 key[1] == page.name)
+
+    def _reset_if_intermap(self, page):
+        from trac.wiki.interwiki import InterWikiMap
+        if page.name == InterWikiMap._page_name:
+            self._cache.clear()
+
+
+class WikiSearchIndex(Component):
+    """Inverted index of the words of the name, author and text of the
+    latest version of the wiki pages, used for the wiki search once the
+    `wiki_search` table is installed.
+
+    The plain text of the latest version of the pages, without the wiki
+    markup, is stored in the `wiki_plaintext` table along the index, for
+    the excerpts shown in the search results.
+
+    Each word is indexed in lower case, along with the parts of the
+    CamelCase and underscore separated words. A page is a candidate for
+    a search when each word of the terms is the prefix of one of its
+    words, and the candidates are ranked by the number of occurrences
+    of these words. Unlike the scan of the texts, the index doesn't
+    find the terms in the middle of a word, so it's only used for the
+    searches when `[wiki] search_word_prefixes` is enabled.
+
+    The index is kept up to date by the `IWikiChangeListener` events,
+    so it must be rebuilt with `trac-admin wiki reindex` if this
+    component has been disabled for a while.
+    """
+
+    implements(IWikiChangeListener)
+
+    word_prefixes = BoolOption('wiki', 'search_word_prefixes', 'false',
+        """Search the wiki pages with the search index, which only finds
+        the terms at the start of a word: `port` finds "portal" but not
+        "report". Otherwise the texts of the pages are scanned for the
+        terms, which is slower on large wikis. (''since 1.3.6'')
+        """)
+
+    max_results = IntOption('wiki', 'search_max_results', 0,
+        """Maximum number of wiki pages returned by a search, the most
+        relevant ones, when the search index is installed, or 0 for no
+        limit. (''since 1.3.6'')
+        """)
+
+    # Longer words are not indexed
+    max_word_length = 64
+
+    _word_re = re.compile(r'\w+', re.UNICODE)
+    _word_part_re = re.compile(r'[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])')
+
+    @property
+    def installed(self):
+        """Whether the `wiki_search` and `wiki_plaintext` tables are
+        installed.
+        """
+        return WikiSystem(self.env).has_plaintext_table
+
+    def get_words(self, *texts):
+        """Return a `dict` of the indexed words of `texts`, with their
+        number of occurrences.
+        """
+        words = {}
+        for text in texts:
+            for word in self._word_re.findall(text or ''):
+                if len(word) > self.max_word_length:
+                    continue
+                parts = self._word_part_re.findall(word)
+                if len(parts) > 1 or parts and parts[0] != word:
+                    parts.insert(0, word)
+                for part in parts:
+                    part = part.lower()
+                    words[part] = words.get(part, 0) + 1
+        return words
+
+    def search(self, terms):
+        """Return the names of the candidate pages for the search
+        `terms`, the most relevant first, or `None` if the index can't
+        be used for these terms.
+
+        The candidates are the pages having words starting with each
+        word of the terms.
+        """
+        if not self.installed:
+            return None
+        words = set()
+        for term in terms:
+            words.update(word.lower() for word in self._word_re.findall(term)
+                         if len(word) <= self.max_word_length)
+        if not words:
+            return None
+        # The terms starting with a word are selected by a range, which
+        # unlike a LIKE pattern can use the index of the term column
+        ranges = [(word, word[:-1] + unichr(ord(word[-1]) + 1))
+                  for word in words]
+        with self.env.db_query as db:
+            match = '(term>=%s AND term<%s)'
+            sql = """SELECT name, SUM(weight) AS score FROM wiki_search
+                     WHERE (%s)""" % ' OR '.join([match] * len(ranges))
+            for bounds in ranges:
+                sql += """ AND name IN (SELECT name FROM wiki_search
+                                        WHERE %s)""" % match
+            args = [bound for bounds in ranges for bound in bounds]
+            sql += " GROUP BY name ORDER BY score DESC, name"
+            return [name for name, score in db(sql, args + args)]
+
+    def index_page(self, page):
+        """Index the name, author and text of `page`, the latest version
+        of the page, replacing its previous entries.
+        """
+        if self.installed:
+            self._index_page(page)
+
+    def _index_page(self, page):
+        with self.env.db_transaction:
+            self._index_words(page)
+            self._store_plaintext(page)
+
+    def _index_words(self, page):
+        words = self.get_words(page.name, page.author, page.text)
+        with self.env.db_transaction as db:
+            db("DELETE FROM wiki_search WHERE name=%s", (page.name,))
+            db.executemany("""
+                INSERT INTO wiki_search (term, name, weight)
+                VALUES (%s, %s, %s)
+                """, [(word, page.name, count)
+                      for word, count in words.iteritems()])
+
+    def _store_plaintext(self, page):
+        context = web_context(None, page.resource)
+        plaintext = format_to_plaintext(self.env, context, page.text)
+        with self.env.db_transaction as db:
+            db("DELETE FROM wiki_plaintext WHERE name=%s", (page.name,))
+            db("""INSERT INTO wiki_plaintext (name, version, text)
+                  VALUES (%s, %s, %s)
+                  """, (page.name, page.version, plaintext))
+
+    def remove_page(self, name):
+        """Remove the entries of page `name` from the index."""
+        if self.installed:
+            with self.env.db_transaction as db:
+                self._remove_page(db, name)
+
+    def _remove_page(self, db, name):
+        db("DELETE FROM wiki_search WHERE name=%s", (name,))
+        db("DELETE FROM wiki_plaintext WHERE name=%s", (name,))
+
+    def reindex_page(self, name):
+        """Index the latest version of page `name`, or remove its entries
+        if it doesn't exist.
+        """
+        page = WikiPage(self.env, name)
+        if page.exists:
+            self.index_page(page)
+        else:
+            self.remove_page(name)
+
+    def rebuild(self):
+        """Index all the wiki pages again, once the `wiki_search` table
+        has been created. Their plain text is stored again as well if the
+        `wiki_plaintext` table exists.
+
+        The pages are indexed in batches, each in its own transaction.
+        """
+        plaintext = DatabaseManager(self.env).has_table('wiki_plaintext')
+        self._rebuild(True, plaintext)
+
+    def rebuild_plaintext(self):
+        """Store the plain text of all the wiki pages again, once the
+        `wiki_plaintext` table has been created.
+        """
+        self._rebuild(False, True)
+
+    def _rebuild(self, words, plaintext):
+        with self.env.db_transaction as db:
+            if words:
+                db("DELETE FROM wiki_search")
+            if plaintext:
+                db("DELETE FROM wiki_plaintext")
+        names = sorted(WikiSystem(self.env).pages)
+        for start in xrange(0, len(names), 100):
+            with self.env.db_transaction:
+                for name in names[start:start + 100]:
+                    page = WikiPage(self.env, name)
+                    if words:
+                        self._index_words(page)
+                    if plaintext:
+                        self._store_plaintext(page)
+
+    # IWikiChangeListener methods
+
+    def wiki_page_added(self, page):
+        self.index_page(page)
+
+    def wiki_page_changed(self, page, version, t, comment, author):
+        self.index_page(page)
+
+    def wiki_page_deleted(self, page):
+        self.remove_page(page.name)
+
+    def wiki_page_version_deleted(self, page):
+        self.reindex_page(page.name)
+
+    def wiki_page_renamed(self, page, old_name):
+        self.remove_page(old_name)
+        self.reindex_page(page.name)
+
+    def wiki_page_comment_modified(self, page, old_comment):
+        pass
 
 
 class DefaultWikiPolicy(Component):
@@ -841,6 +1433,11 @@ class DefaultWikiPolicy(Component):
             if action == 'WIKI_CHANGE_READONLY':
                 return 'WIKI_ADMIN' in perm(resource)
             if action in ('WIKI_DELETE', 'WIKI_MODIFY', 'WIKI_RENAME'):
-                page = WikiPage(self.env, resource)
-                if page.readonly and 'WIKI_ADMIN' not in perm(resource):
+                if resource.version is None:
+                    readonly = resource.id in \
+                               WikiSystem(self.env).readonly_pages
+                else:
+                    readonly = WikiPage(self.env, resource,
+                                        fetch_text=False).readonly
+                if readonly and 'WIKI_ADMIN' not in perm(resource):
                     return False